@@ -9,20 +9,29 @@
    - convert_bytes()         : Преобразует количество байт в удобочитаемый формат (B, KB, MB, ...).
    - compute_hash()          : Вычисляет SHA256 хэш для заданных данных.
    - normalize_code()        : Нормализует код (удаляет лишние переводы строк) для корректного сравнения.
-   - code_has_changed()      : Сравнивает хэш текущего файла с новым кодом/бинарником.
-   - check_for_updates()     : Проверяет наличие обновлений, загружая файл с UPDATE_URL.
-   - perform_update_exe_direct(update_url)
-                             : Обновление путем загрузки нового .exe и запуска его.
-   - perform_update_compile_py(update_url)
-                             : Обновление: загрузка .py, компиляция в .exe с помощью PyInstaller и запуск.
-   - perform_update_script_py(update_url)
-                             : Обновление, если агент запущен как .py (скачивание нового скрипта, резервное копирование и запуск).
+   - file_code_hash()        : Потоковый (кусками / через mmap) хэш файла с нормализацией .py на лету.
+   - running_code_hash()     : Хэш файла агента, кэшируется вместе с mtime и размером файла.
+   - code_has_changed()      : Сравнивает хэш текущего файла с хэшем нового кода/бинарника.
+   - stage_update()          : Потоковая запись скачиваемого обновления в промежуточный файл с подсчётом хэша.
+   - check_for_updates()     : Проверяет наличие обновлений, один раз загружая файл с UPDATE_URL в промежуточный файл.
+   - perform_update_exe_direct(staged_path)
+                             : Обновление: установка скачанного .exe и запуск его.
+   - perform_update_compile_py(staged_path)
+                             : Обновление: компиляция скачанного .py в .exe с помощью PyInstaller и запуск.
+   - perform_update_script_py(staged_path)
+                             : Обновление, если агент запущен как .py (установка нового скрипта, резервное копирование и запуск).
+   - apply_update(info)      : Сверяет хэш скачанного файла и применяет его подходящим способом.
    - do_update_if_available() : Единая точка входа для проверки и выполнения обновления.
 
 2. Системный мониторинг:
-   - get_metrics()           : Сбор метрик системы (загрузка CPU, память, диск, процессы, системная информация).
+   - get_metrics(spec)       : Сбор метрик системы (загрузка CPU, память, диск, процессы, системная информация).
+                               Каждый раздел собирается своим коллектором из METRIC_COLLECTORS.
+   - parse_fields()          : Разбирает параметр ?fields= в дерево проекции.
+   - apply_projection()      : Оставляет в ответе только запрошенные поля.
    - get_user_directories()  : Получение списка пользовательских директорий (C:/Users или /home).
    - get_services()          : Сбор списка запущенных сервисов (с учетом платформы Windows/Linux).
+   - get_cached_table()      : Кэш таблиц процессов/сервисов (обновляется не чаще TABLE_CACHE_TTL).
+   - paginate_table()        : Курсорная пагинация и фильтрация по закэшированной таблице.
    - get_ip()                : Определяет основной IP адрес машины.
    - get_uptime()            : Вычисляет аптайм машины с момента загрузки в формате "Xd Xh Xm Xs".
    - get_disks()             : Получает список примонтированных дисков с информацией о точке монтирования, файловой системе и опциях.
@@ -30,11 +39,22 @@
 3. Информация о пользователях:
    - update_user_login_info() : Обновляет статус пользователей (залогинен/разлогинен) и фиксирует время последнего входа.
    - get_user_login_info()    : Возвращает информацию о статусе пользователей с форматированным временем входа.
-   - get_machine_info()       : Собирает данные о машине: hostname, IP, аптайм, список дисков и статус пользователей.
+   - get_machine_info(spec)   : Собирает данные о машине: hostname, IP, аптайм, список дисков и статус пользователей.
 
-4. Фоновые процессы:
+4. Реестр пользователей:
+   - reload_user_registry()  : Загружает users.json (файл или каталог), если он изменился.
+   - find_user()             : O(1) поиск по имени (в т.ч. без учёта регистра).
+
+5. Фоновые процессы:
    - background_update_checker()   : Фоновая проверка обновлений с заданным интервалом.
    - background_user_status_updater(): Фоновый сбор информации о статусе пользователей.
+   - background_metrics_sampler()    : Фоновый сбор снимков метрик (поколения) для /metrics и потоков.
+   - background_services_watcher()   : Отслеживает изменения списка сервисов для long-poll /services.
+   - background_registry_watcher()   : Горячая перезагрузка реестра пользователей.
+   - background_push_sender()        : Push-режим (AGENT_PUSH_URL): пакеты снимков агрегатору
+                                       со сжатием, backoff и спулом на диске.
+   - background_discovery_announcer(): UDP-анонсы агента (AGENT_DISCOVERY=multicast|broadcast,
+                                       AGENT_DISCOVERY_SEEDS=host:port,...) для агрегаторов.
 
 Эндпойнты (Routes):
 ---------------------
@@ -45,10 +65,11 @@
       Инициирует проверку и выполнение обновления агента.
 
 - GET /users
-      Возвращает список заданных пользователей.
+      Возвращает список пользователей из реестра (users.json или встроенный список).
 
-- GET /connect/<username>
+- GET /connect/<username>[?fields=...]
       Возвращает информацию о пользователе, включая системные метрики, список директорий и данные о машине.
+      fields (например, metrics.cpu.usage,machine_info.uptime) ограничивает ответ и набор коллекторов.
 
 - GET /connect/<username>/<metric_name>
       Возвращает конкретную метрику системы (например, cpu, memory, disk) для указанного пользователя.
@@ -56,8 +77,30 @@
 - GET /connect/<username>/directories
       Возвращает список пользовательских директорий.
 
-- GET /metrics
-      Возвращает метрики системы.
+- GET /metrics[?fields=...][&wait=N&since=G]
+      Возвращает метрики системы. fields задаёт проекцию, например:
+      ?fields=cpu.usage,memory.percent,processes[].pid,name
+      Разделы, не попавшие в проекцию, не собираются.
+      Заголовок X-Generation - поколение снимка сэмплера. С wait запрос ждёт (до N сек)
+      снимок новее since (по умолчанию - новее текущего); по таймауту - 204.
+
+  Форматы ответа /metrics, /processes, /services выбираются по Accept:
+      application/json (по умолчанию), application/x-agent-columnar+json (списки объектов
+      как параллельные массивы {"$cols": {...}}), application/msgpack (та же раскладка, msgpack).
+
+- GET /metrics/prometheus
+      Экспозиция для Prometheus (OpenMetrics при Accept: application/openmetrics-text):
+      CPU, память, диски по точкам монтирования, сетевые интерфейсы, сервисы и top-N процессов.
+      Текст рендерится один раз на поколение сэмплера - повторные scrape берут кэш.
+
+- GET /metrics/stream[?fields=...&interval=N&delta=1]
+      SSE-поток снимков из фонового сэмплера (event: snapshot / delta, id: поколение).
+      interval - минимальный интервал между сообщениями подписчику, fields - проекция,
+      delta=1 - после первого снимка присылать JSON Merge Patch к предыдущему.
+      Каждый снимок сериализуется один раз на набор полей и раздаётся всем подписчикам.
+
+- WS /metrics/ws[?fields=...&interval=N&delta=1]
+      То же через WebSocket (если установлен flask-sock).
 
 - GET /metrics/list
       Возвращает список всех доступных метрик.
@@ -65,8 +108,19 @@
 - GET /connect/<username>/metrics/list
       Возвращает список доступных метрик для выбранного пользователя.
 
-- GET /services
-      Возвращает список запущенных сервисов.
+- GET /processes[?limit=&cursor=&name~=&user=&status=&cpu>&rss>][&fields=...]
+      Постраничный список процессов из кэша таблицы процессов. next_cursor в ответе
+      передаётся в cursor следующего запроса; null - страниц больше нет.
+      fields - проекция, как в /batch: ?fields=processes[].pid,name,next_cursor
+
+- GET /processes/top[?key=cpu|rss&k=20]
+      Top-k процессов по загрузке CPU или памяти (rss) из кэша таблицы процессов.
+      Строки содержат сырые cpu/rss - агрегатор сливает их в /fleet/processes/top.
+
+- GET /services[?limit=&cursor=&name~=&status=][&wait=N&since=G][&fields=...]
+      Возвращает список запущенных сервисов. С параметрами - постранично и с фильтрами.
+      fields - проекция, как в /batch (сам по себе постраничный режим не включает).
+      X-Generation меняется только при изменении списка; wait/since - как у /metrics.
 
 - GET /connect/<username>/services
       Возвращает информацию о сервисах для указанного пользователя.
@@ -74,6 +128,18 @@
 - GET /machine_info
       Возвращает подробную информацию о машине: hostname, IP, аптайм, примонтированные диски и статус пользователей.
 
+- POST /batch
+      Выполняет несколько GET-запросов (metrics, processes, services, machine_info, connect/...)
+      по одному снимку и возвращает их одним ответом:
+      {"queries": ["/metrics?fields=cpu.usage", {"path": "/processes?limit=10", "fields": "processes[].pid"}]}
+      -> {"generation": G, "results": [{"path", "status", "body" | "error"}, ...]}
+
+Локальный доступ:
+---------------------
+Если задана переменная окружения AGENT_UNIX_SOCKET, агент дополнительно слушает
+Unix-сокет с теми же маршрутами (права на файл - UNIX_SOCKET_MODE).
+Для скриптов - agent_uds_client.py:  python agent_uds_client.py /metrics?fields=cpu.usage
+
 ========================================================
 """
 
@@ -88,10 +154,36 @@ import shutil
 import requests
 import psutil
 import socket
-
-from flask import Flask, jsonify, abort, request
+import ipaddress
+import re
+import json
+import base64
+import bisect
+import heapq
+import gzip
+import random
+import codecs
+import mmap
+import tempfile
+import glob
+from urllib.parse import unquote_plus, parse_qs
+
+from flask import Flask, Response, jsonify, abort, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.serving import make_server
+
+try:
+    from flask_sock import Sock  # необязательно: WebSocket-вариант /metrics/ws
+except ImportError:
+    Sock = None
+
+try:
+    import msgpack  # необязательно: бинарный формат ответов (Accept: application/msgpack)
+except ImportError:
+    msgpack = None
 
 app = Flask(__name__)
+sock = Sock(app) if Sock else None
 
 # ------------------------------------------------------------------------------------
 #                                  Конфигурация
@@ -108,6 +200,111 @@ UPDATE_URL = "https://raw.githubusercontent.com/WrNekit/agent-updater/refs/heads
 VERISONAPP = '1.0'
 UPDATE_CHECK_INTERVAL = 60  # каждые 60 секунд проверка обновлений
 
+# Необязательный Unix-сокет для локальных скриптов (те же маршруты, без TCP).
+# Доступ ограничивается правами на файл сокета.
+UNIX_SOCKET_PATH = os.environ.get("AGENT_UNIX_SOCKET")  # например, /run/agent/agent.sock
+UNIX_SOCKET_MODE = 0o660
+
+# Необязательный push-режим: агент сам отправляет снимки сэмплера агрегатору
+# (test_connect.py, POST /fleet/ingest) - агрегатору не нужен входящий доступ к агентам.
+PUSH_URL = os.environ.get("AGENT_PUSH_URL")  # например, http://aggregator:5000/fleet/ingest
+
+AGENT_PORT = int(os.environ.get("AGENT_PORT", 5000))
+
+# Необязательное обнаружение: агент анонсирует себя по UDP, агрегаторы ведут таблицу
+# участников (test_connect.py, /fleet/members) вместо ручного списка users.
+DISCOVERY_MODE = os.environ.get("AGENT_DISCOVERY")  # "multicast" | "broadcast" | None (только сиды)
+DISCOVERY_SEEDS = [s.strip() for s in os.environ.get("AGENT_DISCOVERY_SEEDS", "").split(",") if s.strip()]  # host:port
+
+# ------------------------------------------------------------------------------------
+#                  Реестр пользователей и хостов (индексы, горячая перезагрузка)
+# ------------------------------------------------------------------------------------
+# Файл .json или каталог с .json: список {"name": ..., "ip": ...} или {"users": [...]}.
+# В "ip" можно указать диапазон CIDR (10.0.0.0/24) - тогда запись находится по любому
+# адресу из диапазона. Если файла нет, используется список users выше.
+# Тот же блок есть в agent.py, test_connect.py и deep.py: каждый файл обновляется
+# сам по себе (UPDATE_URL) и не может зависеть от соседних модулей.
+USERS_REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.json")
+REGISTRY_RELOAD_INTERVAL = 5  # как часто проверять файл реестра на изменения, сек
+
+def build_user_registry(entries, signature=None):
+    """Строит индексы реестра: по имени, по имени без учёта регистра, по IP и по сетям CIDR."""
+    registry = {
+        "signature": signature,
+        "users": [],
+        "by_name": {},
+        "by_casefold": {},
+        "by_ip": {},
+        "networks": {},  # (версия IP, длина префикса) -> {адрес сети (int): запись}
+        "network_keys": [],  # ключи networks от длинных префиксов к коротким
+    }
+    for entry in entries:
+        if not isinstance(entry, dict) or 'name' not in entry or 'ip' not in entry:
+            print(f"[WARNING] Реестр: пропущена запись без name/ip: {entry}")
+            continue
+        try:
+            network = ipaddress.ip_network(str(entry['ip']).strip(), strict=False)
+        except ValueError:
+            print(f"[WARNING] Реестр: некорректный IP у {entry['name']}: {entry['ip']}")
+            continue
+        registry["users"].append(entry)
+        registry["by_name"][entry['name']] = entry
+        registry["by_casefold"][entry['name'].casefold()] = entry
+        if network.num_addresses == 1:
+            registry["by_ip"][str(network.network_address)] = entry
+        else:
+            key = (network.version, network.prefixlen)
+            registry["networks"].setdefault(key, {})[int(network.network_address)] = entry
+    registry["network_keys"] = sorted(registry["networks"], key=lambda k: -k[1])
+    return registry
+
+def registry_signature(path):
+    """Отпечаток файла/каталога реестра (имена, mtime, размеры) для обнаружения изменений."""
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.json'))
+    elif os.path.isfile(path):
+        files = [path]
+    else:
+        return None
+    return tuple((f, os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files)
+
+def load_registry_entries(signature):
+    entries = []
+    for path, _, _ in signature:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        entries.extend(data.get("users", []) if isinstance(data, dict) else data)
+    return entries
+
+def reload_user_registry():
+    """Перечитывает реестр, если файл изменился. Индексы подменяются целиком, без блокировок чтения."""
+    global user_registry
+    try:
+        signature = registry_signature(USERS_REGISTRY_PATH)
+        if signature == user_registry["signature"]:
+            return False
+        entries = load_registry_entries(signature) if signature else users
+        user_registry = build_user_registry(entries, signature)
+        print(f"[INFO] Реестр пользователей загружен: {len(user_registry['users'])} записей")
+        return True
+    except Exception as e:
+        print("[ERROR] Не удалось загрузить реестр пользователей:", e)
+        return False
+
+def find_user(name, casefold=False):
+    """O(1) поиск записи по имени (casefold=True - без учёта регистра)."""
+    if casefold:
+        return user_registry["by_casefold"].get(name.casefold())
+    return user_registry["by_name"].get(name)
+
+def background_registry_watcher():
+    while True:
+        time.sleep(REGISTRY_RELOAD_INTERVAL)
+        reload_user_registry()
+
+user_registry = build_user_registry(users)
+reload_user_registry()
+
 # ------------------------------------------------------------------------------------
 #                          Функции для обновления агента
 # ------------------------------------------------------------------------------------
@@ -140,65 +337,234 @@ def normalize_code(data):
     except:
         return data
 
-def code_has_changed(new_data, is_py=False):
-    """Сравниваем хэш текущего файла (exe или py) с new_data."""
-    try:
-        # Используем __file__, чтобы указать путь к текущему скрипту агента
-        current_file = os.path.abspath(__file__)
-        
-        # Проверка на существование файла
-        if not os.path.exists(current_file):
-            print(f"[ERROR] Текущий файл {current_file} не существует!")
-            return True, None, None
-        
-        with open(current_file, "rb") as f:
-            current_data = f.read()
-
-        if is_py:
-            old_norm = normalize_code(current_data)
-            new_norm = normalize_code(new_data)
-        else:
-            old_norm = current_data
-            new_norm = new_data
+# Путь к файлу запущенного агента (для сравнения хэшей при обновлении)
+RUNNING_FILE = os.path.abspath(__file__)
 
-        # Вычисляем хэш для текущего и нового файла
-        old_hash = compute_hash(old_norm)
-        new_hash = compute_hash(new_norm)
+# Потоковый хэш кода: файл читается кусками HASH_CHUNK_SIZE (большие бинарники - через mmap),
+# для .py нормализация normalize_code() выполняется построчно на лету.
+# Тот же конвейер (хэш, валидаторы, промежуточный файл) есть в agent.py, test_connect.py и deep.py:
+# каждый файл обновляется сам по себе (UPDATE_URL) и не может зависеть от соседних модулей.
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_MMAP_MIN_SIZE = 16 * 1024 * 1024
 
-        # Сравнение хэшей
+def new_code_hasher(is_py):
+    """
+    Состояние потокового хэша. Результат совпадает с compute_hash(normalize_code(data)) для .py
+    и с compute_hash(data) для бинарников; если .py - не UTF-8, хэшируются сырые байты, как в normalize_code().
+    """
+    return {
+        "raw": hashlib.sha256(),
+        "norm": hashlib.sha256() if is_py else None,
+        "decoder": codecs.getincrementaldecoder("utf-8")(),
+        "tail": "",       # незавершённая строка с конца предыдущего куска
+        "blank": 0,       # пустые строки, ещё не записанные в хэш (хвостовые отбрасываются, как strip())
+        "started": False, # встретилась ли первая непустая строка (ведущие пробелы отбрасываются)
+    }
+
+def code_hasher_line(state, line):
+    line = line.rstrip()
+    if not state["started"]:
+        line = line.lstrip()
+        if not line:
+            return
+        state["started"] = True
+        state["norm"].update(line.encode("utf-8"))
+    elif not line:
+        state["blank"] += 1
+    else:
+        state["norm"].update(("\n" * (state["blank"] + 1) + line).encode("utf-8"))
+        state["blank"] = 0
+
+def code_hasher_update(state, chunk):
+    state["raw"].update(chunk)
+    if state["norm"] is None:
+        return
+    try:
+        text = state["tail"] + state["decoder"].decode(chunk)
+    except UnicodeDecodeError:
+        state["norm"] = None
+        return
+    lines = text.split("\n")
+    state["tail"] = lines.pop()
+    for line in lines:
+        code_hasher_line(state, line)
+
+def code_hasher_digest(state):
+    if state["norm"] is not None:
+        try:
+            tail = state["tail"] + state["decoder"].decode(b"", final=True)
+        except UnicodeDecodeError:
+            state["norm"] = None
+        else:
+            state["tail"] = ""
+            code_hasher_line(state, tail)
+    return (state["norm"] or state["raw"]).hexdigest()
+
+def file_code_hash(path, is_py):
+    """Хэш файла без чтения его целиком в память."""
+    state = new_code_hasher(is_py)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not is_py and size >= HASH_MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                code_hasher_update(state, mapped)
+        else:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                code_hasher_update(state, chunk)
+    return code_hasher_digest(state)
+
+# Хэш файла запущенного агента по режиму сравнения (is_py) вместе с (mtime_ns, размер),
+# при которых он посчитан: файл перечитывается, только если он изменился на диске.
+running_hash_cache = {}
+running_hash_lock = threading.Lock()
+
+def running_code_hash(is_py):
+    stamp = running_file_stamp()
+    if stamp is None:
+        raise FileNotFoundError(RUNNING_FILE)
+    with running_hash_lock:
+        cached = running_hash_cache.get(is_py)
+        if cached and cached["stamp"] == stamp:
+            return cached["hash"]
+        digest = file_code_hash(RUNNING_FILE, is_py)
+        running_hash_cache[is_py] = {"stamp": stamp, "hash": digest}
+        return digest
+
+def code_has_changed(new_hash, is_py=False):
+    """Сравниваем хэш текущего файла (exe или py) с хэшем скачанного; хэш текущего файла берётся из кэша."""
+    try:
+        old_hash = running_code_hash(is_py)
         return old_hash != new_hash, old_hash, new_hash
     except FileNotFoundError as e:
         print(f"[ERROR] Файл не найден: {e}")
-        return True, None, None
+        return True, None, new_hash
     except Exception as e:
         print(f"[ERROR] Ошибка при вычислении хэша: {e}")
-        return True, None, None
+        return True, None, new_hash
+
+# Валидаторы HTTP-кэша (ETag / Last-Modified) по URL обновления, сохраняются между
+# перезапусками. Запоминаются, только когда загруженный файл совпал с текущим, и
+# действуют, пока текущий файл не изменился (mtime и размер) - поэтому ответ 304
+# всегда означает "обновлений нет".
+UPDATE_VALIDATORS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "update_validators.json")
+
+def load_update_validators():
+    try:
+        with open(UPDATE_VALIDATORS_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_update_validators(validators):
+    tmp_path = UPDATE_VALIDATORS_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(validators, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, UPDATE_VALIDATORS_PATH)
+    except OSError as e:
+        print("[WARNING] Не удалось сохранить валидаторы обновлений:", e)
+
+def running_file_stamp():
+    """(mtime_ns, размер) файла запущенного агента."""
+    try:
+        st = os.stat(RUNNING_FILE)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+def conditional_update_headers(url):
+    """If-None-Match / If-Modified-Since для url, если валидаторы относятся к текущему файлу агента."""
+    record = load_update_validators().get(url)
+    if not record or record.get("local") != running_file_stamp():
+        return {}
+    headers = {}
+    if record.get("etag"):
+        headers["If-None-Match"] = record["etag"]
+    if record.get("last_modified"):
+        headers["If-Modified-Since"] = record["last_modified"]
+    return headers
+
+def remember_update_validators(url, resp):
+    """Сохраняет ETag/Last-Modified ответа url (вызывать, только если файл не отличается от текущего)."""
+    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    validators = load_update_validators()
+    if not etag and not last_modified:
+        if validators.pop(url, None) is None:
+            return
+    else:
+        validators[url] = {"etag": etag, "last_modified": last_modified, "local": running_file_stamp()}
+    save_update_validators(validators)
+
+def update_file_type():
+    """Тип файла обновления по UPDATE_URL: "exe" или "py"."""
+    lower_url = UPDATE_URL.lower()
+    # Для Linux по умолчанию ожидаем Python-скрипт (.py)
+    if is_windows():
+        if lower_url.endswith(".exe"):
+            return "exe"
+        elif lower_url.endswith(".py"):
+            return "py"
+        return "exe"  # по умолчанию для Windows
+    return "py"  # для Linux ожидается скрипт
+
+def stage_update(resp, file_type):
+    """
+    Пишет тело ответа кусками в промежуточный файл рядом с агентом, по ходу считая хэш кода.
+    Возвращает (путь, хэш); целиком файл в памяти не держится.
+    """
+    cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    fd, staged_path = tempfile.mkstemp(prefix="agent_update_", suffix=".part", dir=cdir)
+    state = new_code_hasher(file_type == "py")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in resp.iter_content(HASH_CHUNK_SIZE):
+                f.write(chunk)
+                code_hasher_update(state, chunk)
+        # mkstemp создаёт файл с правами 0o600; ставим те же, что дал бы open("wb")
+        os.chmod(staged_path, default_file_mode())
+    except BaseException:
+        discard_staged_update(staged_path)
+        raise
+    return staged_path, code_hasher_digest(state)
+
+def discard_staged_update(staged_path):
+    try:
+        os.remove(staged_path)
+    except OSError:
+        pass
+
+def default_file_mode():
+    """Права нового файла по умолчанию: 0o666 без битов umask."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def cleanup_staged_updates():
+    """Удаляет промежуточные файлы обновлений, оставшиеся от загрузки, прерванной падением или перезапуском."""
+    cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    for path in glob.glob(os.path.join(cdir, "agent_update_*.part")):
+        discard_staged_update(path)
 
 def check_for_updates():
-    """Скачивает UPDATE_URL, определяет, .exe или .py, сравнивает хэши."""
+    """
+    Скачивает UPDATE_URL (один раз, потоком) в промежуточный файл, определяет, .exe или .py, сравнивает хэши.
+    Если обновление есть, путь к файлу возвращается в "staged_path" для apply_update().
+    """
     try:
-        lower_url = UPDATE_URL.lower()
-        # Для Linux по умолчанию ожидаем Python-скрипт (.py)
-        if is_windows():
-            if lower_url.endswith(".exe"):
-                file_type = "exe"
-            elif lower_url.endswith(".py"):
-                file_type = "py"
-            else:
-                file_type = "exe"  # по умолчанию для Windows
-        else:
-            file_type = "py"  # для Linux ожидается скрипт
+        file_type = update_file_type()
 
-        resp = requests.get(UPDATE_URL, timeout=30)
-        if resp.status_code != 200:
-            print("[ERROR] check_for_updates: HTTP", resp.status_code)
-            return {"update_available": False, "error": f"HTTP {resp.status_code}"}
+        with requests.get(UPDATE_URL, timeout=30, stream=True,
+                          headers=conditional_update_headers(UPDATE_URL)) as resp:
+            if resp.status_code == 304:
+                # Файл на сервере не менялся с последней проверки, совпавшей с текущим файлом
+                return {"update_available": False, "not_modified": True}
+            if resp.status_code != 200:
+                print("[ERROR] check_for_updates: HTTP", resp.status_code)
+                return {"update_available": False, "error": f"HTTP {resp.status_code}"}
+            staged_path, new_hash = stage_update(resp, file_type)
 
-        new_data = resp.content
-        if file_type == "py":
-            changed, old_hash, new_hash = code_has_changed(new_data, is_py=True)
-        else:
-            changed, old_hash, new_hash = code_has_changed(new_data, is_py=False)
+        changed, old_hash, new_hash = code_has_changed(new_hash, is_py=(file_type == "py"))
 
         # Добавим отладочную информацию для диагностики
         print(f"Old hash: {old_hash}")
@@ -211,33 +577,26 @@ def check_for_updates():
                 "file_type": file_type,
                 "old_hash": old_hash,
                 "new_hash": new_hash,
-                "update_url": UPDATE_URL
+                "update_url": UPDATE_URL,
+                "staged_path": staged_path
             }
         else:
             # Если хэши не изменились, возвращаем False
+            discard_staged_update(staged_path)
+            remember_update_validators(UPDATE_URL, resp)
             return {"update_available": False}
     except Exception as e:
         print("[ERROR] check_for_updates exception:", e)
         return {"update_available": False, "error": str(e)}
 
-def perform_update_exe_direct(update_url):
+def perform_update_exe_direct(staged_path):
     """Сценарий, если в репо лежит готовый .exe, а мы тоже .exe."""
-    print("[INFO] Скачиваем готовый .exe:", update_url)
+    print("[INFO] Устанавливаем готовый .exe:", staged_path)
     try:
-        resp = requests.get(update_url, timeout=30)
-        if resp.status_code != 200:
-            return {"success": False, "message": f"HTTP {resp.status_code}"}
-
-        new_data = resp.content
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=False)
-        if not changed:
-            return {"success": False, "message": "Файл .exe не изменился."}
-
         cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
         stamp = time.strftime("%Y%m%d%H%M%S")
         new_exe = os.path.join(cdir, f"agent_new_{stamp}.exe")
-        with open(new_exe, "wb") as f:
-            f.write(new_data)
+        os.replace(staged_path, new_exe)
         print("[INFO] Новый exe сохранён:", new_exe)
 
         if is_windows():
@@ -251,23 +610,13 @@ def perform_update_exe_direct(update_url):
     except Exception as e:
         return {"success": False, "message": str(e)}
 
-def perform_update_compile_py(update_url):
-    print("[INFO] Скачиваем .py и компилируем через PyInstaller.")
+def perform_update_compile_py(staged_path):
+    print("[INFO] Компилируем скачанный .py через PyInstaller.")
     try:
-        resp = requests.get(update_url, timeout=30)
-        if resp.status_code != 200:
-            return {"success": False, "message": f"HTTP {resp.status_code}"}
-
-        new_data = resp.content
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=True)
-        if not changed:
-            return {"success": False, "message": "Исходный .py не изменился."}
-
         cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
         stamp = time.strftime("%Y%m%d%H%M%S")
         new_py = os.path.join(cdir, f"agent_new_{stamp}.py")
-        with open(new_py, "wb") as f:
-            f.write(new_data)
+        os.replace(staged_path, new_py)
 
         compile_cmd = [sys.executable, "-m", "PyInstaller", "--onefile", "--noconsole", new_py]
         res = subprocess.run(compile_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
@@ -292,26 +641,16 @@ def perform_update_compile_py(update_url):
     except Exception as e:
         return {"success": False, "message": str(e)}
 
-def perform_update_script_py(update_url):
-    print("[INFO] Скачиваем новый .py (скриптовый режим).")
+def perform_update_script_py(staged_path):
+    print("[INFO] Устанавливаем новый .py (скриптовый режим).")
     try:
-        resp = requests.get(update_url, timeout=30)
-        if resp.status_code != 200:
-            return {"success": False, "message": f"HTTP {resp.status_code}"}
-
-        new_data = resp.content
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=True)
-        if not changed:
-            return {"success": False, "message": "Новый скрипт не отличается."}
-
         cfile = os.path.abspath(sys.argv[0])
         cdir = os.path.dirname(cfile)
         stamp = time.strftime("%Y%m%d%H%M%S")
         new_py = os.path.join(cdir, f"agent_new_{stamp}.py")
         backup_py = os.path.join(cdir, f"agent_backup_{stamp}.py")
 
-        with open(new_py, "wb") as f:
-            f.write(new_data)
+        os.replace(staged_path, new_py)
         shutil.move(cfile, backup_py)
 
         if is_windows():
@@ -324,71 +663,180 @@ def perform_update_script_py(update_url):
     except Exception as e:
         return {"success": False, "message": str(e)}
 
-def do_update_if_available():
-    info = check_for_updates()
-    if not info.get("update_available"):
-        return {"success": False, "message": "Обновлений не обнаружено"}
-
+def apply_update(info):
+    """
+    Применяет файл, скачанный check_for_updates() (info["staged_path"]).
+    Хэш этого файла уже посчитан в stage_update() по мере записи, второй раз файл не читается.
+    """
+    staged_path = info["staged_path"]
     ftype = info["file_type"]
     if ftype == "exe":
-        if is_compiled():
-            return perform_update_exe_direct(info["update_url"])
-        else:
+        if not is_compiled():
             print("[WARNING] Агент .py, но обновление .exe. Запуск .exe напрямую.")
-            return perform_update_exe_direct(info["update_url"])
+        result = perform_update_exe_direct(staged_path)
     else:
         # file_type == "py"
         if is_compiled():
-            return perform_update_compile_py(info["update_url"])
+            result = perform_update_compile_py(staged_path)
         else:
-            return perform_update_script_py(info["update_url"])
+            result = perform_update_script_py(staged_path)
+    # Сюда попадаем, только если обновиться не удалось
+    discard_staged_update(staged_path)
+    return result
+
+def do_update_if_available():
+    info = check_for_updates()
+    if not info.get("update_available"):
+        return {"success": False, "message": "Обновлений не обнаружено"}
+    return apply_update(info)
 
 # ------------------------------------------------------------------------------------
 #                          Системные функции и метрики
 # ------------------------------------------------------------------------------------
-def get_metrics():
+# Поля процесса в ответе -> атрибуты psutil, которые для них нужно запросить
+PROCESS_FIELD_ATTRS = {
+    "pid": "pid",
+    "name": "name",
+    "cpu_usage": "cpu_percent",
+    "memory_usage": "memory_info",
+}
+
+def collect_cpu(spec=None):
     cpu_usage = psutil.cpu_percent(interval=1)
+    return {
+        "usage": f"{cpu_usage}%",
+        "description": "Текущая загрузка CPU"
+    }
+
+def collect_memory(spec=None):
     memory_info = psutil.virtual_memory()
+    return {
+        "total": convert_bytes(memory_info.total),
+        "used": convert_bytes(memory_info.used),
+        "free": convert_bytes(memory_info.available),
+        "percent": f"{memory_info.percent}%",
+    }
+
+def collect_disk(spec=None):
     disk_info = psutil.disk_usage('/')
+    return {
+        "total": convert_bytes(disk_info.total),
+        "used": convert_bytes(disk_info.used),
+        "free": convert_bytes(disk_info.free),
+        "percent": f"{disk_info.percent}%",
+    }
+
+def collect_processes(spec=None):
+    """Список процессов; при проекции у psutil запрашиваются только нужные атрибуты."""
+    fields = [f for f in PROCESS_FIELD_ATTRS if spec is None or f in spec]
+    if not fields:
+        return []  # проекция не называет ни одного известного поля процесса - psutil не опрашиваем
+    attrs = [PROCESS_FIELD_ATTRS[f] for f in fields]
     processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_info']):
+    for proc in psutil.process_iter(attrs):
         try:
-            processes.append({
-                "pid": proc.info['pid'],
-                "name": proc.info['name'],
-                "cpu_usage": f"{proc.info['cpu_percent']:.1f}%",
-                "memory_usage": convert_bytes(proc.info['memory_info'].rss),
-            })
+            entry = {}
+            for field in fields:
+                if field == "cpu_usage":
+                    entry[field] = f"{proc.info['cpu_percent']:.1f}%"
+                elif field == "memory_usage":
+                    entry[field] = convert_bytes(proc.info['memory_info'].rss)
+                else:
+                    entry[field] = proc.info[PROCESS_FIELD_ATTRS[field]]
+            processes.append(entry)
         except:
             pass
+    return processes
 
+def collect_last_update(spec=None):
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+def collect_system_info(spec=None):
     return {
-        "cpu": {
-            "usage": f"{cpu_usage}%",
-            "description": "Текущая загрузка CPU"
-        },
-        "memory": {
-            "total": convert_bytes(memory_info.total),
-            "used": convert_bytes(memory_info.used),
-            "free": convert_bytes(memory_info.available),
-            "percent": f"{memory_info.percent}%",
-        },
-        "disk": {
-            "total": convert_bytes(disk_info.total),
-            "used": convert_bytes(disk_info.used),
-            "free": convert_bytes(disk_info.free),
-            "percent": f"{disk_info.percent}%",
-        },
-        "processes": processes,
-        "last_update": time.strftime('%Y-%m-%d %H:%M:%S'),
-        "system_info": {
-            "os": platform.system(),
-            "os_version": platform.version(),
-            "architecture": platform.architecture()[0],
-            "hostname": platform.node()
-        }
+        "os": platform.system(),
+        "os_version": platform.version(),
+        "architecture": platform.architecture()[0],
+        "hostname": platform.node()
     }
 
+# Порядок ключей совпадает с порядком в ответе /metrics
+METRIC_COLLECTORS = {
+    "cpu": collect_cpu,
+    "memory": collect_memory,
+    "disk": collect_disk,
+    "processes": collect_processes,
+    "last_update": collect_last_update,
+    "system_info": collect_system_info,
+}
+
+def get_metrics(spec=None):
+    """
+    Собирает метрики. spec - дерево проекции (см. parse_fields);
+    коллекторы, не попавшие в проекцию, не вызываются.
+    """
+    return {
+        name: collector(spec.get(name) if spec else None)
+        for name, collector in METRIC_COLLECTORS.items()
+        if spec is None or name in spec
+    }
+
+# ------------------------------------------------------------------------------------
+#                      Проекция полей (?fields=...)
+# ------------------------------------------------------------------------------------
+def parse_fields(fields_param, roots):
+    """
+    Разбирает параметр fields в дерево проекции.
+
+    Синтаксис: пути через запятую, вложенность через точку, "[]" отмечает список
+    ("processes[].pid" применяется к каждому элементу). Имя без точки сразу после
+    пути со "[]" относится к тому же списку, если это не ключ верхнего уровня из roots:
+        cpu.usage,memory.percent,processes[].pid,name
+    Значение None в дереве означает "поле целиком".
+    """
+    spec = {}
+    list_prefix = None
+    for token in fields_param.split(','):
+        token = token.strip()
+        if not token:
+            continue
+        if list_prefix and '.' not in token and token not in roots:
+            path = list_prefix + [token]
+        else:
+            path = token.replace('[]', '').split('.')
+            list_prefix = None
+            if '[]' in token:
+                list_prefix = token[:token.rindex('[]')].replace('[]', '').split('.')
+
+        node = spec
+        for i, key in enumerate(path):
+            if not key:
+                break
+            last = (i == len(path) - 1)
+            if key in node and node[key] is None:
+                break  # поле уже выбрано целиком
+            if last:
+                node[key] = None
+            else:
+                node = node.setdefault(key, {})
+    return spec
+
+def apply_projection(data, spec):
+    """Оставляет в data только поля из дерева проекции spec."""
+    if spec is None:
+        return data
+    if isinstance(data, list):
+        return [apply_projection(item, spec) for item in data]
+    if isinstance(data, dict):
+        return {key: apply_projection(data[key], sub) for key, sub in spec.items() if key in data}
+    return data
+
+def request_fields_spec(roots):
+    """Дерево проекции из ?fields= текущего запроса или None, если параметр не задан."""
+    fields_param = request.args.get('fields')
+    if not fields_param:
+        return None
+    return parse_fields(fields_param, roots)
+
 def get_user_directories():
     path = "C:/Users" if is_windows() else "/home"
     try:
@@ -417,6 +865,224 @@ def get_services():
                 services.append({"name": parts[0], "status": parts[2]})
     return services
 
+# ------------------------------------------------------------------------------------
+#               Форматы ответа: JSON, колоночный JSON, msgpack (Accept)
+# ------------------------------------------------------------------------------------
+# Колоночная раскладка: любой список словарей с одинаковыми ключами заменяется на
+#   {"$cols": {"pid": [1, 2, ...], "name": ["init", "sshd", ...]}}
+# (параллельные массивы вместо списка объектов). Остальные значения не меняются.
+# application/x-agent-columnar+json - такая раскладка в JSON,
+# application/msgpack - такая же раскладка в msgpack (если установлен msgpack).
+COLUMNAR_MIMETYPE = "application/x-agent-columnar+json"
+MSGPACK_MIMETYPE = "application/msgpack"
+WIRE_MIMETYPES = {"json": "application/json", "columnar": COLUMNAR_MIMETYPE, "msgpack": MSGPACK_MIMETYPE}
+
+def to_columnar(data):
+    if isinstance(data, dict):
+        return {key: to_columnar(value) for key, value in data.items()}
+    if isinstance(data, list):
+        if data and isinstance(data[0], dict) and data[0] and \
+                all(isinstance(item, dict) and item.keys() == data[0].keys() for item in data):
+            return {"$cols": {key: [to_columnar(item[key]) for item in data] for key in data[0]}}
+        return [to_columnar(item) for item in data]
+    return data
+
+def from_columnar(data):
+    """Обратное преобразование: {"$cols": {...}} -> список словарей."""
+    if isinstance(data, dict):
+        if len(data) == 1 and "$cols" in data:
+            columns = data["$cols"]
+            count = len(next(iter(columns.values()), []))
+            return [{key: from_columnar(values[i]) for key, values in columns.items()} for i in range(count)]
+        return {key: from_columnar(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [from_columnar(item) for item in data]
+    return data
+
+def negotiate_format():
+    """Выбирает формат ответа по заголовку Accept; по умолчанию - JSON."""
+    offers = ["application/json", COLUMNAR_MIMETYPE] + ([MSGPACK_MIMETYPE] if msgpack else [])
+    best = request.accept_mimetypes.best_match(offers, default="application/json")
+    return {v: k for k, v in WIRE_MIMETYPES.items()}[best]
+
+def encode_body(data, fmt):
+    if fmt == "msgpack":
+        return msgpack.packb(to_columnar(data), use_bin_type=True)
+    if fmt == "columnar":
+        return json.dumps(to_columnar(data), ensure_ascii=False, separators=(',', ':'))
+    return json.dumps(data, ensure_ascii=False)
+
+def encoded_response(data, fmt, status=200, headers=None):
+    response = Response(encode_body(data, fmt), status=status, mimetype=WIRE_MIMETYPES[fmt], headers=headers)
+    response.headers["Vary"] = "Accept"
+    return response
+
+# ------------------------------------------------------------------------------------
+#          Кэш таблиц процессов и сервисов, фильтры и курсорная пагинация
+# ------------------------------------------------------------------------------------
+TABLE_CACHE_TTL = 2          # сколько секунд таблица считается свежей
+PAGE_DEFAULT_LIMIT = 100
+PAGE_MAX_LIMIT = 1000
+
+def collect_process_table():
+    """Сырые строки процессов (числа, а не отформатированные строки), отсортированные по pid."""
+    rows = []
+    for proc in psutil.process_iter(['pid', 'name', 'username', 'status', 'cpu_percent', 'memory_info']):
+        try:
+            rows.append({
+                "pid": proc.info['pid'],
+                "name": proc.info['name'] or "",
+                "user": proc.info['username'] or "",
+                "status": proc.info['status'] or "",
+                "cpu": proc.info['cpu_percent'] or 0.0,
+                "rss": proc.info['memory_info'].rss if proc.info['memory_info'] else 0,
+            })
+        except:
+            pass
+    rows.sort(key=lambda r: r["pid"])
+    return rows
+
+def collect_service_table():
+    """Строки сервисов, отсортированные по имени."""
+    return sorted(get_services(), key=lambda r: r["name"])
+
+# name -> (функция сбора, ключ сортировки/курсора)
+TABLES = {
+    "processes": (collect_process_table, "pid"),
+    "services": (collect_service_table, "name"),
+}
+
+table_cache = {}  # name -> {"time": ..., "rows": [...], "keys": [...]}
+table_cache_lock = threading.Lock()
+
+def get_cached_table(name):
+    """Возвращает закэшированную таблицу, пересобирая её не чаще раза в TABLE_CACHE_TTL секунд."""
+    with table_cache_lock:
+        entry = table_cache.get(name)
+        if entry is None or time.time() - entry["time"] > TABLE_CACHE_TTL:
+            collect, key = TABLES[name]
+            rows = collect()
+            entry = {"time": time.time(), "rows": rows, "keys": [r[key] for r in rows]}
+            table_cache[name] = entry
+        return entry
+
+# Поддерживаемые фильтры: поле -> допустимые операции
+TABLE_FILTERS = {
+    "processes": {"name": ("~=", "="), "user": ("=",), "status": ("=",), "cpu": (">", "<"), "rss": (">", "<")},
+    "services": {"name": ("~=", "="), "status": ("=",)},
+}
+LONG_POLL_PARAMS = ("wait", "since")
+PAGE_PARAMS = ("limit", "cursor") + LONG_POLL_PARAMS
+# Параметры строки запроса, которые не являются фильтрами строк
+NON_FILTER_PARAMS = PAGE_PARAMS + ("fields",)
+FILTER_RE = re.compile(r'^(\w+)(~=|=|>|<)(.*)$')
+
+def parse_row_filters(table, query_string):
+    """
+    Разбирает фильтры из строки запроса: name~=ssh (подстрока без учёта регистра),
+    user=root, status=running, cpu>5, rss>104857600.
+    Возвращает список предикатов; при ошибке - abort(400).
+    """
+    allowed = TABLE_FILTERS[table]
+    predicates = []
+    for part in query_string.split('&'):
+        part = unquote_plus(part)
+        if not part or part.split('=', 1)[0] in NON_FILTER_PARAMS:
+            continue
+        m = FILTER_RE.match(part)
+        if not m or m.group(1) not in allowed or m.group(2) not in allowed[m.group(1)]:
+            abort(400, description=f"Unsupported filter: {part}")
+        field, op, value = m.groups()
+        if op == "~=":
+            needle = value.lower()
+            predicates.append(lambda r, f=field, v=needle: v in str(r[f]).lower())
+        elif op == "=":
+            predicates.append(lambda r, f=field, v=value: str(r[f]) == v)
+        else:
+            try:
+                number = float(value)
+            except ValueError:
+                abort(400, description=f"Filter {field}{op} expects a number")
+            if op == ">":
+                predicates.append(lambda r, f=field, v=number: r[f] > v)
+            else:
+                predicates.append(lambda r, f=field, v=number: r[f] < v)
+    return predicates
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        abort(400, description="Invalid cursor")
+
+def paginate_table(table, limit=None, cursor=None, predicates=(), entry=None):
+    """
+    Курсорная (keyset) пагинация по закэшированной таблице (или по переданной entry).
+    Курсор хранит ключ последней отданной строки, поэтому обновление кэша
+    между страницами не приводит к дублям и пропускам.
+    Возвращает (rows, next_cursor).
+    """
+    if entry is None:
+        entry = get_cached_table(table)
+    rows, keys = entry["rows"], entry["keys"]
+    key = TABLES[table][1]
+    start = 0
+    if cursor:
+        position = decode_cursor(cursor)
+        # ключ другого типа (строка вместо pid и т.п.) bisect не сравнит - TypeError
+        if keys and type(position) is not type(keys[0]):
+            abort(400, description="Invalid cursor")
+        start = bisect.bisect_right(keys, position)
+    page = []
+    for i in range(start, len(rows)):
+        row = rows[i]
+        if all(p(row) for p in predicates):
+            if limit is not None and len(page) >= limit:
+                return page, encode_cursor(page[-1][key])
+            page.append(row)
+    return page, None
+
+def request_page_args(args=None):
+    """Читает limit/cursor из запроса (или из args); limit ограничен PAGE_MAX_LIMIT."""
+    args = request.args if args is None else args
+    limit = args.get('limit')
+    try:
+        limit = PAGE_DEFAULT_LIMIT if limit is None else int(limit)
+    except ValueError:
+        abort(400, description="limit must be an integer")
+    return max(1, min(limit, PAGE_MAX_LIMIT)), args.get('cursor')
+
+def format_process_row(row):
+    return {
+        "pid": row["pid"],
+        "name": row["name"],
+        "user": row["user"],
+        "status": row["status"],
+        "cpu_usage": f"{row['cpu']:.1f}%",
+        "memory_usage": convert_bytes(row["rss"]),
+    }
+
+TOP_KEYS = {"cpu": "cpu", "rss": "rss", "memory": "rss"}  # ?key= -> поле строки таблицы процессов
+TOP_MAX_K = 1000
+
+def top_processes(key, k):
+    """
+    Top-k процессов по key из кэша таблицы процессов (heapq.nlargest, O(n log k)).
+    Строки содержат и сырые числа (cpu, rss) - по ним агрегатор сливает ответы хостов.
+    """
+    field = TOP_KEYS[key]
+    table = get_cached_table("processes")
+    rows = heapq.nlargest(k, table["rows"], key=lambda r: r[field])
+    return {
+        "key": field,
+        "k": k,
+        "time": table["time"],
+        "processes": [{**format_process_row(r), "cpu": r["cpu"], "rss": r["rss"]} for r in rows],
+    }
+
 # ------------------------------------------------------------------------------------
 #                Дополнительные функции: информация о машине
 # ------------------------------------------------------------------------------------
@@ -504,7 +1170,15 @@ def get_user_login_info():
         }
     return result
 
-def get_machine_info():
+MACHINE_INFO_COLLECTORS = {
+    "hostname": platform.node,
+    "ip": get_ip,
+    "uptime": get_uptime,
+    "disks": get_disks,
+    "user_status": get_user_login_info,
+}
+
+def get_machine_info(spec=None):
     """
     Собирает информацию о машине:
       - hostname
@@ -512,15 +1186,535 @@ def get_machine_info():
       - аптайм
       - список примонтированных дисков
       - статус пользователей (залогинен/разлогинен и время последнего входа)
+    При заданной проекции spec собираются только запрошенные поля.
     """
     return {
-        "hostname": platform.node(),
-        "ip": get_ip(),
-        "uptime": get_uptime(),
-        "disks": get_disks(),
-        "user_status": get_user_login_info()
+        name: collector()
+        for name, collector in MACHINE_INFO_COLLECTORS.items()
+        if spec is None or name in spec
     }
 
+# ------------------------------------------------------------------------------------
+#                  Фоновый сэмплер метрик и поток обновлений (SSE)
+# ------------------------------------------------------------------------------------
+SAMPLE_INTERVAL = 1        # период сэмплирования, сек (collect_cpu сам занимает ~1 сек)
+STREAM_KEEPALIVE = 15      # комментарий-keepalive в SSE, если новых сэмплов нет
+
+# Последний снимок метрик. generation растёт с каждым сэмплом; payloads - кэш
+# сериализации текущего снимка по (fields, delta), общий для всех подписчиков.
+sampler_cond = threading.Condition()
+sampler_state = {"generation": 0, "time": 0, "snapshot": None, "previous": None, "raw": None, "payloads": {}}
+
+def collect_raw_sample():
+    """
+    Числовые значения, которых нет в отформатированном снимке: память, диски по точкам
+    монтирования, сетевые интерфейсы, а также строки таблиц сервисов и процессов -
+    экспозиция Prometheus строится только из сэмпла и не собирает ничего на scrape.
+    """
+    mounts = []
+    for p in psutil.disk_partitions():
+        try:
+            usage = psutil.disk_usage(p.mountpoint)
+        except Exception:
+            continue
+        mounts.append({"device": p.device, "mountpoint": p.mountpoint, "fstype": p.fstype,
+                       "total": usage.total, "used": usage.used, "free": usage.free, "percent": usage.percent})
+    return {
+        "memory": psutil.virtual_memory()._asdict(),
+        "mounts": mounts,
+        "nics": {nic: c._asdict() for nic, c in psutil.net_io_counters(pernic=True).items()},
+        "boot_time": psutil.boot_time(),
+        "services": get_cached_table("services")["rows"],
+        "processes": get_cached_table("processes")["rows"],
+    }
+
+def background_metrics_sampler():
+    while True:
+        started = time.time()
+        try:
+            snapshot = get_metrics()
+            raw = collect_raw_sample()
+        except Exception as e:
+            print("[ERROR] Сэмплер метрик:", e)
+            snapshot = None
+        if snapshot is not None:
+            with sampler_cond:
+                sampler_state["previous"] = sampler_state["snapshot"]
+                sampler_state["snapshot"] = snapshot
+                sampler_state["raw"] = raw
+                sampler_state["generation"] += 1
+                sampler_state["time"] = time.time()
+                sampler_state["payloads"] = {}
+                sampler_cond.notify_all()
+        time.sleep(max(0, SAMPLE_INTERVAL - (time.time() - started)))
+
+def get_sampled_metrics():
+    """(generation, snapshot) из сэмплера, если снимок свежий; иначе (0, None)."""
+    with sampler_cond:
+        if sampler_state["snapshot"] is not None and time.time() - sampler_state["time"] <= SAMPLE_INTERVAL * 3:
+            return sampler_state["generation"], sampler_state["snapshot"]
+    return 0, None
+
+def diff_snapshot(old, new):
+    """JSON Merge Patch (RFC 7396) от old к new: изменённые ключи, удалённые = null, списки целиком."""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    patch = {}
+    for key, value in new.items():
+        if key not in old:
+            patch[key] = value
+        elif old[key] != value:
+            patch[key] = diff_snapshot(old[key], value)
+    for key in old:
+        if key not in new:
+            patch[key] = None
+    return patch
+
+def sampler_payload(generation, fields_param, delta, fmt="json"):
+    """
+    Сериализованный снимок поколения generation (или дельта к generation-1).
+    Сериализация выполняется один раз на поколение, набор полей и формат.
+    Возвращает None, если поколение уже сменилось.
+    """
+    with sampler_cond:
+        if sampler_state["generation"] != generation:
+            return None
+        key = (fields_param, delta, fmt)
+        if key not in sampler_state["payloads"]:
+            spec = parse_fields(fields_param, METRIC_COLLECTORS) if fields_param else None
+            data = apply_projection(sampler_state["snapshot"], spec)
+            if delta:
+                data = diff_snapshot(apply_projection(sampler_state["previous"], spec), data)
+            sampler_state["payloads"][key] = encode_body(data, fmt)
+        return sampler_state["payloads"][key]
+
+def metrics_stream_events(fields_param, min_interval, use_delta):
+    """
+    Генератор сообщений для одного подписчика. min_interval ограничивает частоту
+    (промежуточные поколения пропускаются), при use_delta после первого полного
+    снимка отправляются дельты - если подписчик получил предыдущее поколение.
+    Выдаёт (event, generation, payload); event=None - keepalive.
+    """
+    last_gen = 0
+    while True:
+        with sampler_cond:
+            sampler_cond.wait_for(lambda: sampler_state["generation"] > last_gen, timeout=STREAM_KEEPALIVE)
+            gen = sampler_state["generation"]
+        if gen <= last_gen:
+            yield None, last_gen, None
+            continue
+        delta = use_delta and last_gen > 0 and last_gen == gen - 1
+        payload = sampler_payload(gen, fields_param, delta)
+        if payload is None:
+            continue  # поколение сменилось, пока мы ждали - берём новое
+        yield ("delta" if delta else "snapshot"), gen, payload
+        last_gen = gen
+        if min_interval > 0:
+            time.sleep(min_interval)
+
+# ------------------------------------------------------------------------------------
+#          Push-режим: пакеты снимков агрегатору (gzip, backoff, спул на диске)
+# ------------------------------------------------------------------------------------
+# Реплицируемый документ хоста: {"metrics": проекция PUSH_FIELDS, "services": [...]}.
+# Агрегатор подтверждает поколение (ack); следующий пакет начинается с дельты к
+# подтверждённому документу, внутри пакета дельты идут цепочкой. Если агрегатор
+# не знает базы (перезапуск, потерянный пакет) - он отвечает resync, и пакет
+# переотправляется с полным снимком в начале.
+PUSH_INTERVAL = 10             # как часто отправлять накопленные снимки, сек
+PUSH_FIELDS = "cpu,memory,disk,processes,last_update,system_info"  # проекция снимка
+PUSH_BATCH_MAX = 60            # снимков в одном пакете; при недоступном агрегаторе пакет уходит в спул
+PUSH_TIMEOUT = (3, 10)         # (connect, read) для POST, сек
+PUSH_BACKOFF_MAX = 300         # верхняя граница паузы между неудачными попытками, сек
+PUSH_SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "push_spool")
+PUSH_SPOOL_MAX_FILES = 500     # самые старые пакеты удаляются сверх лимита
+REPLICA_LIST_KEYS = {"processes": "pid", "services": "name"}  # списки, передаваемые построчно
+
+def push_identity():
+    return {"name": platform.node(), "ip": get_ip(), "port": AGENT_PORT, "version": VERISONAPP,
+            "instance": f"{os.getpid()}-{int(time.time())}"}
+
+def diff_replica(old, new, field=None):
+    """
+    Дельта old -> new. Словари - как JSON Merge Patch (удалённые ключи = null).
+    Списки из REPLICA_LIST_KEYS - {"$rows": {"key", "upsert", "remove"}}: только
+    изменённые/новые строки и ключи удалённых; если порядок строк после применения
+    не совпал бы с new, список передаётся целиком. Прочее - новое значение целиком.
+    """
+    key = REPLICA_LIST_KEYS.get(field)
+    if key and isinstance(old, list) and isinstance(new, list):
+        old_rows = {row.get(key): row for row in old}
+        new_keys = [row.get(key) for row in new]
+        new_set = set(new_keys)
+        expected = [k for k in old_rows if k in new_set] + [k for k in new_keys if k not in old_rows]
+        if expected != new_keys or len(new_set) != len(new_keys):
+            return new
+        return {"$rows": {
+            "key": key,
+            "upsert": [row for row in new if old_rows.get(row.get(key)) != row],
+            "remove": [k for k in old_rows if k not in new_set],
+        }}
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = {}
+        for k, value in new.items():
+            if k not in old:
+                patch[k] = value
+            elif old[k] != value:
+                patch[k] = diff_replica(old[k], value, k)
+        for k in old:
+            if k not in new:
+                patch[k] = None
+        return patch
+    return new
+
+def encode_push_batch(identity, batch, base=None):
+    """
+    batch - [(generation, time, документ)]. base - подтверждённое (generation, документ)
+    или None: тогда первый снимок идёт целиком, остальные - дельтами по цепочке.
+    """
+    snapshots = []
+    for generation, sampled_at, doc in batch:
+        if base is None:
+            snapshots.append({"generation": generation, "time": sampled_at, **doc})
+        else:
+            snapshots.append({"generation": generation, "time": sampled_at, "base": base[0],
+                              "delta": diff_replica(base[1], doc)})
+        base = (generation, doc)
+    body = json.dumps({"agent": identity, "snapshots": snapshots}, ensure_ascii=False).encode("utf-8")
+    return gzip.compress(body, compresslevel=6)
+
+# Ответы 4xx, после которых повтор того же пакета имеет смысл
+PUSH_RETRYABLE_STATUSES = {408, 425, 429}
+
+def post_push_body(body):
+    """
+    Отправляет сжатый пакет. Ответ агрегатора (dict) при 2xx; {"rejected": код} - если
+    агрегатор окончательно отверг пакет (4xx), повторять его бесполезно; None - агрегатор
+    недоступен или ответил 5xx, пакет стоит повторить позже.
+    """
+    try:
+        resp = requests.post(PUSH_URL, data=body, timeout=PUSH_TIMEOUT,
+                             headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        if 200 <= resp.status_code < 300:
+            return resp.json()
+        print("[WARNING] Push: агрегатор ответил", resp.status_code)
+        if 400 <= resp.status_code < 500 and resp.status_code not in PUSH_RETRYABLE_STATUSES:
+            return {"rejected": resp.status_code}
+    except Exception as e:
+        print("[WARNING] Push: агрегатор недоступен:", e)
+    return None
+
+def spool_push_body(body):
+    """Сохраняет пакет в спул; при переполнении удаляет самые старые."""
+    os.makedirs(PUSH_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(PUSH_SPOOL_DIR, f"push_{time.time_ns()}.json.gz")
+    with open(path + ".tmp", "wb") as f:
+        f.write(body)
+    os.replace(path + ".tmp", path)
+    spooled = sorted(f for f in os.listdir(PUSH_SPOOL_DIR) if f.endswith(".json.gz"))
+    for name in spooled[:max(0, len(spooled) - PUSH_SPOOL_MAX_FILES)]:
+        os.remove(os.path.join(PUSH_SPOOL_DIR, name))
+
+def drain_push_spool():
+    """
+    Досылает пакеты из спула (от старых к новым). Пакеты в спуле самодостаточны
+    (начинаются с полного снимка). Отвергнутый агрегатором пакет удаляется, чтобы не
+    блокировать остальные. False - агрегатор снова недоступен.
+    """
+    if not os.path.isdir(PUSH_SPOOL_DIR):
+        return True
+    for name in sorted(f for f in os.listdir(PUSH_SPOOL_DIR) if f.endswith(".json.gz")):
+        path = os.path.join(PUSH_SPOOL_DIR, name)
+        with open(path, "rb") as f:
+            body = f.read()
+        reply = post_push_body(body)
+        if reply is None:
+            return False
+        if reply.get("rejected"):
+            print(f"[WARNING] Push: агрегатор отверг пакет из спула ({reply['rejected']}), удаляем", name)
+        os.remove(path)
+    return True
+
+def send_push_batch(identity, batch, acked):
+    """
+    Отправляет пакет дельтами к acked. Возвращает (успех, новое подтверждённое
+    (generation, документ) или None). На resync пакет сразу уходит с полным снимком.
+    Отвергнутый агрегатором (4xx) пакет отбрасывается: успех, но без подтверждения.
+    """
+    reply = post_push_body(encode_push_batch(identity, batch, acked))
+    if reply is not None and reply.get("resync") and acked is not None:
+        reply = post_push_body(encode_push_batch(identity, batch))
+    if reply is None:
+        return False, None
+    if reply.get("rejected"):
+        print(f"[WARNING] Push: агрегатор отверг пакет ({reply['rejected']}), пакет отброшен")
+        return True, None
+    last_generation, _, last_doc = batch[-1]
+    if reply.get("ack") == last_generation and not reply.get("resync"):
+        return True, (last_generation, last_doc)
+    return True, None
+
+def background_push_sender():
+    """
+    Копит документ каждого поколения сэмплера и раз в PUSH_INTERVAL отправляет пакет
+    на PUSH_URL (дельтами к подтверждённому поколению). При ошибке пакет целиком
+    ложится в спул, а следующая попытка откладывается с экспоненциальной паузой
+    (с джиттером) до PUSH_BACKOFF_MAX.
+    """
+    spec = parse_fields(PUSH_FIELDS, METRIC_COLLECTORS)
+    identity = push_identity()
+    batch, last_gen, acked = [], 0, None
+    backoff, next_attempt = 0, time.time() + PUSH_INTERVAL
+    while True:
+        with sampler_cond:
+            sampler_cond.wait_for(lambda: sampler_state["generation"] > last_gen, timeout=PUSH_INTERVAL)
+            if sampler_state["generation"] > last_gen:
+                last_gen = sampler_state["generation"]
+                doc = {"metrics": apply_projection(sampler_state["snapshot"], spec)}
+                if services_state["entry"] is not None:
+                    doc["services"] = services_state["entry"]["rows"]
+                batch.append((last_gen, sampler_state["time"], doc))
+        if time.time() < next_attempt:
+            if len(batch) >= PUSH_BATCH_MAX:
+                spool_push_body(encode_push_batch(identity, batch))
+                batch = []
+            continue
+
+        ok = drain_push_spool()
+        if ok and batch:
+            ok, acked = send_push_batch(identity, batch, acked)
+        if not ok and batch:
+            spool_push_body(encode_push_batch(identity, batch))
+        batch = []
+        if ok:
+            backoff = 0
+            next_attempt = time.time() + PUSH_INTERVAL
+            continue
+        acked = None  # после спула агрегатор увидит другие поколения - начинаем с полного снимка
+        backoff = min(PUSH_BACKOFF_MAX, max(PUSH_INTERVAL, backoff * 2))
+        next_attempt = time.time() + backoff * random.uniform(0.5, 1.0)
+        print(f"[WARNING] Push: следующая попытка через {next_attempt - time.time():.0f} сек")
+
+# ------------------------------------------------------------------------------------
+#        Обнаружение: UDP-анонсы агента (multicast / broadcast / сиды)
+# ------------------------------------------------------------------------------------
+DISCOVERY_GROUP = "239.255.42.99"
+DISCOVERY_PORT = int(os.environ.get("AGENT_DISCOVERY_PORT", 50000))
+DISCOVERY_INTERFACE = os.environ.get("AGENT_DISCOVERY_INTERFACE", "0.0.0.0")  # интерфейс для multicast
+DISCOVERY_INTERVAL = 5         # период анонсов, сек
+DISCOVERY_MEMBER_TTL = 15      # сколько агрегатор держит запись без новых анонсов, сек
+ADVERTISE_IP = os.environ.get("AGENT_ADVERTISE_IP")  # по умолчанию - get_ip()
+
+def agent_capabilities():
+    capabilities = ["metrics", "processes", "services", "machine_info", "prometheus", "batch", "stream"]
+    if sock:
+        capabilities.append("ws")
+    if msgpack:
+        capabilities.append("msgpack")
+    if PUSH_URL:
+        capabilities.append("push")
+    return capabilities
+
+def discovery_announcement(instance):
+    return {
+        "type": "agent-announce",
+        "name": platform.node(),
+        "ip": ADVERTISE_IP or get_ip(),
+        "port": AGENT_PORT,
+        "version": VERISONAPP,
+        "capabilities": agent_capabilities(),
+        "instance": instance,
+        "ttl": DISCOVERY_MEMBER_TTL,
+    }
+
+def discovery_targets():
+    """Адреса для анонса: группа multicast или broadcast (по DISCOVERY_MODE) плюс сиды."""
+    targets = []
+    if DISCOVERY_MODE == "multicast":
+        targets.append((DISCOVERY_GROUP, DISCOVERY_PORT))
+    elif DISCOVERY_MODE == "broadcast":
+        targets.append(("<broadcast>", DISCOVERY_PORT))
+    for seed in DISCOVERY_SEEDS:
+        host, _, port = seed.rpartition(":")
+        targets.append((host, int(port)) if host else (seed, DISCOVERY_PORT))
+    return targets
+
+def background_discovery_announcer():
+    instance = f"{os.getpid()}-{int(time.time())}"
+    targets = discovery_targets()
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if DISCOVERY_MODE == "multicast":
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(DISCOVERY_INTERFACE))
+    elif DISCOVERY_MODE == "broadcast":
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    print(f"[INFO] Анонсы обнаружения: {targets}")
+    while True:
+        message = json.dumps(discovery_announcement(instance)).encode("utf-8")
+        for target in targets:
+            try:
+                s.sendto(message, target)
+            except OSError as e:
+                print(f"[WARNING] Анонс на {target} не отправлен:", e)
+        time.sleep(DISCOVERY_INTERVAL)
+
+# ------------------------------------------------------------------------------------
+#             Экспозиция Prometheus/OpenMetrics из снимка сэмплера
+# ------------------------------------------------------------------------------------
+PROMETHEUS_TOP_PROCESSES = 10  # сколько процессов отдавать в top-N gauges
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+def prometheus_escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_families(snapshot, raw, generation):
+    """Список семейств метрик сэмпла поколения generation: (имя, тип, описание, [(метки, значение), ...])."""
+    def percent(text):
+        try:
+            return float(str(text).rstrip('%'))
+        except ValueError:
+            return float('nan')
+
+    mem = raw["memory"]
+    families = [
+        ("agent_info", "gauge", "Agent version and host", [
+            ({"version": VERISONAPP, "hostname": platform.node(), "os": platform.system()}, 1)]),
+        ("agent_sample_generation", "gauge", "Sampler snapshot generation", [({}, generation)]),
+        ("agent_uptime_seconds", "gauge", "Seconds since host boot", [({}, time.time() - raw["boot_time"])]),
+        ("agent_cpu_usage_percent", "gauge", "CPU usage", [({}, percent(snapshot["cpu"]["usage"]))]),
+        ("agent_memory_total_bytes", "gauge", "Total memory", [({}, mem["total"])]),
+        ("agent_memory_used_bytes", "gauge", "Used memory", [({}, mem["used"])]),
+        ("agent_memory_available_bytes", "gauge", "Available memory", [({}, mem["available"])]),
+        ("agent_memory_usage_percent", "gauge", "Memory usage", [({}, mem["percent"])]),
+    ]
+    for name, field, help_text in (("agent_disk_total_bytes", "total", "Filesystem size"),
+                                   ("agent_disk_used_bytes", "used", "Filesystem used bytes"),
+                                   ("agent_disk_free_bytes", "free", "Filesystem free bytes"),
+                                   ("agent_disk_usage_percent", "percent", "Filesystem usage")):
+        families.append((name, "gauge", help_text, [
+            ({"mountpoint": m["mountpoint"], "device": m["device"], "fstype": m["fstype"]}, m[field])
+            for m in raw["mounts"]]))
+    for name, field, help_text in (("agent_network_receive_bytes", "bytes_recv", "Bytes received"),
+                                   ("agent_network_transmit_bytes", "bytes_sent", "Bytes sent"),
+                                   ("agent_network_receive_packets", "packets_recv", "Packets received"),
+                                   ("agent_network_transmit_packets", "packets_sent", "Packets sent")):
+        families.append((name, "counter", help_text, [
+            ({"nic": nic}, counters[field]) for nic, counters in sorted(raw["nics"].items())]))
+
+    services = raw["services"]
+    families.append(("agent_service_up", "gauge", "1 if the service is active/running", [
+        ({"service": svc["name"], "status": svc["status"]}, 1 if svc["status"] in ("active", "running") else 0)
+        for svc in services]))
+
+    procs = raw["processes"]
+    for name, field, help_text in (("agent_top_process_cpu_percent", "cpu", "Top processes by CPU"),
+                                   ("agent_top_process_resident_memory_bytes", "rss", "Top processes by RSS")):
+        top = heapq.nlargest(PROMETHEUS_TOP_PROCESSES, procs, key=lambda r: r[field])
+        families.append((name, "gauge", help_text, [
+            ({"pid": r["pid"], "name": r["name"], "user": r["user"]}, r[field]) for r in top]))
+    return families
+
+def render_prometheus(snapshot, raw, generation, openmetrics=False):
+    lines = []
+    for name, mtype, help_text, samples in prometheus_families(snapshot, raw, generation):
+        sample_name = name + "_total" if mtype == "counter" else name
+        family_name = name if openmetrics else sample_name
+        lines.append(f"# HELP {family_name} {help_text}")
+        lines.append(f"# TYPE {family_name} {mtype}")
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{prometheus_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{sample_name}{{{label_text}}} {value}" if label_text else f"{sample_name} {value}")
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+prometheus_lock = threading.Lock()  # параллельные scrape ждут одного рендера
+
+def prometheus_payload(openmetrics):
+    """Текст экспозиции; рендерится один раз на поколение сэмплера и формат."""
+    key = ("prometheus", openmetrics)
+    with prometheus_lock:
+        with sampler_cond:
+            generation, snapshot, raw = sampler_state["generation"], sampler_state["snapshot"], sampler_state["raw"]
+            cached = sampler_state["payloads"].get(key)
+        if cached is not None:
+            return cached
+        if snapshot is None or raw is None:
+            # сэмплер не запущен - собираем на месте
+            return render_prometheus(get_metrics({"cpu": None}), collect_raw_sample(), generation, openmetrics)
+        text = render_prometheus(snapshot, raw, generation, openmetrics)
+        with sampler_cond:
+            if sampler_state["generation"] == generation:
+                sampler_state["payloads"][key] = text
+        return text
+
+# ------------------------------------------------------------------------------------
+#                 Long-poll: ожидание нового снимка / изменения сервисов
+# ------------------------------------------------------------------------------------
+LONG_POLL_MAX_WAIT = 60        # верхняя граница ?wait=, сек
+SERVICES_WATCH_INTERVAL = 5    # как часто проверять список сервисов на изменения
+
+# Поколение списка сервисов растёт только при его изменении (уведомления - через sampler_cond).
+# entry - запись кэша таблицы services, которой соответствует generation.
+services_state = {"generation": 0, "entry": None}
+
+def services_snapshot():
+    """
+    (поколение, запись кэша таблицы services) из одного снимка: строки и X-Generation
+    всегда согласованы. Если таблица изменилась, поколение растёт здесь же.
+    """
+    entry = get_cached_table("services")
+    with sampler_cond:
+        current = services_state["entry"]
+        if current is None or entry["time"] > current["time"]:
+            if current is None or entry["rows"] != current["rows"]:
+                services_state["generation"] += 1
+                sampler_cond.notify_all()
+            services_state["entry"] = entry
+        return services_state["generation"], services_state["entry"]
+
+def background_services_watcher():
+    while True:
+        try:
+            services_snapshot()
+        except Exception as e:
+            print("[ERROR] Наблюдение за сервисами:", e)
+        time.sleep(SERVICES_WATCH_INTERVAL)
+
+def wait_for_generation(state, since, timeout):
+    """
+    Блокируется, пока state["generation"] не станет больше since (None - больше текущего),
+    но не дольше timeout. Возвращает (изменилось ли, текущее поколение).
+    since из будущего (клиент помнит поколение до перезапуска агента) - сразу
+    (True, текущее), чтобы клиент получил текущее состояние и пересинхронизировался.
+    """
+    with sampler_cond:
+        if since is None:
+            since = state["generation"]
+        elif since > state["generation"]:
+            return True, state["generation"]
+        changed = sampler_cond.wait_for(lambda: state["generation"] > since, timeout=timeout)
+        return changed, state["generation"]
+
+def request_long_poll_args():
+    """(wait, since) из ?wait=&since=; wait=None - запрос без ожидания."""
+    try:
+        wait = request.args.get('wait')
+        wait = None if wait is None else max(0.0, min(float(wait), LONG_POLL_MAX_WAIT))
+        since = request.args.get('since')
+        since = None if since is None else int(since)
+    except ValueError:
+        abort(400, description="wait and since must be numbers")
+    return wait, since
+
+def request_stream_args():
+    """fields, min_interval (сек), delta из параметров запроса потока."""
+    try:
+        min_interval = max(0.0, float(request.args.get('interval', 0)))
+    except ValueError:
+        abort(400, description="interval must be a number")
+    return request.args.get('fields') or None, min_interval, request.args.get('delta') in ('1', 'true')
+
 # ------------------------------------------------------------------------------------
 #                          Фоновый сбор информации о статусе пользователей
 # ------------------------------------------------------------------------------------
@@ -537,7 +1731,7 @@ def background_update_checker():
         info = check_for_updates()
         if info.get("update_available"):
             print("[INFO] Фоновая проверка: есть обновление, пробуем обновиться.")
-            res = do_update_if_available()
+            res = apply_update(info)
             if res.get("success"):
                 print("[INFO] Успешно обновились, завершаем старый агент.")
                 break
@@ -559,63 +1753,154 @@ def update_endpoint():
 
 @app.route('/users', methods=['GET'])
 def list_users():
-    return jsonify({"users": users})
+    return jsonify({"users": user_registry["users"]})
+
+CONNECT_ROOTS = ("user", "metrics", "directories", "machine_info")
 
 @app.route('/connect/<username>', methods=['GET'])
 def connect_to_user(username):
-    user = next((u for u in users if u['name'] == username), None)
+    user = find_user(username)
     if not user:
         abort(404, description="User not found")
-    return jsonify({
-        "user": user,
-        "metrics": get_metrics(),
-        "directories": get_user_directories(),
-        "machine_info": get_machine_info()  # добавленная информация о машине
-    })
+    spec = request_fields_spec(CONNECT_ROOTS)
+    return jsonify(build_connect_response(user, spec))
+
+def build_connect_response(user, spec, metrics_source=get_metrics,
+                           directories_source=get_user_directories, machine_info_source=get_machine_info):
+    """Ответ /connect/<username>: собираются только части, попавшие в проекцию spec."""
+    builders = {
+        "user": lambda sub: user,
+        "metrics": metrics_source,
+        "directories": lambda sub: directories_source(),
+        "machine_info": machine_info_source,  # добавленная информация о машине
+    }
+    result = {
+        name: build(spec.get(name) if spec else None)
+        for name, build in builders.items()
+        if spec is None or name in spec
+    }
+    return apply_projection(result, spec)
 
 @app.route('/connect/<username>/<metric_name>', methods=['GET'])
 def connect_to_user_metric(username, metric_name):
-    user = next((u for u in users if u['name'] == username), None)
+    user = find_user(username)
     if not user:
         abort(404, description="User not found")
-    mdata = get_metrics()
-    if metric_name in mdata:
-        return jsonify({metric_name: mdata[metric_name]})
-    else:
+    if metric_name not in METRIC_COLLECTORS:
         abort(404, description="Metric not found")
+    mdata = get_metrics({metric_name: None})
+    return jsonify({metric_name: mdata[metric_name]})
 
 @app.route('/connect/<username>/directories', methods=['GET'])
 def connect_to_user_directories(username):
-    user = next((u for u in users if u['name'] == username), None)
+    user = find_user(username)
     if not user:
         abort(404, description="User not found")
     return jsonify({"directories": get_user_directories()})
 
 @app.route('/metrics', methods=['GET'])
 def metrics():
-    return jsonify(get_metrics())
+    spec = request_fields_spec(METRIC_COLLECTORS)
+    fmt = negotiate_format()
+    wait, since = request_long_poll_args()
+    if wait is not None:
+        changed, _ = wait_for_generation(sampler_state, since, wait)
+        if not changed:
+            return Response(status=204, headers={"X-Generation": str(sampler_state["generation"])})
+    generation, snapshot = get_sampled_metrics()
+    if snapshot is None:
+        return encoded_response(apply_projection(get_metrics(spec), spec), fmt)
+    payload = sampler_payload(generation, request.args.get('fields') or None, False, fmt)
+    if payload is None:
+        response = encoded_response(apply_projection(snapshot, spec), fmt)
+    else:
+        response = Response(payload, mimetype=WIRE_MIMETYPES[fmt], headers={"Vary": "Accept"})
+    response.headers["X-Generation"] = str(generation)
+    return response
+
+@app.route('/metrics/prometheus', methods=['GET'])
+def metrics_prometheus():
+    """Метрики в формате Prometheus (или OpenMetrics по Accept) из кэшированного снимка."""
+    openmetrics = "application/openmetrics-text" in request.headers.get("Accept", "")
+    return Response(prometheus_payload(openmetrics),
+                    content_type=OPENMETRICS_CONTENT_TYPE if openmetrics else PROMETHEUS_CONTENT_TYPE)
+
+@app.route('/metrics/stream', methods=['GET'])
+def metrics_stream():
+    """SSE-поток снимков метрик из фонового сэмплера."""
+    fields_param, min_interval, use_delta = request_stream_args()
+
+    def events():
+        for event, gen, payload in metrics_stream_events(fields_param, min_interval, use_delta):
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"id: {gen}\nevent: {event}\ndata: {payload}\n\n"
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+if sock:
+    @sock.route('/metrics/ws')
+    def metrics_ws(ws):
+        """WebSocket-вариант /metrics/stream: сообщения {"event", "generation", "data"}."""
+        fields_param, min_interval, use_delta = request_stream_args()
+        for event, gen, payload in metrics_stream_events(fields_param, min_interval, use_delta):
+            if event is not None:
+                ws.send(f'{{"event": "{event}", "generation": {gen}, "data": {payload}}}')
 
 @app.route('/metrics/list', methods=['GET'])
 def metrics_list():
     """Возвращает список всех доступных метрик."""
-    mdata = get_metrics()
-    return jsonify({"available_metrics": list(mdata.keys())})
+    return jsonify({"available_metrics": list(METRIC_COLLECTORS)})
 
 @app.route('/connect/<username>/metrics/list', methods=['GET'])
 def connect_to_user_metrics_list(username):
-    user = next((u for u in users if u['name'] == username), None)
+    user = find_user(username)
     if not user:
         abort(404, description="User not found")
-    mdata = get_metrics()
-    return jsonify({"available_metrics": list(mdata.keys())})
+    return jsonify({"available_metrics": list(METRIC_COLLECTORS)})
+
+@app.route('/processes', methods=['GET'])
+def list_processes():
+    """Постраничный список процессов с фильтрами (из кэша таблицы процессов)."""
+    limit, cursor = request_page_args()
+    predicates = parse_row_filters("processes", request.query_string.decode('utf-8'))
+    rows, next_cursor = paginate_table("processes", limit, cursor, predicates)
+    body = {"processes": [format_process_row(r) for r in rows], "next_cursor": next_cursor}
+    return encoded_response(apply_projection(body, request_fields_spec(())), negotiate_format())
+
+@app.route('/processes/top', methods=['GET'])
+def processes_top():
+    """Top-k процессов по cpu или rss (memory): ?key=cpu&k=20."""
+    key = request.args.get('key', 'cpu')
+    if key not in TOP_KEYS:
+        abort(400, description=f"key must be one of {', '.join(TOP_KEYS)}")
+    k = max(1, min(request.args.get('k', 20, type=int), TOP_MAX_K))
+    return encoded_response(top_processes(key, k), negotiate_format())
 
 @app.route('/services', methods=['GET'])
 def list_services():
-    return jsonify({"services": get_services()})
+    wait, since = request_long_poll_args()
+    if wait is not None:
+        changed, generation = wait_for_generation(services_state, since, wait)
+        if not changed:
+            return Response(status=204, headers={"X-Generation": str(generation)})
+    generation, entry = services_snapshot()
+    headers = {"X-Generation": str(generation)}
+    fmt = negotiate_format()
+    spec = request_fields_spec(())
+    if not any(k not in LONG_POLL_PARAMS + ("fields",) for k in request.args):
+        return encoded_response(apply_projection({"services": entry["rows"]}, spec), fmt, headers=headers)
+    limit, cursor = request_page_args()
+    predicates = parse_row_filters("services", request.query_string.decode('utf-8'))
+    rows, next_cursor = paginate_table("services", limit, cursor, predicates, entry=entry)
+    return encoded_response(apply_projection({"services": rows, "next_cursor": next_cursor}, spec),
+                            fmt, headers=headers)
 
 @app.route('/connect/<username>/services', methods=['GET'])
 def connect_to_user_services(username):
-    user = next((u for u in users if u['name'] == username), None)
+    user = find_user(username)
     if not user:
         abort(404, description="User not found")
     return jsonify({"user": user, "services": get_services()})
@@ -625,11 +1910,181 @@ def machine_info():
     """Возвращает подробную информацию о машине."""
     return jsonify(get_machine_info())
 
+# ------------------------------------------------------------------------------------
+#                  Пакетные запросы: POST /batch по одному снимку
+# ------------------------------------------------------------------------------------
+BATCH_MAX_QUERIES = 50
+
+def make_batch_snapshot():
+    """
+    Снимок для пакета запросов: каждая часть (метрики, таблицы, директории, информация
+    о машине) берётся один раз при первом обращении и дальше переиспользуется.
+    Метрики - текущее поколение сэмплера, если он работает.
+    """
+    generation, metrics_snapshot = get_sampled_metrics()
+    loaders = {
+        "metrics": lambda: metrics_snapshot if metrics_snapshot is not None else get_metrics(),
+        "processes": lambda: get_cached_table("processes"),
+        "services": lambda: get_cached_table("services"),
+        "directories": get_user_directories,
+        "machine_info": get_machine_info,
+    }
+    parts = {}
+
+    def part(name):
+        if name not in parts:
+            parts[name] = loaders[name]()
+        return parts[name]
+    return generation, part
+
+def batch_find_user(username):
+    user = find_user(username)
+    if not user:
+        abort(404, description="User not found")
+    return user
+
+def batch_metric(part, args, username, metric_name):
+    batch_find_user(username)
+    mdata = part("metrics")
+    if metric_name not in mdata:
+        abort(404, description="Metric not found")
+    return {metric_name: mdata[metric_name]}
+
+def batch_table_page(part, args, table):
+    limit, cursor = request_page_args(args)
+    predicates = parse_row_filters(table, args["_query_string"])
+    rows, next_cursor = paginate_table(table, limit, cursor, predicates, entry=part(table))
+    if table == "processes":
+        rows = [format_process_row(r) for r in rows]
+    return {table: rows, "next_cursor": next_cursor}
+
+def batch_services(part, args):
+    if not any(k not in LONG_POLL_PARAMS + ("fields", "_query_string") for k in args):
+        return {"services": part("services")["rows"]}
+    return batch_table_page(part, args, "services")
+
+# Имя view-функции Flask -> обработчик (part, args, **view_args) для /batch
+BATCH_HANDLERS = {
+    "version_get": lambda part, args: {"Version": VERISONAPP},
+    "list_users": lambda part, args: {"users": user_registry["users"]},
+    "metrics": lambda part, args: part("metrics"),
+    "metrics_list": lambda part, args: {"available_metrics": list(METRIC_COLLECTORS)},
+    "list_processes": lambda part, args: batch_table_page(part, args, "processes"),
+    "list_services": batch_services,
+    "machine_info": lambda part, args: part("machine_info"),
+    "connect_to_user": lambda part, args, username: build_connect_response(
+        batch_find_user(username), None,
+        metrics_source=lambda sub: part("metrics"),
+        directories_source=lambda: part("directories"),
+        machine_info_source=lambda sub: part("machine_info")),
+    "connect_to_user_metric": batch_metric,
+    "connect_to_user_directories": lambda part, args, username: (
+        batch_find_user(username) and {"directories": part("directories")}),
+    "connect_to_user_services": lambda part, args, username: {
+        "user": batch_find_user(username), "services": part("services")["rows"]},
+    "connect_to_user_metrics_list": lambda part, args, username: (
+        batch_find_user(username) and {"available_metrics": list(METRIC_COLLECTORS)}),
+}
+
+# Проекция для ответа: корни верхнего уровня по обработчику
+BATCH_FIELD_ROOTS = {"metrics": METRIC_COLLECTORS, "connect_to_user": CONNECT_ROOTS}
+
+def run_batch_query(query, part, adapter):
+    """
+    Выполняет один запрос пакета; возвращает {"path", "status", "body"|"error"}.
+    Ошибка одного запроса (в т.ч. непредвиденная - 500) не мешает остальным.
+    """
+    if isinstance(query, dict):
+        path, fields_param = query.get("path"), query.get("fields")
+    else:
+        path, fields_param = query, None
+    if not isinstance(path, str) or not path.startswith('/'):
+        return {"path": path, "status": 400, "error": "path must be a string starting with /"}
+    if fields_param is not None and not isinstance(fields_param, str):
+        return {"path": path, "status": 400, "error": "fields must be a string"}
+    path_only, _, query_string = path.partition('?')
+    args = {k: v[-1] for k, v in parse_qs(query_string, keep_blank_values=True).items()}
+    if fields_param:
+        args["fields"] = fields_param
+    args["_query_string"] = "&".join(
+        p for p in query_string.split('&') if p and not p.startswith("fields=")
+    )
+    try:
+        endpoint, view_args = adapter.match(path_only, method="GET")
+        handler = BATCH_HANDLERS.get(endpoint)
+        if handler is None:
+            abort(400, description=f"{path_only} is not supported in /batch")
+        body = handler(part, args, **view_args)
+        if args.get("fields"):
+            body = apply_projection(body, parse_fields(args["fields"], BATCH_FIELD_ROOTS.get(endpoint, ())))
+        return {"path": path, "status": 200, "body": body}
+    except HTTPException as e:
+        return {"path": path, "status": e.code, "error": e.description}
+    except Exception as e:
+        print(f"[ERROR] /batch {path}:", e)
+        return {"path": path, "status": 500, "error": str(e) or type(e).__name__}
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Выполняет несколько GET-запросов по одному снимку.
+    Тело: {"queries": ["/metrics?fields=cpu.usage", {"path": "/services", "fields": "services[].name"}]}
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        abort(400, description="Body must be a JSON object: {\"queries\": [...]}")
+    queries = payload.get("queries")
+    if not isinstance(queries, list) or not queries:
+        abort(400, description="queries must be a non-empty list")
+    if len(queries) > BATCH_MAX_QUERIES:
+        abort(400, description=f"At most {BATCH_MAX_QUERIES} queries per batch")
+    generation, part = make_batch_snapshot()
+    adapter = app.url_map.bind('localhost')
+    return jsonify({
+        "generation": generation,
+        "results": [run_batch_query(q, part, adapter) for q in queries],
+    })
+
+# ------------------------------------------------------------------------------------
+#                     Локальный доступ через Unix-сокет
+# ------------------------------------------------------------------------------------
+def serve_unix_socket(path):
+    """
+    Обслуживает те же маршруты Flask на Unix-сокете path (в отдельном потоке).
+    Сокет создаётся сразу с правами UNIX_SOCKET_MODE (через umask на время bind):
+    между bind и chmod к нему не может подключиться посторонний пользователь.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o750, exist_ok=True)
+    old_umask = os.umask(0o777 & ~UNIX_SOCKET_MODE)
+    try:
+        server = make_server(f"unix://{path}", 0, app, threaded=True)
+    finally:
+        os.umask(old_umask)
+    os.chmod(path, UNIX_SOCKET_MODE)
+    print(f"[INFO] Unix-сокет: {path} (права {oct(UNIX_SOCKET_MODE)})")
+    server.serve_forever()
+
 # ------------------------------------------------------------------------------------
 #                                Запуск
 # ------------------------------------------------------------------------------------
 if __name__ == '__main__':
     print(f"[INFO] Запущена версия агента {VERISONAPP}, PID={os.getpid()}")
+    # Недокачанные файлы обновлений от прошлого запуска
+    cleanup_staged_updates()
+    # Хэш собственного файла считается один раз - проверки обновлений хэшируют только скачанное
+    try:
+        running_code_hash(update_file_type() == "py")
+    except OSError as e:
+        print("[WARNING] Не удалось вычислить хэш агента:", e)
     threading.Thread(target=background_update_checker, daemon=True).start()
     threading.Thread(target=background_user_status_updater, daemon=True).start()
-    app.run(host='0.0.0.0', port=5000, use_reloader=False)
+    threading.Thread(target=background_metrics_sampler, daemon=True).start()
+    threading.Thread(target=background_registry_watcher, daemon=True).start()
+    threading.Thread(target=background_services_watcher, daemon=True).start()
+    if PUSH_URL:
+        threading.Thread(target=background_push_sender, daemon=True).start()
+    if UNIX_SOCKET_PATH and hasattr(socket, "AF_UNIX"):
+        threading.Thread(target=serve_unix_socket, args=(UNIX_SOCKET_PATH,), daemon=True).start()
+    if DISCOVERY_MODE or DISCOVERY_SEEDS:
+        threading.Thread(target=background_discovery_announcer, daemon=True).start()
+    app.run(host='0.0.0.0', port=AGENT_PORT, use_reloader=False)
@@ -0,0 +1,74 @@
+"""
+Мини-клиент для локального доступа к агенту через Unix-сокет (только стандартная библиотека).
+
+Использование из скриптов:
+    from agent_uds_client import uds_get
+    cpu = uds_get("/metrics?fields=cpu.usage")["cpu"]["usage"]
+
+Из командной строки (для cron / health-скриптов):
+    python agent_uds_client.py /metrics?fields=memory.percent
+    python agent_uds_client.py --socket /run/agent/agent.sock /services
+
+Путь к сокету по умолчанию берётся из AGENT_UNIX_SOCKET, как и у агента.
+"""
+
+import os
+import sys
+import json
+import socket
+import http.client
+
+DEFAULT_SOCKET_PATH = os.environ.get("AGENT_UNIX_SOCKET", "/run/agent/agent.sock")
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection, которое подключается к Unix-сокету вместо host:port."""
+
+    def __init__(self, socket_path, timeout=5):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+def uds_request(method, path, body=None, socket_path=None, timeout=5):
+    """Выполняет запрос к агенту; возвращает (статус, разобранный JSON или текст)."""
+    conn = UnixHTTPConnection(socket_path or DEFAULT_SOCKET_PATH, timeout=timeout)
+    try:
+        headers = {"Accept": "application/json"}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        if resp.getheader("Content-Type", "").startswith("application/json"):
+            return resp.status, json.loads(data) if data else None
+        return resp.status, data.decode("utf-8", errors="replace")
+    finally:
+        conn.close()
+
+def uds_get(path, socket_path=None, timeout=5):
+    """GET path через Unix-сокет; при статусе не 200 - RuntimeError."""
+    status, data = uds_request("GET", path, socket_path=socket_path, timeout=timeout)
+    if status != 200:
+        raise RuntimeError(f"Agent HTTP {status}: {data}")
+    return data
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    socket_path = None
+    if len(args) >= 2 and args[0] == "--socket":
+        socket_path, args = args[1], args[2:]
+    if len(args) != 1:
+        print("Использование: python agent_uds_client.py [--socket PATH] /metrics?fields=cpu.usage")
+        sys.exit(2)
+    try:
+        status, data = uds_request("GET", args[0], socket_path=socket_path)
+    except (FileNotFoundError, ConnectionRefusedError, PermissionError) as e:
+        print(f"Агент недоступен через {socket_path or DEFAULT_SOCKET_PATH}: {e.strerror}", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(data, ensure_ascii=False, indent=2) if not isinstance(data, str) else data)
+    sys.exit(0 if status == 200 else 1)
@@ -0,0 +1,83 @@
+"""
+Бенчмарк: fetch_remote_json() с пулом keep-alive против нового соединения на каждый запрос.
+
+Поднимает на 127.0.0.1 локальный "агент-заглушку" с /metrics (HTTP/1.1 с keep-alive,
+как агент за waitress/gunicorn/nginx), затем делает N последовательных запросов:
+  - requests.get(url) - как было раньше (TCP-handshake на каждый запрос);
+  - test_connect.fetch_remote_json() - через сессию из пула.
+Печатает среднюю задержку, p50/p99 и число сокетов в TIME_WAIT после прогона.
+
+Встроенный сервер Flask (werkzeug) всегда отвечает "Connection: close", поэтому
+против агента, запущенного через app.run(), пул выигрыша по задержке не даст.
+
+    python bench_remote_pool.py [N]
+"""
+
+import sys
+import time
+import json
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psutil
+import requests
+
+import test_connect
+
+PAYLOAD = json.dumps({
+    "cpu": {"usage": "3.0%"},
+    "processes": [{"pid": i, "name": f"proc{i}", "cpu_usage": "0.0%", "memory_usage": "1.00 MB"} for i in range(200)],
+}).encode("utf-8")
+
+class StandInAgentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+    def log_message(self, *args):
+        pass
+
+def time_wait_count(port):
+    try:
+        return sum(1 for c in psutil.net_connections("tcp")
+                   if c.status == psutil.CONN_TIME_WAIT and port in (c.laddr.port, c.raddr.port if c.raddr else None))
+    except psutil.AccessDenied:
+        return -1
+
+def run(label, fetch, n):
+    samples = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fetch()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    print(f"{label:<28} mean={statistics.mean(samples):7.3f} ms  "
+          f"p50={samples[len(samples) // 2]:7.3f} ms  p99={samples[int(len(samples) * 0.99) - 1]:7.3f} ms")
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInAgentHandler)
+    server.daemon_threads = True
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    test_connect.REMOTE_AGENT_PORT = port
+    url = f"http://127.0.0.1:{port}/metrics"
+
+    print(f"Агент-заглушка: {url}, запросов: {n}")
+    before = time_wait_count(port)
+    run("requests.get (без пула)", lambda: requests.get(url, timeout=5).json(), n)
+    after_plain = time_wait_count(port)
+    print(f"  новых TIME_WAIT: {after_plain - before}")
+    run("fetch_remote_json (пул)", lambda: test_connect.fetch_remote_json("127.0.0.1", "metrics"), n)
+    print(f"  новых TIME_WAIT: {time_wait_count(port) - after_plain}")
+    server.shutdown()
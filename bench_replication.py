@@ -0,0 +1,76 @@
+"""
+Бенчмарк: объём push-трафика агента на хост в минуту - полные снимки против дельт.
+
+Снимает N реальных снимков этой машины (проекция PUSH_FIELDS + список сервисов,
+как в background_push_sender), режет их на пакеты по PUSH_INTERVAL снимков и
+кодирует двумя способами:
+  - полные снимки в каждом пакете (формат до репликации дельтами);
+  - agent.encode_push_batch() - дельты к подтверждённому поколению.
+Пакеты с дельтами отправляются в test_connect /fleet/ingest (тестовый клиент Flask),
+после чего документ хоста на агрегаторе сверяется с последним снимком агента.
+Печатает байты на хост в минуту (gzip и без сжатия).
+
+    python bench_replication.py [N]
+"""
+
+import sys
+import time
+import json
+import gzip
+
+import agent
+import test_connect
+
+def take_samples(n):
+    spec = agent.parse_fields(agent.PUSH_FIELDS, agent.METRIC_COLLECTORS)
+    samples = []
+    for generation in range(1, n + 1):
+        started = time.time()
+        doc = {"metrics": agent.get_metrics(spec), "services": agent.collect_service_table()}
+        samples.append((generation, time.time(), doc))
+        time.sleep(max(0, agent.SAMPLE_INTERVAL - (time.time() - started)))
+    return samples
+
+def encode_full_batch(identity, batch):
+    snapshots = [{"generation": g, "time": t, **doc} for g, t, doc in batch]
+    return gzip.compress(json.dumps({"agent": identity, "snapshots": snapshots}, ensure_ascii=False).encode("utf-8"), 6)
+
+def per_minute(total, seconds):
+    return total * 60 / seconds
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    per_batch = max(1, int(agent.PUSH_INTERVAL / agent.SAMPLE_INTERVAL))
+    print(f"Снимков: {n} (по {agent.SAMPLE_INTERVAL} сек), в пакете: {per_batch}")
+    samples = take_samples(n)
+    seconds = n * agent.SAMPLE_INTERVAL
+    batches = [samples[i:i + per_batch] for i in range(0, n, per_batch)]
+    identity = agent.push_identity()
+    client = test_connect.app.test_client()
+
+    full_gz = full_raw = delta_gz = delta_raw = 0
+    acked = None
+    for batch in batches:
+        body = encode_full_batch(identity, batch)
+        full_gz += len(body)
+        full_raw += len(gzip.decompress(body))
+
+        body = agent.encode_push_batch(identity, batch, acked)
+        delta_gz += len(body)
+        delta_raw += len(gzip.decompress(body))
+        reply = client.post("/fleet/ingest", data=body,
+                            headers={"Content-Type": "application/json", "Content-Encoding": "gzip"}).get_json()
+        if reply.get("resync") or reply.get("ack") != batch[-1][0]:
+            sys.exit(f"Агрегатор не подтвердил пакет: {reply}")
+        acked = (batch[-1][0], batch[-1][2])
+
+    # агрегатор хранит агента по адресу отправителя и порту из identity
+    entry = test_connect.fleet_table[test_connect.host_key("127.0.0.1", identity.get("port"))]
+    last_doc = samples[-1][2]
+    restored = {"metrics": entry["metrics"], "services": entry["services"]}
+    print("Документ на агрегаторе совпадает с агентом:", restored == json.loads(json.dumps(last_doc)))
+    print(f"{'полные снимки':<16} gzip={per_minute(full_gz, seconds):10.0f} Б/мин  "
+          f"без сжатия={per_minute(full_raw, seconds):10.0f} Б/мин")
+    print(f"{'дельты':<16} gzip={per_minute(delta_gz, seconds):10.0f} Б/мин  "
+          f"без сжатия={per_minute(delta_raw, seconds):10.0f} Б/мин")
+    print(f"Экономия (gzip): {100 * (1 - delta_gz / full_gz):.1f}%")
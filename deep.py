@@ -10,6 +10,18 @@ import requests
 import psutil
 import socket
 import logging
+import re
+import json
+import base64
+import bisect
+import ipaddress
+import math
+import codecs
+import mmap
+import tempfile
+import glob
+from collections import OrderedDict
+from urllib.parse import unquote_plus
 from functools import wraps
 from flask import Flask, jsonify, abort, request
 from typing import Dict, List, Tuple, Optional, Union, Any
@@ -41,6 +53,8 @@ class Config:
         self._update_url = ""
         self._version = "1.0"
         self._update_check_interval = 60
+        self._rate_limit_per_minute = 60
+        self._rate_limit_max_clients = 10000
         
     @property
     def users(self) -> List[Dict[str, str]]:
@@ -79,6 +93,28 @@ class Config:
             raise ValueError("Интервал проверки должен быть положительным числом")
         self._update_check_interval = value
 
+    @property
+    def rate_limit_per_minute(self) -> int:
+        """Ёмкость и скорость пополнения корзины токенов одного клиента (токенов в минуту)."""
+        return self._rate_limit_per_minute
+
+    @rate_limit_per_minute.setter
+    def rate_limit_per_minute(self, value: int):
+        if not isinstance(value, int) or value <= 0:
+            raise ValueError("Лимит запросов должен быть положительным числом")
+        self._rate_limit_per_minute = value
+
+    @property
+    def rate_limit_max_clients(self) -> int:
+        """Сколько клиентов держать в LRU лимитера."""
+        return self._rate_limit_max_clients
+
+    @rate_limit_max_clients.setter
+    def rate_limit_max_clients(self, value: int):
+        if not isinstance(value, int) or value <= 0:
+            raise ValueError("Размер таблицы клиентов должен быть положительным числом")
+        self._rate_limit_max_clients = value
+
 config = Config()
 config.users = [
     {"name": "Alice", "ip": "192.168.1.10"},
@@ -87,23 +123,157 @@ config.users = [
 ]
 config.update_url = "https://raw.githubusercontent.com/WrNekit/agent-updater/refs/heads/main/deeo.py"
 
+# ------------------------------------------------------------------------------------
+#                  Реестр пользователей и хостов (индексы, горячая перезагрузка)
+# ------------------------------------------------------------------------------------
+# Файл .json или каталог с .json: список {"name": ..., "ip": ...} или {"users": [...]}.
+# В "ip" можно указать диапазон CIDR (10.0.0.0/24) - тогда запись находится по любому
+# адресу из диапазона. Если файла нет, используется config.users.
+# Тот же блок есть в agent.py, test_connect.py и deep.py: каждый файл обновляется
+# сам по себе (UPDATE_URL) и не может зависеть от соседних модулей.
+USERS_REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.json")
+REGISTRY_RELOAD_INTERVAL = 5  # как часто проверять файл реестра на изменения, сек
+
+def build_user_registry(entries: List[Dict[str, str]], signature: Optional[tuple] = None) -> Dict[str, Any]:
+    """Строит индексы реестра: по имени, по имени без учёта регистра, по IP и по сетям CIDR."""
+    registry = {
+        "signature": signature,
+        "users": [],
+        "by_name": {},
+        "by_casefold": {},
+        "by_ip": {},
+        "networks": {},  # (версия IP, длина префикса) -> {адрес сети (int): запись}
+        "network_keys": [],  # ключи networks от длинных префиксов к коротким
+    }
+    for entry in entries:
+        if not isinstance(entry, dict) or 'name' not in entry or 'ip' not in entry:
+            logger.warning(f"Реестр: пропущена запись без name/ip: {entry}")
+            continue
+        try:
+            network = ipaddress.ip_network(str(entry['ip']).strip(), strict=False)
+        except ValueError:
+            logger.warning(f"Реестр: некорректный IP у {entry['name']}: {entry['ip']}")
+            continue
+        registry["users"].append(entry)
+        registry["by_name"][entry['name']] = entry
+        registry["by_casefold"][entry['name'].casefold()] = entry
+        if network.num_addresses == 1:
+            registry["by_ip"][str(network.network_address)] = entry
+        else:
+            key = (network.version, network.prefixlen)
+            registry["networks"].setdefault(key, {})[int(network.network_address)] = entry
+    registry["network_keys"] = sorted(registry["networks"], key=lambda k: -k[1])
+    return registry
+
+def registry_signature(path: str) -> Optional[tuple]:
+    """Отпечаток файла/каталога реестра (имена, mtime, размеры) для обнаружения изменений."""
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.json'))
+    elif os.path.isfile(path):
+        files = [path]
+    else:
+        return None
+    return tuple((f, os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files)
+
+def load_registry_entries(signature: tuple) -> List[Dict[str, str]]:
+    entries = []
+    for path, _, _ in signature:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        entries.extend(data.get("users", []) if isinstance(data, dict) else data)
+    return entries
+
+def reload_user_registry() -> bool:
+    """Перечитывает реестр, если файл изменился. Индексы подменяются целиком, без блокировок чтения."""
+    global user_registry
+    try:
+        signature = registry_signature(USERS_REGISTRY_PATH)
+        if signature == user_registry["signature"]:
+            return False
+        entries = load_registry_entries(signature) if signature else config.users
+        user_registry = build_user_registry(entries, signature)
+        logger.info(f"Реестр пользователей загружен: {len(user_registry['users'])} записей")
+        return True
+    except Exception as e:
+        logger.error(f"Не удалось загрузить реестр пользователей: {e}")
+        return False
+
+def find_user(name: str, casefold: bool = False) -> Optional[Dict[str, str]]:
+    """O(1) поиск записи по имени (casefold=True - без учёта регистра)."""
+    if casefold:
+        return user_registry["by_casefold"].get(name.casefold())
+    return user_registry["by_name"].get(name)
+
+def background_registry_watcher() -> None:
+    while True:
+        time.sleep(REGISTRY_RELOAD_INTERVAL)
+        reload_user_registry()
+
+user_registry = build_user_registry(config.users)
+reload_user_registry()
+
 # ------------------------------------------------------------------------------------
 #                          Декораторы для безопасности и логирования
 # ------------------------------------------------------------------------------------
-def rate_limited(max_per_minute: int = 60):
+class TokenBucketLimiter:
+    """
+    Корзины токенов по клиентам в ограниченном LRU.
+    Каждая корзина - [токены, время последнего пополнения]; проверка O(1).
+    """
+
+    def __init__(self, per_minute: int, max_clients: int):
+        self._capacity = float(per_minute)
+        self._rate = per_minute / 60.0  # токенов в секунду
+        self._max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, client: str, cost: float = 1) -> float:
+        """Списывает cost токенов. Возвращает 0, если запрос разрешён, иначе - через сколько секунд повторить."""
+        cost = min(float(cost), self._capacity)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = [self._capacity, now]
+                self._buckets[client] = bucket
+                if len(self._buckets) > self._max_clients:
+                    self._buckets.popitem(last=False)  # вытесняем самого давнего клиента
+            else:
+                self._buckets.move_to_end(client)
+                bucket[0] = min(self._capacity, bucket[0] + (now - bucket[1]) * self._rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            return (cost - bucket[0]) / self._rate
+
+rate_limiter = TokenBucketLimiter(config.rate_limit_per_minute, config.rate_limit_max_clients)
+
+def client_key() -> str:
+    """
+    Ключ клиента для лимитера - удалённый адрес. Заголовок Authorization агент не проверяет,
+    поэтому ключевать по нему нельзя: новое значение на каждый запрос давало бы новую корзину.
+    """
+    return "addr:" + (request.remote_addr or "unknown")
+
+def rate_limited(cost: float = 1):
+    """
+    Ограничение частоты по корзине токенов клиента (config.rate_limit_per_minute).
+    cost - сколько токенов стоит вызов эндпоинта; при превышении - 429 с Retry-After.
+    """
     def decorator(f):
-        calls = []
-        
         @wraps(f)
         def wrapped(*args, **kwargs):
-            now = time.time()
-            calls_in_time = [call for call in calls if call > now - 60]
-            
-            if len(calls_in_time) >= max_per_minute:
+            retry_after = rate_limiter.acquire(client_key(), cost)
+            if retry_after > 0:
                 logger.warning(f"Превышен лимит запросов для {f.__name__}")
-                abort(429, description="Слишком много запросов")
-                
-            calls.append(now)
+                return jsonify({
+                    "error": "Слишком много запросов",
+                    "retry_after": math.ceil(retry_after),
+                    "status": "error",
+                    "timestamp": time.strftime('%Y-%m-%d %H:%M:%S')
+                }), 429, {"Retry-After": str(math.ceil(retry_after))}
             return f(*args, **kwargs)
         return wrapped
     return decorator
@@ -147,23 +317,10 @@ def convert_bytes(bytes_value: Union[int, float]) -> str:
     return f"{bytes_value:.2f} ПБ"
 
 def compute_hash(data: bytes) -> str:
-    """Вычисление хеша с защитой от переполнения."""
+    """Вычисление SHA256 хеша данных целиком."""
     if not isinstance(data, bytes):
         raise ValueError("Входные данные должны быть в байтах")
-    
-    hash_func = hashlib.sha256()
-    try:
-        # Ограничиваем размер данных для хеширования (10MB максимум)
-        max_size = 10 * 1024 * 1024
-        if len(data) > max_size:
-            data = data[:max_size]
-            logger.warning("Входные данные усечены для хеширования")
-            
-        hash_func.update(data)
-        return hash_func.hexdigest()
-    except Exception as e:
-        logger.error(f"Ошибка вычисления хеша: {e}")
-        raise
+    return hashlib.sha256(data).hexdigest()
 
 def normalize_code(data: bytes) -> bytes:
     """Нормализация кода с обработкой ошибок кодировки."""
@@ -176,79 +333,257 @@ def normalize_code(data: bytes) -> bytes:
         logger.error(f"Ошибка нормализации кода: {e}")
         return data
 
-def code_has_changed(new_data: bytes, is_py: bool = False) -> Tuple[bool, Optional[str], Optional[str]]:
-    """Безопасное сравнение хешей с обработкой ошибок файловых операций."""
+# Путь к файлу запущенного агента (для сравнения хешей при обновлении)
+RUNNING_FILE = os.path.abspath(__file__)
+
+# Потоковый хеш кода: файл читается кусками HASH_CHUNK_SIZE (большие бинарники - через mmap),
+# для .py нормализация normalize_code() выполняется построчно на лету.
+# Тот же конвейер (хеш, валидаторы, промежуточный файл) есть в agent.py, test_connect.py и deep.py:
+# каждый файл обновляется сам по себе (UPDATE_URL) и не может зависеть от соседних модулей.
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_MMAP_MIN_SIZE = 16 * 1024 * 1024
+
+def new_code_hasher(is_py: bool) -> Dict[str, Any]:
+    """
+    Состояние потокового хеша. Результат совпадает с compute_hash(normalize_code(data)) для .py
+    и с compute_hash(data) для бинарников.
+    """
+    return {
+        "hash": hashlib.sha256(),
+        "decoder": codecs.getincrementaldecoder('utf-8')(errors='replace') if is_py else None,
+        "tail": "",       # незавершённая строка с конца предыдущего куска
+        "blank": 0,       # пустые строки, ещё не записанные в хеш (хвостовые отбрасываются, как strip())
+        "started": False, # встретилась ли первая непустая строка (ведущие пробелы отбрасываются)
+    }
+
+def code_hasher_line(state: Dict[str, Any], line: str) -> None:
+    line = line.rstrip()
+    if not state["started"]:
+        line = line.lstrip()
+        if not line:
+            return
+        state["started"] = True
+        state["hash"].update(line.encode('utf-8'))
+    elif not line:
+        state["blank"] += 1
+    else:
+        state["hash"].update(("\n" * (state["blank"] + 1) + line).encode('utf-8'))
+        state["blank"] = 0
+
+def code_hasher_update(state: Dict[str, Any], chunk) -> None:
+    if state["decoder"] is None:
+        state["hash"].update(chunk)
+        return
+    lines = (state["tail"] + state["decoder"].decode(chunk)).split('\n')
+    state["tail"] = lines.pop()
+    for line in lines:
+        code_hasher_line(state, line)
+
+def code_hasher_digest(state: Dict[str, Any]) -> str:
+    if state["decoder"] is not None:
+        code_hasher_line(state, state["tail"] + state["decoder"].decode(b'', final=True))
+        state["tail"] = ""
+    return state["hash"].hexdigest()
+
+def file_code_hash(path: str, is_py: bool) -> str:
+    """Хеш файла без чтения его целиком в память."""
+    state = new_code_hasher(is_py)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not is_py and size >= HASH_MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                code_hasher_update(state, mapped)
+        else:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                code_hasher_update(state, chunk)
+    return code_hasher_digest(state)
+
+# Хеш файла запущенного агента по режиму сравнения (is_py) вместе с (mtime_ns, размер),
+# при которых он посчитан: файл перечитывается, только если он изменился на диске.
+running_hash_cache: Dict[bool, Dict[str, Any]] = {}
+running_hash_lock = threading.Lock()
+
+def running_code_hash(is_py: bool) -> str:
+    stamp = running_file_stamp()
+    if stamp is None:
+        raise FileNotFoundError(RUNNING_FILE)
+    with running_hash_lock:
+        cached = running_hash_cache.get(is_py)
+        if cached and cached["stamp"] == stamp:
+            return cached["hash"]
+        digest = file_code_hash(RUNNING_FILE, is_py)
+        running_hash_cache[is_py] = {"stamp": stamp, "hash": digest}
+        return digest
+
+def code_has_changed(new_hash: str, is_py: bool = False) -> Tuple[bool, Optional[str], Optional[str]]:
+    """Сравнение хеша скачанного файла с закэшированным хешем текущего файла."""
     try:
-        current_file = os.path.abspath(__file__)
-        
+        current_file = RUNNING_FILE
+
         # Проверка существования и доступности файла
         if not os.path.exists(current_file):
             logger.error(f"Файл не найден: {current_file}")
-            return True, None, None
-            
+            return True, None, new_hash
+
         if not os.access(current_file, os.R_OK):
             logger.error(f"Нет доступа на чтение файла: {current_file}")
-            return True, None, None
-            
-        # Ограничение размера читаемого файла (50MB максимум)
-        max_file_size = 50 * 1024 * 1024
-        file_size = os.path.getsize(current_file)
-        if file_size > max_file_size:
-            logger.error(f"Файл слишком большой для сравнения: {file_size} байт")
-            return True, None, None
-            
-        with open(current_file, "rb") as f:
-            current_data = f.read(max_file_size)
-
-        old_norm = normalize_code(current_data) if is_py else current_data
-        new_norm = normalize_code(new_data) if is_py else new_data
+            return True, None, new_hash
 
-        old_hash = compute_hash(old_norm)
-        new_hash = compute_hash(new_norm)
+        old_hash = running_code_hash(is_py)
 
         logger.debug(f"Сравнение хешей - старый: {old_hash}, новый: {new_hash}")
         return old_hash != new_hash, old_hash, new_hash
         
     except Exception as e:
         logger.error(f"Ошибка сравнения кода: {e}")
-        return True, None, None
+        return True, None, new_hash
+
+class UpdateTooLarge(Exception):
+    """Скачиваемый файл обновления превысил допустимый размер."""
+
+def stage_update(resp: requests.Response, file_type: str, max_size: int) -> Tuple[str, str]:
+    """
+    Пишет тело ответа кусками в промежуточный файл рядом с агентом, по ходу считая хеш кода.
+    Возвращает (путь, хеш); целиком файл в памяти не держится. Больше max_size байт - UpdateTooLarge.
+    """
+    cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    fd, staged_path = tempfile.mkstemp(prefix="agent_update_", suffix=".part", dir=cdir)
+    state = new_code_hasher(file_type == "py")
+    written = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in resp.iter_content(HASH_CHUNK_SIZE):
+                written += len(chunk)
+                if written > max_size:
+                    raise UpdateTooLarge(f"Файл обновления больше {max_size} байт")
+                f.write(chunk)
+                code_hasher_update(state, chunk)
+        # mkstemp создаёт файл с правами 0o600; ставим те же, что дал бы open("wb")
+        os.chmod(staged_path, default_file_mode())
+    except BaseException:
+        discard_staged_update(staged_path)
+        raise
+    return staged_path, code_hasher_digest(state)
+
+def discard_staged_update(staged_path: str) -> None:
+    try:
+        os.remove(staged_path)
+    except OSError:
+        pass
+
+def default_file_mode() -> int:
+    """Права нового файла по умолчанию: 0o666 без битов umask."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def cleanup_staged_updates() -> None:
+    """Удаляет промежуточные файлы обновлений, оставшиеся от загрузки, прерванной падением или перезапуском."""
+    cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    for path in glob.glob(os.path.join(cdir, "agent_update_*.part")):
+        logger.info(f"Удаляем недокачанное обновление {path}")
+        discard_staged_update(path)
+
+# Валидаторы HTTP-кэша (ETag / Last-Modified) по URL обновления, сохраняются между
+# перезапусками. Запоминаются, только когда загруженный файл совпал с текущим, и
+# действуют, пока текущий файл не изменился (mtime и размер) - поэтому ответ 304
+# всегда означает "обновлений нет".
+UPDATE_VALIDATORS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "update_validators.json")
+update_validators_lock = threading.Lock()
+
+def load_update_validators() -> Dict[str, Any]:
+    try:
+        with open(UPDATE_VALIDATORS_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_update_validators(validators: Dict[str, Any]) -> None:
+    tmp_path = UPDATE_VALIDATORS_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(validators, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, UPDATE_VALIDATORS_PATH)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить валидаторы обновлений: {e}")
+
+def running_file_stamp() -> Optional[List[int]]:
+    """(mtime_ns, размер) файла запущенного агента."""
+    try:
+        st = os.stat(RUNNING_FILE)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+def conditional_update_headers(url: str) -> Dict[str, str]:
+    """If-None-Match / If-Modified-Since для url, если валидаторы относятся к текущему файлу агента."""
+    with update_validators_lock:
+        record = load_update_validators().get(url)
+    if not record or record.get("local") != running_file_stamp():
+        return {}
+    headers = {}
+    if record.get("etag"):
+        headers["If-None-Match"] = record["etag"]
+    if record.get("last_modified"):
+        headers["If-Modified-Since"] = record["last_modified"]
+    return headers
+
+def remember_update_validators(url: str, resp: requests.Response) -> None:
+    """Сохраняет ETag/Last-Modified ответа url (вызывать, только если файл не отличается от текущего)."""
+    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    with update_validators_lock:
+        validators = load_update_validators()
+        if not etag and not last_modified:
+            if validators.pop(url, None) is None:
+                return
+        else:
+            validators[url] = {"etag": etag, "last_modified": last_modified, "local": running_file_stamp()}
+        save_update_validators(validators)
+
+def update_file_type() -> str:
+    """Тип файла обновления по config.update_url: "exe" или "py"."""
+    # Определение типа файла с защитой от инъекций
+    lower_url = config.update_url.lower()
+    if is_windows() and lower_url.endswith(".exe"):
+        return "exe"
+    return "py"  # По умолчанию для Linux
 
 def check_for_updates() -> Dict[str, Any]:
-    """Безопасная проверка обновлений с таймаутом и проверкой SSL."""
+    """
+    Безопасная проверка обновлений с таймаутом и проверкой SSL.
+    Файл скачивается один раз, потоком в промежуточный файл; при наличии обновления
+    путь к нему возвращается в "staged_path" для apply_update().
+    """
     logger.info("Проверка обновлений...")
     try:
-        # Определение типа файла с защитой от инъекций
-        lower_url = config.update_url.lower()
-        file_type = "py"  # По умолчанию для Linux
-        
-        if is_windows():
-            if lower_url.endswith(".exe"):
-                file_type = "exe"
-            elif lower_url.endswith(".py"):
-                file_type = "py"
+        file_type = update_file_type()
 
         # Безопасный запрос с таймаутом и проверкой SSL
+        # Ограничение размера загружаемого файла (50MB максимум)
+        max_update_size = 50 * 1024 * 1024
         try:
-            resp = requests.get(
+            with requests.get(
                 config.update_url,
                 timeout=(10, 30),
                 verify=True,
-                headers={'User-Agent': f'Agent/{config.version}'}
-            )
-            resp.raise_for_status()
+                stream=True,
+                headers={'User-Agent': f'Agent/{config.version}', **conditional_update_headers(config.update_url)}
+            ) as resp:
+                if resp.status_code == 304:
+                    # Файл на сервере не менялся с последней проверки, совпавшей с текущим файлом
+                    logger.info("Обновлений не обнаружено (304 Not Modified)")
+                    return {"update_available": False, "not_modified": True}
+                resp.raise_for_status()
+                staged_path, new_hash = stage_update(resp, file_type, max_update_size)
         except requests.exceptions.RequestException as e:
             logger.error(f"Ошибка запроса проверки обновлений: {e}")
             return {"update_available": False, "error": str(e)}
-
-        new_data = resp.content
-        
-        # Ограничение размера загружаемого файла (50MB максимум)
-        max_update_size = 50 * 1024 * 1024
-        if len(new_data) > max_update_size:
+        except UpdateTooLarge:
             logger.error("Файл обновления слишком большой")
             return {"update_available": False, "error": "Файл обновления слишком большой"}
 
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=(file_type == "py"))
+        changed, old_hash, new_hash = code_has_changed(new_hash, is_py=(file_type == "py"))
 
         if changed:
             return {
@@ -256,56 +591,35 @@ def check_for_updates() -> Dict[str, Any]:
                 "file_type": file_type,
                 "old_hash": old_hash,
                 "new_hash": new_hash,
-                "update_url": config.update_url
+                "update_url": config.update_url,
+                "staged_path": staged_path
             }
         else:
             logger.info("Обновлений не обнаружено")
+            discard_staged_update(staged_path)
+            remember_update_validators(config.update_url, resp)
             return {"update_available": False}
             
     except Exception as e:
         logger.error(f"Исключение при проверке обновлений: {e}", exc_info=True)
         return {"update_available": False, "error": str(e)}
 
-def perform_update_exe_direct(update_url: str) -> Dict[str, Any]:
-    """Безопасное обновление .exe с проверкой цифровой подписи (заглушка)."""
-    logger.info("Загрузка нового .exe: %s", update_url)
+def perform_update_exe_direct(staged_path: str) -> Dict[str, Any]:
+    """Безопасное обновление скачанным .exe с проверкой цифровой подписи (заглушка)."""
+    logger.info("Установка нового .exe: %s", staged_path)
     try:
-        # Проверка URL
-        if not update_url.startswith(('http://', 'https://')):
-            return {"success": False, "message": "Некорректный URL обновления"}
-
-        # Безопасная загрузка
-        try:
-            resp = requests.get(
-                update_url,
-                timeout=(10, 30),
-                verify=True,
-                headers={'User-Agent': f'Agent/{config.version}'}
-            )
-            resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка загрузки обновления: {e}")
-            return {"success": False, "message": f"Ошибка загрузки: {e}"}
-
-        new_data = resp.content
-        
         # Проверка размера файла
-        if len(new_data) > 100 * 1024 * 1024:  # 100MB максимум
+        if os.path.getsize(staged_path) > 100 * 1024 * 1024:  # 100MB максимум
             return {"success": False, "message": "Файл обновления слишком большой"}
 
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=False)
-        if not changed:
-            return {"success": False, "message": "Файл .exe не изменился"}
-
         # Безопасное сохранение нового файла
         cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
         stamp = time.strftime("%Y%m%d%H%M%S")
         new_exe = os.path.join(cdir, f"agent_new_{stamp}.exe")
         
         try:
-            with open(new_exe, "wb") as f:
-                f.write(new_data)
-        except IOError as e:
+            os.replace(staged_path, new_exe)
+        except OSError as e:
             return {"success": False, "message": f"Ошибка записи файла: {e}"}
 
         logger.info("Новый исполняемый файл сохранен: %s", new_exe)
@@ -345,37 +659,14 @@ def verify_file_signature(file_path: str) -> bool:
     # В реальной реализации здесь должна быть проверка цифровой подписи
     return True
 
-def perform_update_script_py(update_url: str) -> Dict[str, Any]:
-    """Безопасное обновление Python-скрипта."""
-    logger.info("Загрузка нового .py скрипта")
+def perform_update_script_py(staged_path: str) -> Dict[str, Any]:
+    """Безопасное обновление скачанным Python-скриптом."""
+    logger.info("Установка нового .py скрипта")
     try:
-        # Проверка URL
-        if not update_url.startswith(('http://', 'https://')):
-            return {"success": False, "message": "Некорректный URL обновления"}
-
-        # Безопасная загрузка
-        try:
-            resp = requests.get(
-                update_url,
-                timeout=(10, 30),
-                verify=True,
-                headers={'User-Agent': f'Agent/{config.version}'}
-            )
-            resp.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Ошибка загрузки обновления: {e}")
-            return {"success": False, "message": f"Ошибка загрузки: {e}"}
-
-        new_data = resp.content
-        
         # Проверка размера файла
-        if len(new_data) > 10 * 1024 * 1024:  # 10MB максимум
+        if os.path.getsize(staged_path) > 10 * 1024 * 1024:  # 10MB максимум
             return {"success": False, "message": "Файл скрипта слишком большой"}
 
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=True)
-        if not changed:
-            return {"success": False, "message": "Файл скрипта не изменился"}
-
         # Безопасная работа с файлами
         cfile = os.path.abspath(sys.argv[0])
         cdir = os.path.dirname(cfile)
@@ -385,8 +676,7 @@ def perform_update_script_py(update_url: str) -> Dict[str, Any]:
 
         try:
             # Сохраняем новый файл
-            with open(new_py, "wb") as f:
-                f.write(new_data)
+            os.replace(staged_path, new_py)
                 
             # Создаем резервную копию
             shutil.move(cfile, backup_py)
@@ -425,51 +715,50 @@ def perform_update_script_py(update_url: str) -> Dict[str, Any]:
         logger.error(f"Исключение при обновлении: {e}", exc_info=True)
         return {"success": False, "message": str(e)}
 
-def do_update_if_available() -> Dict[str, Any]:
-    """Безопасная проверка и выполнение обновления."""
-    info = check_for_updates()
-    if not info.get("update_available"):
-        return {"success": False, "message": "Обновлений не обнаружено"}
-
+def apply_update(info: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Применение файла, скачанного check_for_updates() (info["staged_path"]).
+    Хеш этого файла уже посчитан в stage_update() по мере записи, второй раз файл не читается.
+    """
     ftype = info.get("file_type", "py")
-    update_url = info.get("update_url", "")
+    staged_path = info.get("staged_path", "")
     
-    if not update_url:
-        return {"success": False, "message": "Некорректный URL обновления"}
+    if not staged_path:
+        return {"success": False, "message": "Нет скачанного файла обновления"}
         
     try:
         if ftype == "exe":
             if is_compiled():
-                return perform_update_exe_direct(update_url)
+                return perform_update_exe_direct(staged_path)
             else:
                 logger.warning("Запущен как .py, но обновление .exe - выполняем прямое обновление")
-                return perform_update_exe_direct(update_url)
+                return perform_update_exe_direct(staged_path)
         else:
             if is_compiled():
-                return perform_update_compile_py(update_url)
+                return perform_update_compile_py(staged_path)
             else:
-                return perform_update_script_py(update_url)
+                return perform_update_script_py(staged_path)
     except Exception as e:
         logger.error(f"Ошибка обновления: {e}", exc_info=True)
         return {"success": False, "message": str(e)}
+    finally:
+        # Сюда попадаем, только если обновиться не удалось
+        discard_staged_update(staged_path)
 
-def perform_update_compile_py(update_url):
-    print("[INFO] Скачиваем .py и компилируем через PyInstaller.")
-    try:
-        resp = requests.get(update_url, timeout=30)
-        if resp.status_code != 200:
-            return {"success": False, "message": f"HTTP {resp.status_code}"}
-
-        new_data = resp.content
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=True)
-        if not changed:
-            return {"success": False, "message": "Исходный .py не изменился."}
+def do_update_if_available() -> Dict[str, Any]:
+    """Безопасная проверка и выполнение обновления."""
+    info = check_for_updates()
+    if not info.get("update_available"):
+        return {"success": False, "message": "Обновлений не обнаружено"}
+    return apply_update(info)
 
+def perform_update_compile_py(staged_path):
+    print("[INFO] Компилируем скачанный .py через PyInstaller.")
+    try:
         cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
         stamp = time.strftime("%Y%m%d%H%M%S")
         new_py = os.path.join(cdir, f"agent_new_{stamp}.py")
-        with open(new_py, "wb") as f:
-            f.write(new_data)
+        os.replace(staged_path, new_py)
 
         compile_cmd = [sys.executable, "-m", "PyInstaller", "--onefile", "--noconsole", new_py]
         res = subprocess.run(compile_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
@@ -545,8 +834,7 @@ def get_metrics() -> Dict[str, Any]:
         pass
 
     try:
-        # Информация о процессах с ограничением количества
-        max_processes = 50
+        # Информация о процессах (полный список; постранично - через /processes)
         processes = []
         for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_info']):
             try:
@@ -556,8 +844,6 @@ def get_metrics() -> Dict[str, Any]:
                     "cpu_usage": f"{proc.info['cpu_percent']:.1f}%",
                     "memory_usage": convert_bytes(proc.info['memory_info'].rss),
                 })
-                if len(processes) >= max_processes:
-                    break
             except:
                 continue
         metrics["processes"] = processes
@@ -599,8 +885,6 @@ def get_services() -> List[Dict[str, str]]:
                         "status": svc.status()[:50],
                         "display_name": svc.display_name()[:100]
                     })
-                    if len(services) >= 100:  # Ограничение количества
-                        break
                 except:
                     continue
         else:
@@ -613,7 +897,7 @@ def get_services() -> List[Dict[str, str]]:
                     text=True,
                     timeout=10
                 )
-                for line in res.stdout.splitlines()[:100]:  # Ограничение количества
+                for line in res.stdout.splitlines():
                     parts = line.split()
                     if len(parts) > 1:
                         services.append({
@@ -626,6 +910,132 @@ def get_services() -> List[Dict[str, str]]:
         logger.error(f"Ошибка получения списка сервисов: {e}")
     return services
 
+# ------------------------------------------------------------------------------------
+#          Кэш таблиц процессов и сервисов, фильтры и курсорная пагинация
+# ------------------------------------------------------------------------------------
+def collect_process_table() -> List[Dict[str, Any]]:
+    """Сырые строки процессов, отсортированные по pid."""
+    rows = []
+    for proc in psutil.process_iter(['pid', 'name', 'username', 'status', 'cpu_percent', 'memory_info']):
+        try:
+            rows.append({
+                "pid": proc.info['pid'],
+                "name": (proc.info['name'] or "")[:100],
+                "user": (proc.info['username'] or "")[:100],
+                "status": (proc.info['status'] or "")[:50],
+                "cpu": proc.info['cpu_percent'] or 0.0,
+                "rss": proc.info['memory_info'].rss if proc.info['memory_info'] else 0,
+            })
+        except:
+            continue
+    rows.sort(key=lambda r: r["pid"])
+    return rows
+
+def format_process_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "pid": row["pid"],
+        "name": row["name"],
+        "user": row["user"],
+        "status": row["status"],
+        "cpu_usage": f"{row['cpu']:.1f}%",
+        "memory_usage": convert_bytes(row["rss"]),
+    }
+
+class TableCache:
+    """Кэш таблиц с TTL; строки хранятся отсортированными по ключу курсора."""
+
+    FILTER_RE = re.compile(r'^(\w+)(~=|=|>|<)(.*)$')
+    PAGE_PARAMS = ("limit", "cursor")
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+
+    def __init__(self, ttl: float = 2.0):
+        self._ttl = ttl
+        self._tables = {}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, collect, key: str, filters: Dict[str, Tuple[str, ...]]):
+        self._tables[name] = (collect, key, filters)
+
+    def get(self, name: str) -> Dict[str, Any]:
+        """Возвращает таблицу, пересобирая её не чаще раза в ttl секунд."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or time.time() - entry["time"] > self._ttl:
+                collect, key, _ = self._tables[name]
+                rows = collect()
+                entry = {"time": time.time(), "rows": rows, "keys": [r[key] for r in rows]}
+                self._entries[name] = entry
+            return entry
+
+    def parse_filters(self, name: str, query_string: str) -> List[Any]:
+        """Фильтры вида name~=ssh, user=root, status=running, cpu>5, rss>104857600."""
+        allowed = self._tables[name][2]
+        predicates = []
+        for part in query_string.split('&'):
+            part = unquote_plus(part)
+            if not part or part.split('=', 1)[0] in self.PAGE_PARAMS:
+                continue
+            m = self.FILTER_RE.match(part)
+            if not m or m.group(1) not in allowed or m.group(2) not in allowed[m.group(1)]:
+                raise ValueError(f"Неподдерживаемый фильтр: {part}")
+            field, op, value = m.groups()
+            if op == "~=":
+                predicates.append(lambda r, f=field, v=value.lower(): v in str(r[f]).lower())
+            elif op == "=":
+                predicates.append(lambda r, f=field, v=value: str(r[f]) == v)
+            else:
+                number = float(value)
+                if op == ">":
+                    predicates.append(lambda r, f=field, v=number: r[f] > v)
+                else:
+                    predicates.append(lambda r, f=field, v=number: r[f] < v)
+        return predicates
+
+    def paginate(self, name: str, limit: int, cursor: Optional[str],
+                 predicates: List[Any]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Keyset-пагинация: курсор хранит ключ последней отданной строки."""
+        entry = self.get(name)
+        rows, keys = entry["rows"], entry["keys"]
+        key = self._tables[name][1]
+        start = bisect.bisect_right(keys, json.loads(base64.urlsafe_b64decode(cursor))) if cursor else 0
+        page = []
+        for i in range(start, len(rows)):
+            if all(p(rows[i]) for p in predicates):
+                if len(page) >= limit:
+                    next_cursor = base64.urlsafe_b64encode(json.dumps(page[-1][key]).encode('utf-8'))
+                    return page, next_cursor.decode('ascii')
+                page.append(rows[i])
+        return page, None
+
+    def query(self, name: str) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Страница таблицы по параметрам текущего запроса; ValueError при некорректных параметрах."""
+        try:
+            limit = int(request.args.get('limit', self.DEFAULT_LIMIT))
+            limit = max(1, min(limit, self.MAX_LIMIT))
+            predicates = self.parse_filters(name, request.query_string.decode('utf-8'))
+            return self.paginate(name, limit, request.args.get('cursor'), predicates)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"Некорректные параметры запроса: {e}")
+
+def table_query_error(e: ValueError):
+    return jsonify({
+        "error": str(e),
+        "status": "error",
+        "timestamp": time.strftime('%Y-%m-%d %H:%M:%S')
+    }), 400
+
+table_cache = TableCache()
+table_cache.register(
+    "processes", collect_process_table, "pid",
+    {"name": ("~=", "="), "user": ("=",), "status": ("=",), "cpu": (">", "<"), "rss": (">", "<")}
+)
+table_cache.register(
+    "services", lambda: sorted(get_services(), key=lambda r: r["name"]), "name",
+    {"name": ("~=", "="), "status": ("=",)}
+)
+
 # ------------------------------------------------------------------------------------
 #                Дополнительные функции с улучшенной безопасностью
 # ------------------------------------------------------------------------------------
@@ -763,7 +1173,7 @@ class BackgroundUpdater:
                 info = check_for_updates()
                 if info.get("update_available"):
                     logger.info("Обнаружено обновление, выполнение обновления...")
-                    res = do_update_if_available()
+                    res = apply_update(info)
                     if res.get("success"):
                         logger.info("Обновление успешно, завершение...")
                         break
@@ -818,6 +1228,7 @@ def api_root():
             "version": "/version",
             "users": "/users",
             "metrics": "/metrics",
+            "processes": "/processes",
             "services": "/services",
             "machine_info": "/machine_info"
         }
@@ -836,7 +1247,7 @@ def get_version():
 
 @app.route('/update', methods=['GET', 'POST'])
 @handle_errors
-@rate_limited(max_per_minute=5)
+@rate_limited(cost=12)
 def update_agent():
     """Обновление агента"""
     result = do_update_if_available()
@@ -852,8 +1263,8 @@ def update_agent():
 def get_all_users():
     """Получение списка всех пользователей"""
     return jsonify({
-        "users": config.users,
-        "count": len(config.users),
+        "users": user_registry["users"],
+        "count": len(user_registry["users"]),
         "status": "success",
         "timestamp": time.strftime('%Y-%m-%d %H:%M:%S')
     })
@@ -866,7 +1277,7 @@ def get_user(username: str):
     if not isinstance(username, str) or not username.isalnum():
         abort(400, description="Некорректное имя пользователя")
         
-    user = next((u for u in config.users if u['name'].lower() == username.lower()), None)
+    user = find_user(username, casefold=True)
     if not user:
         abort(404, description="Пользователь не найден")
     
@@ -889,7 +1300,7 @@ def get_user_metrics(username: str):
     if not isinstance(username, str) or not username.isalnum():
         abort(400, description="Некорректное имя пользователя")
         
-    user = next((u for u in config.users if u['name'].lower() == username.lower()), None)
+    user = find_user(username, casefold=True)
     if not user:
         abort(404, description="Пользователь не найден")
     
@@ -918,7 +1329,7 @@ def get_user_specific_metric(username: str, metric_name: str):
     if not isinstance(metric_name, str) or not metric_name.isalnum():
         abort(400, description="Некорректное название метрики")
 
-    user = next((u for u in config.users if u['name'].lower() == username.lower()), None)
+    user = find_user(username, casefold=True)
     if not user:
         abort(404, description="Пользователь не найден")
     
@@ -954,7 +1365,7 @@ def get_top_processes(username: str):
     if not isinstance(username, str) or not username.isalnum():
         abort(400, description="Некорректное имя пользователя")
         
-    user = next((u for u in config.users if u['name'].lower() == username.lower()), None)
+    user = find_user(username, casefold=True)
     if not user:
         abort(404, description="Пользователь не найден")
     
@@ -1004,7 +1415,7 @@ def get_user_services(username: str):
     if not isinstance(username, str) or not username.isalnum():
         abort(400, description="Некорректное имя пользователя")
         
-    user = next((u for u in config.users if u['name'].lower() == username.lower()), None)
+    user = find_user(username, casefold=True)
     if not user:
         abort(404, description="Пользователь не найден")
     
@@ -1030,7 +1441,7 @@ def get_user_directories_endpoint(username: str):
     if not isinstance(username, str) or not username.isalnum():
         abort(400, description="Некорректное имя пользователя")
         
-    user = next((u for u in config.users if u['name'].lower() == username.lower()), None)
+    user = find_user(username, casefold=True)
     if not user:
         abort(404, description="Пользователь не найден")
     
@@ -1052,7 +1463,7 @@ def get_user_directories_endpoint(username: str):
 
 @app.route('/metrics', methods=['GET'])
 @handle_errors
-@rate_limited(max_per_minute=30)
+@rate_limited(cost=2)
 def get_all_metrics():
     """Получение всех метрик системы"""
     return jsonify({
@@ -1095,12 +1506,38 @@ def get_specific_metric(metric_name: str):
 @handle_errors
 @rate_limited()
 def get_all_services():
-    """Получение всех сервисов системы"""
-    services_data = get_services()
+    """Получение сервисов системы (с параметрами - постранично и с фильтрами)"""
+    if not request.args:
+        services_data = table_cache.get("services")["rows"]
+        next_cursor = None
+    else:
+        try:
+            services_data, next_cursor = table_cache.query("services")
+        except ValueError as e:
+            return table_query_error(e)
     
     return jsonify({
         "count": len(services_data),
         "services": services_data,
+        "next_cursor": next_cursor,
+        "status": "success",
+        "timestamp": time.strftime('%Y-%m-%d %H:%M:%S')
+    })
+
+@app.route('/processes', methods=['GET'])
+@handle_errors
+@rate_limited()
+def get_processes_page():
+    """Постраничный список процессов с фильтрами (limit, cursor, name~=, user=, status=, cpu>, rss>)"""
+    try:
+        rows, next_cursor = table_cache.query("processes")
+    except ValueError as e:
+        return table_query_error(e)
+    
+    return jsonify({
+        "count": len(rows),
+        "processes": [format_process_row(r) for r in rows],
+        "next_cursor": next_cursor,
         "status": "success",
         "timestamp": time.strftime('%Y-%m-%d %H:%M:%S')
     })
@@ -1128,11 +1565,20 @@ def get_full_machine_info():
 # ------------------------------------------------------------------------------------
 def main():
     logger.info(f"Запуск агента версии {config.version}, PID={os.getpid()}")
+
+    # Недокачанные файлы обновлений от прошлого запуска
+    cleanup_staged_updates()
+    # Хеш собственного файла считается один раз - проверки обновлений хешируют только скачанное
+    try:
+        running_code_hash(update_file_type() == "py")
+    except OSError as e:
+        logger.warning(f"Не удалось вычислить хеш агента: {e}")
     
     try:
         # Запуск фоновых процессов
         background_updater.start()
         user_status_updater.start()
+        threading.Thread(target=background_registry_watcher, daemon=True).start()
         
         # Настройка Flask
         app.run(
@@ -9,8 +9,32 @@ import shutil
 import requests
 import psutil
 import socket
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+import json
+import ipaddress
+import asyncio
+import zlib
+import codecs
+import mmap
+import tempfile
+import glob
+import heapq
+import bisect
+import re
 
-from flask import Flask, jsonify, abort, request
+from flask import Flask, Response, jsonify, abort, request
+from requests.adapters import HTTPAdapter
+
+try:
+    import msgpack  # необязательно: бинарный формат ответов удалённых агентов
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy as np  # необязательно: колоночный движок запросов /fleet/query
+except ImportError:
+    np = None
 
 app = Flask(__name__)
 
@@ -30,6 +54,247 @@ UPDATE_URL = "https://raw.githubusercontent.com/WrNekit/agent-updater/refs/heads
 VERISONAPP = '1.0.1'
 UPDATE_CHECK_INTERVAL = 60  # Проверяем обновления каждые 60 секунд
 
+# ------------------------------------------------------------------------------------
+#                  Реестр пользователей и хостов (индексы, горячая перезагрузка)
+# ------------------------------------------------------------------------------------
+# Файл .json или каталог с .json: список {"name": ..., "ip": ...} или {"users": [...]}.
+# В "ip" можно указать диапазон CIDR (10.0.0.0/24) - тогда запись находится по любому
+# адресу из диапазона. Если файла нет, используется список users выше.
+# Тот же блок есть в agent.py, test_connect.py и deep.py: каждый файл обновляется
+# сам по себе (UPDATE_URL) и не может зависеть от соседних модулей.
+USERS_REGISTRY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "users.json")
+REGISTRY_RELOAD_INTERVAL = 5  # как часто проверять файл реестра на изменения, сек
+
+def build_user_registry(entries, signature=None):
+    """Строит индексы реестра: по имени, по имени без учёта регистра, по IP и по сетям CIDR."""
+    registry = {
+        "signature": signature,
+        "users": [],
+        "by_name": {},
+        "by_casefold": {},
+        "by_ip": {},
+        "networks": {},  # (версия IP, длина префикса) -> {адрес сети (int): запись}
+        "network_keys": [],  # ключи networks от длинных префиксов к коротким
+    }
+    for entry in entries:
+        if not isinstance(entry, dict) or 'name' not in entry or 'ip' not in entry:
+            print(f"[WARNING] Реестр: пропущена запись без name/ip: {entry}")
+            continue
+        try:
+            network = ipaddress.ip_network(str(entry['ip']).strip(), strict=False)
+        except ValueError:
+            print(f"[WARNING] Реестр: некорректный IP у {entry['name']}: {entry['ip']}")
+            continue
+        registry["users"].append(entry)
+        registry["by_name"][entry['name']] = entry
+        registry["by_casefold"][entry['name'].casefold()] = entry
+        if network.num_addresses == 1:
+            registry["by_ip"][str(network.network_address)] = entry
+        else:
+            key = (network.version, network.prefixlen)
+            registry["networks"].setdefault(key, {})[int(network.network_address)] = entry
+    registry["network_keys"] = sorted(registry["networks"], key=lambda k: -k[1])
+    return registry
+
+def registry_signature(path):
+    """Отпечаток файла/каталога реестра (имена, mtime, размеры) для обнаружения изменений."""
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.json'))
+    elif os.path.isfile(path):
+        files = [path]
+    else:
+        return None
+    return tuple((f, os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in files)
+
+def load_registry_entries(signature):
+    entries = []
+    for path, _, _ in signature:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        entries.extend(data.get("users", []) if isinstance(data, dict) else data)
+    return entries
+
+def reload_user_registry():
+    """Перечитывает реестр, если файл изменился. Индексы подменяются целиком, без блокировок чтения."""
+    global user_registry
+    try:
+        signature = registry_signature(USERS_REGISTRY_PATH)
+        if signature == user_registry["signature"]:
+            return False
+        entries = load_registry_entries(signature) if signature else users
+        user_registry = build_user_registry(entries, signature)
+        print(f"[INFO] Реестр пользователей загружен: {len(user_registry['users'])} записей")
+        return True
+    except Exception as e:
+        print("[ERROR] Не удалось загрузить реестр пользователей:", e)
+        return False
+
+def find_user(name, casefold=False):
+    """O(1) поиск записи по имени (casefold=True - без учёта регистра)."""
+    if casefold:
+        return user_registry["by_casefold"].get(name.casefold())
+    return user_registry["by_name"].get(name)
+
+def find_user_by_ip(ip):
+    """Поиск по точному IP, затем по самому длинному подходящему префиксу CIDR."""
+    registry = user_registry
+    entry = registry["by_ip"].get(ip)
+    if entry is not None or not registry["networks"]:
+        return entry
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    bits = addr.max_prefixlen
+    for version, prefixlen in registry["network_keys"]:
+        if version != addr.version:
+            continue
+        network_int = int(addr) >> (bits - prefixlen) << (bits - prefixlen)
+        entry = registry["networks"][(version, prefixlen)].get(network_int)
+        if entry is not None:
+            return entry
+    return None
+
+def user_host(entry):
+    """Адрес хоста записи ("10.0.0.5", в т.ч. из "10.0.0.5/32") или None, если запись - диапазон CIDR."""
+    try:
+        network = ipaddress.ip_network(str(entry['ip']).strip(), strict=False)
+    except ValueError:
+        return None
+    return str(network.network_address) if network.num_addresses == 1 else None
+
+def background_registry_watcher():
+    while True:
+        time.sleep(REGISTRY_RELOAD_INTERVAL)
+        reload_user_registry()
+
+user_registry = build_user_registry(users)
+reload_user_registry()
+
+# ------------------------------------------------------------------------------------
+#        Обнаружение агентов: таблица участников по UDP-анонсам (с TTL)
+# ------------------------------------------------------------------------------------
+# Агенты (agent.py, AGENT_DISCOVERY / AGENT_DISCOVERY_SEEDS) раз в несколько секунд
+# присылают анонс {"type": "agent-announce", "name", "ip", "port", "version",
+# "capabilities", "instance", "ttl"}. Запись живёт ttl секунд после последнего анонса.
+DISCOVERY_MODE = os.environ.get("FLEET_DISCOVERY")  # "multicast" | "broadcast" | "seed" | None - выключено
+DISCOVERY_GROUP = "239.255.42.99"
+DISCOVERY_PORT = int(os.environ.get("FLEET_DISCOVERY_PORT", 50000))
+DISCOVERY_INTERFACE = os.environ.get("FLEET_DISCOVERY_INTERFACE", "0.0.0.0")  # интерфейс для multicast
+DISCOVERY_MEMBER_TTL = 15        # если анонс не указал свой ttl
+DISCOVERY_MAX_TTL = 300
+DISCOVERY_MAX_MEMBERS = 10000
+
+members = {}  # (ip, port) -> запись участника
+members_by_name = {}      # имя -> (ip, port) последнего приславшего анонс с этим именем
+members_by_casefold = {}  # имя без учёта регистра -> (ip, port)
+members_lock = threading.Lock()
+
+def index_member(key, name):
+    """Индексы по имени для O(1) find_member. Вызывать под members_lock."""
+    members_by_name[name] = key
+    members_by_casefold[name.casefold()] = key
+
+def unindex_member(key, name):
+    """Убирает имя из индексов, если оно указывает на этого участника. Вызывать под members_lock."""
+    if members_by_name.get(name) == key:
+        del members_by_name[name]
+    if members_by_casefold.get(name.casefold()) == key:
+        del members_by_casefold[name.casefold()]
+
+def drop_member(key):
+    """Удаляет участника и его записи в индексах. Вызывать под members_lock."""
+    record = members.pop(key, None)
+    if record is not None:
+        unindex_member(key, record["name"])
+
+def handle_announcement(payload: bytes, addr):
+    """
+    Разбирает анонс и обновляет таблицу участников. Некорректные анонсы игнорируются.
+    Адрес участника - адрес отправителя датаграммы: "ip" из анонса только сохраняется,
+    иначе любой отправитель мог бы заставить агрегатор опрашивать произвольный хост.
+    """
+    try:
+        message = json.loads(payload)
+        if message.get("type") != "agent-announce" or not isinstance(message.get("name"), str):
+            return False
+        ip = str(ipaddress.ip_address(addr[0]))
+        port = int(message.get("port", 5000))
+        if not 0 < port < 65536:
+            return False
+        ttl = min(DISCOVERY_MAX_TTL, max(1, float(message.get("ttl", DISCOVERY_MEMBER_TTL))))
+    except (ValueError, TypeError, AttributeError):
+        return False
+    now = time.time()
+    key = (ip, port)
+    with members_lock:
+        record = members.get(key)
+        if record is None:
+            if len(members) >= DISCOVERY_MAX_MEMBERS:
+                return False
+            record = members[key] = {"first_seen": now, "name": message["name"]}
+            print(f"[INFO] Обнаружен агент {message['name']} {ip}:{port}")
+        elif record["name"] != message["name"]:
+            unindex_member(key, record["name"])  # агент сменил имя
+        index_member(key, message["name"])
+        record.update({
+            "name": message["name"],
+            "ip": ip,
+            "port": port,
+            "advertised_ip": message.get("ip"),
+            "version": message.get("version"),
+            "capabilities": message.get("capabilities", []),
+            "instance": message.get("instance"),
+            "source": f"{addr[0]}:{addr[1]}",
+            "last_seen": now,
+            "expires": now + ttl,
+        })
+    return True
+
+def live_members():
+    """Живые участники; просроченные записи удаляются."""
+    now = time.time()
+    with members_lock:
+        for key in [k for k, m in members.items() if m["expires"] <= now]:
+            print(f"[INFO] Агент {members[key]['name']} {key[0]}:{key[1]} пропал (TTL)")
+            drop_member(key)
+        return [dict(m) for m in members.values()]
+
+def find_member(name, casefold=False):
+    """O(1) поиск живого обнаруженного агента по имени (casefold=True - без учёта регистра)."""
+    with members_lock:
+        if casefold:
+            key = members_by_casefold.get(name.casefold())
+        else:
+            key = members_by_name.get(name)
+        member = members.get(key)
+        if member is None or member["expires"] <= time.time():
+            return None
+        return dict(member)
+
+def discovery_socket():
+    """UDP-сокет на DISCOVERY_PORT; в режиме multicast - с подпиской на группу."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind(("", DISCOVERY_PORT))
+    if DISCOVERY_MODE == "multicast":
+        membership = socket.inet_aton(DISCOVERY_GROUP) + socket.inet_aton(DISCOVERY_INTERFACE)
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    return s
+
+def background_discovery_listener():
+    s = discovery_socket()
+    print(f"[INFO] Обнаружение агентов ({DISCOVERY_MODE}) на UDP {DISCOVERY_PORT}")
+    while True:
+        try:
+            payload, addr = s.recvfrom(65535)
+            handle_announcement(payload, addr)
+        except OSError as e:
+            print("[ERROR] Обнаружение агентов:", e)
+            time.sleep(1)
+
 # ------------------------------------------------------------------------------------
 #                      Определение локального IP, проверка
 # ------------------------------------------------------------------------------------
@@ -96,62 +361,239 @@ def normalize_code(data):
 # ------------------------------------------------------------------------------------
 #            Сравнение хэша текущего файла с загруженными данными
 # ------------------------------------------------------------------------------------
-def code_has_changed(new_data, is_py=False):
+# Путь к файлу запущенного агента (для сравнения хэшей при обновлении)
+RUNNING_FILE = os.path.abspath(sys.argv[0])
+
+# Потоковый хэш кода: файл читается кусками HASH_CHUNK_SIZE (большие бинарники - через mmap),
+# для .py нормализация normalize_code() выполняется построчно на лету.
+# Тот же конвейер (хэш, валидаторы, промежуточный файл) есть в agent.py, test_connect.py и deep.py:
+# каждый файл обновляется сам по себе (UPDATE_URL) и не может зависеть от соседних модулей.
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_MMAP_MIN_SIZE = 16 * 1024 * 1024
+
+def new_code_hasher(is_py):
     """
-    Сравниваем хэш текущего (exe или py) с new_data.
-    Если is_py=True, нормализуем \n внутри.
+    Состояние потокового хэша. Результат совпадает с compute_hash(normalize_code(data)) для .py
+    и с compute_hash(data) для бинарников; если .py - не UTF-8, хэшируются сырые байты, как в normalize_code().
     """
+    return {
+        "raw": hashlib.sha256(),
+        "norm": hashlib.sha256() if is_py else None,
+        "decoder": codecs.getincrementaldecoder("utf-8")(),
+        "tail": "",       # незавершённая строка с конца предыдущего куска
+        "blank": 0,       # пустые строки, ещё не записанные в хэш (хвостовые отбрасываются, как strip())
+        "started": False, # встретилась ли первая непустая строка (ведущие пробелы отбрасываются)
+    }
+
+def code_hasher_line(state, line):
+    line = line.rstrip()
+    if not state["started"]:
+        line = line.lstrip()
+        if not line:
+            return
+        state["started"] = True
+        state["norm"].update(line.encode("utf-8"))
+    elif not line:
+        state["blank"] += 1
+    else:
+        state["norm"].update(("\n" * (state["blank"] + 1) + line).encode("utf-8"))
+        state["blank"] = 0
+
+def code_hasher_update(state, chunk):
+    state["raw"].update(chunk)
+    if state["norm"] is None:
+        return
     try:
-        current_file = os.path.abspath(sys.argv[0])
-        with open(current_file, "rb") as f:
-            current_data = f.read()
+        text = state["tail"] + state["decoder"].decode(chunk)
+    except UnicodeDecodeError:
+        state["norm"] = None
+        return
+    lines = text.split("\n")
+    state["tail"] = lines.pop()
+    for line in lines:
+        code_hasher_line(state, line)
 
-        if is_py:
-            old_norm = normalize_code(current_data)
-            new_norm = normalize_code(new_data)
+def code_hasher_digest(state):
+    if state["norm"] is not None:
+        try:
+            tail = state["tail"] + state["decoder"].decode(b"", final=True)
+        except UnicodeDecodeError:
+            state["norm"] = None
+        else:
+            state["tail"] = ""
+            code_hasher_line(state, tail)
+    return (state["norm"] or state["raw"]).hexdigest()
+
+def file_code_hash(path, is_py):
+    """Хэш файла без чтения его целиком в память."""
+    state = new_code_hasher(is_py)
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not is_py and size >= HASH_MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                code_hasher_update(state, mapped)
         else:
-            old_norm = current_data
-            new_norm = new_data
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                code_hasher_update(state, chunk)
+    return code_hasher_digest(state)
+
+# Хэш файла запущенного агента по режиму сравнения (is_py) вместе с (mtime_ns, размер),
+# при которых он посчитан: файл перечитывается, только если он изменился на диске.
+running_hash_cache = {}
+running_hash_lock = threading.Lock()
+
+def running_code_hash(is_py):
+    stamp = running_file_stamp()
+    if stamp is None:
+        raise FileNotFoundError(RUNNING_FILE)
+    with running_hash_lock:
+        cached = running_hash_cache.get(is_py)
+        if cached and cached["stamp"] == stamp:
+            return cached["hash"]
+        digest = file_code_hash(RUNNING_FILE, is_py)
+        running_hash_cache[is_py] = {"stamp": stamp, "hash": digest}
+        return digest
 
-        old_hash = compute_hash(old_norm)
-        new_hash = compute_hash(new_norm)
+def code_has_changed(new_hash, is_py=False):
+    """
+    Сравниваем хэш текущего (exe или py) с хэшем скачанного new_hash
+    (для is_py=True оба посчитаны по нормализованному коду). Хэш текущего файла берётся из кэша.
+    """
+    try:
+        old_hash = running_code_hash(is_py)
         changed = (old_hash != new_hash)
         return changed, old_hash, new_hash
     except FileNotFoundError:
         print("[INFO] Текущий файл не найден — считаем, что код изменился.")
-        return True, None, None
+        return True, None, new_hash
     except Exception as e:
         print("[ERROR] code_has_changed:", e)
-        return True, None, None
+        return True, None, new_hash
+
+# Валидаторы HTTP-кэша (ETag / Last-Modified) по URL обновления, сохраняются между
+# перезапусками. Запоминаются, только когда загруженный файл совпал с текущим, и
+# действуют, пока текущий файл не изменился (mtime и размер) - поэтому ответ 304
+# всегда означает "обновлений нет".
+UPDATE_VALIDATORS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "update_validators.json")
+
+def load_update_validators():
+    try:
+        with open(UPDATE_VALIDATORS_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_update_validators(validators):
+    tmp_path = UPDATE_VALIDATORS_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(validators, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, UPDATE_VALIDATORS_PATH)
+    except OSError as e:
+        print("[WARNING] Не удалось сохранить валидаторы обновлений:", e)
+
+def running_file_stamp():
+    """(mtime_ns, размер) файла запущенного агента."""
+    try:
+        st = os.stat(RUNNING_FILE)
+        return [st.st_mtime_ns, st.st_size]
+    except OSError:
+        return None
+
+def conditional_update_headers(url):
+    """If-None-Match / If-Modified-Since для url, если валидаторы относятся к текущему файлу агента."""
+    record = load_update_validators().get(url)
+    if not record or record.get("local") != running_file_stamp():
+        return {}
+    headers = {}
+    if record.get("etag"):
+        headers["If-None-Match"] = record["etag"]
+    if record.get("last_modified"):
+        headers["If-Modified-Since"] = record["last_modified"]
+    return headers
+
+def remember_update_validators(url, resp):
+    """Сохраняет ETag/Last-Modified ответа url (вызывать, только если файл не отличается от текущего)."""
+    etag, last_modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    validators = load_update_validators()
+    if not etag and not last_modified:
+        if validators.pop(url, None) is None:
+            return
+    else:
+        validators[url] = {"etag": etag, "last_modified": last_modified, "local": running_file_stamp()}
+    save_update_validators(validators)
 
 # ------------------------------------------------------------------------------------
 #                         Проверка наличия обновлений
 # ------------------------------------------------------------------------------------
+def update_file_type():
+    """Тип файла обновления по UPDATE_URL: "exe" или "py"."""
+    lower_url = UPDATE_URL.lower()
+    if lower_url.endswith(".exe"):
+        return "exe"
+    elif lower_url.endswith(".py"):
+        return "py"
+    return "exe"  # по умолчанию (если расширение непонятно)
+
+def stage_update(resp, file_type):
+    """
+    Пишет тело ответа кусками в промежуточный файл рядом с агентом, по ходу считая хэш кода.
+    Возвращает (путь, хэш); целиком файл в памяти не держится.
+    """
+    cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    fd, staged_path = tempfile.mkstemp(prefix="agent_update_", suffix=".part", dir=cdir)
+    state = new_code_hasher(file_type == "py")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in resp.iter_content(HASH_CHUNK_SIZE):
+                f.write(chunk)
+                code_hasher_update(state, chunk)
+        # mkstemp создаёт файл с правами 0o600; ставим те же, что дал бы open("wb")
+        os.chmod(staged_path, default_file_mode())
+    except BaseException:
+        discard_staged_update(staged_path)
+        raise
+    return staged_path, code_hasher_digest(state)
+
+def discard_staged_update(staged_path):
+    try:
+        os.remove(staged_path)
+    except OSError:
+        pass
+
+def default_file_mode():
+    """Права нового файла по умолчанию: 0o666 без битов umask."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def cleanup_staged_updates():
+    """Удаляет промежуточные файлы обновлений, оставшиеся от загрузки, прерванной падением или перезапуском."""
+    cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
+    for path in glob.glob(os.path.join(cdir, "agent_update_*.part")):
+        discard_staged_update(path)
+
 def check_for_updates():
     """
-    1) Скачивает UPDATE_URL (exe или py).
+    1) Скачивает UPDATE_URL (exe или py) один раз, потоком в промежуточный файл.
     2) Сравнивает хэши.
-    3) Возвращает {"update_available": bool, "file_type": "exe"/"py", ...}
+    3) Возвращает {"update_available": bool, "file_type": "exe"/"py", "staged_path": ..., ...}
     """
     try:
-        lower_url = UPDATE_URL.lower()
-        if lower_url.endswith(".exe"):
-            file_type = "exe"
-        elif lower_url.endswith(".py"):
-            file_type = "py"
-        else:
-            file_type = "exe"  # по умолчанию (если расширение непонятно)
+        file_type = update_file_type()
 
-        resp = requests.get(UPDATE_URL, timeout=30)
-        if resp.status_code != 200:
-            print("[ERROR] check_for_updates:", resp.status_code)
-            return {"update_available": False, "error": f"HTTP {resp.status_code}"}
+        with requests.get(UPDATE_URL, timeout=30, stream=True,
+                          headers=conditional_update_headers(UPDATE_URL)) as resp:
+            if resp.status_code == 304:
+                # Файл на сервере не менялся с последней проверки, совпавшей с текущим файлом
+                return {"update_available": False, "not_modified": True}
+            if resp.status_code != 200:
+                print("[ERROR] check_for_updates:", resp.status_code)
+                return {"update_available": False, "error": f"HTTP {resp.status_code}"}
+            staged_path, new_hash = stage_update(resp, file_type)
 
-        new_data = resp.content
-        if file_type == "py":
-            changed, old_hash, new_hash = code_has_changed(new_data, is_py=True)
-        else:
-            changed, old_hash, new_hash = code_has_changed(new_data, is_py=False)
+        changed, old_hash, new_hash = code_has_changed(new_hash, is_py=(file_type == "py"))
 
         if changed:
             return {
@@ -159,34 +601,27 @@ def check_for_updates():
                 "file_type": file_type,
                 "old_hash": old_hash,
                 "new_hash": new_hash,
-                "update_url": UPDATE_URL
+                "update_url": UPDATE_URL,
+                "staged_path": staged_path
             }
         else:
+            discard_staged_update(staged_path)
+            remember_update_validators(UPDATE_URL, resp)
             return {"update_available": False}
     except Exception as e:
         print("[ERROR] check_for_updates exception:", e)
         return {"update_available": False, "error": str(e)}
 
 # ------------------------------------------------------------------------------------
-#      Сценарий 1: обновление, если скачиваем готовый .exe (без перекомпиляции)
+#      Сценарий 1: обновление, если скачан готовый .exe (без перекомпиляции)
 # ------------------------------------------------------------------------------------
-def perform_update_exe_direct(update_url):
-    print("[INFO] Обновление: скачиваем .exe:", update_url)
+def perform_update_exe_direct(staged_path):
+    print("[INFO] Обновление: устанавливаем скачанный .exe:", staged_path)
     try:
-        resp = requests.get(update_url, timeout=30)
-        if resp.status_code != 200:
-            return {"success": False, "message": f"HTTP {resp.status_code}"}
-
-        new_data = resp.content
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=False)
-        if not changed:
-            return {"success": False, "message": "Файл .exe не изменился."}
-
         cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
         stamp = time.strftime("%Y%m%d%H%M%S")
         new_exe = os.path.join(cdir, f"agent_new_{stamp}.exe")
-        with open(new_exe, "wb") as f:
-            f.write(new_data)
+        os.replace(staged_path, new_exe)
         print("[INFO] Новый exe сохранён:", new_exe)
 
         # Запуск
@@ -201,25 +636,15 @@ def perform_update_exe_direct(update_url):
         return {"success": False, "message": str(e)}
 
 # ------------------------------------------------------------------------------------
-#      Сценарий 2: скачиваем .py и компилируем в .exe (если агент .exe)
+#      Сценарий 2: скачанный .py компилируем в .exe (если агент .exe)
 # ------------------------------------------------------------------------------------
-def perform_update_compile_py(update_url):
-    print("[INFO] Скачиваем .py -> компилируем PyInstaller.")
+def perform_update_compile_py(staged_path):
+    print("[INFO] Скачанный .py -> компилируем PyInstaller.")
     try:
-        resp = requests.get(update_url, timeout=30)
-        if resp.status_code != 200:
-            return {"success": False, "message": f"HTTP {resp.status_code}"}
-
-        new_data = resp.content
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=True)
-        if not changed:
-            return {"success": False, "message": "Исходный .py не изменился."}
-
         cdir = os.path.dirname(os.path.abspath(sys.argv[0]))
         stamp = time.strftime("%Y%m%d%H%M%S")
         new_py = os.path.join(cdir, f"agent_new_{stamp}.py")
-        with open(new_py, "wb") as f:
-            f.write(new_data)
+        os.replace(staged_path, new_py)
 
         compile_cmd = [sys.executable, "-m", "PyInstaller", "--onefile", "--noconsole", new_py]
         res = subprocess.run(compile_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
@@ -245,26 +670,16 @@ def perform_update_compile_py(update_url):
 # ------------------------------------------------------------------------------------
 #      Сценарий 3: если сам агент .py, а репо тоже .py (скриптовая замена)
 # ------------------------------------------------------------------------------------
-def perform_update_script_py(update_url):
-    print("[INFO] Скачиваем новый .py (скриптовый режим).")
+def perform_update_script_py(staged_path):
+    print("[INFO] Устанавливаем новый .py (скриптовый режим).")
     try:
-        resp = requests.get(update_url, timeout=30)
-        if resp.status_code != 200:
-            return {"success": False, "message": f"HTTP {resp.status_code}"}
-
-        new_data = resp.content
-        changed, old_hash, new_hash = code_has_changed(new_data, is_py=True)
-        if not changed:
-            return {"success": False, "message": "Новый скрипт не отличается."}
-
         cfile = os.path.abspath(sys.argv[0])
         cdir = os.path.dirname(cfile)
         stamp = time.strftime("%Y%m%d%H%M%S")
         new_py = os.path.join(cdir, f"agent_new_{stamp}.py")
         backup_py = os.path.join(cdir, f"agent_backup_{stamp}.py")
 
-        with open(new_py, "wb") as f:
-            f.write(new_data)
+        os.replace(staged_path, new_py)
         shutil.move(cfile, backup_py)
 
         new_proc = subprocess.Popen([sys.executable, new_py], creationflags=subprocess.CREATE_NEW_PROCESS_GROUP, close_fds=True)
@@ -278,24 +693,32 @@ def perform_update_script_py(update_url):
 # ------------------------------------------------------------------------------------
 #                Единая точка вызова обновления
 # ------------------------------------------------------------------------------------
-def do_update_if_available():
-    info = check_for_updates()
-    if not info.get("update_available"):
-        return {"success": False, "message": "Обновлений не обнаружено"}
-
+def apply_update(info):
+    """
+    Применяет файл, скачанный check_for_updates() (info["staged_path"]).
+    Хэш этого файла уже посчитан в stage_update() по мере записи, второй раз файл не читается.
+    """
+    staged_path = info["staged_path"]
     ftype = info["file_type"]
     if ftype == "exe":
-        if is_compiled():
-            return perform_update_exe_direct(info["update_url"])
-        else:
+        if not is_compiled():
             print("[WARNING] Агент .py, но обновление .exe. Запуск .exe напрямую.")
-            return perform_update_exe_direct(info["update_url"])
+        result = perform_update_exe_direct(staged_path)
     else:
         # file_type == "py"
         if is_compiled():
-            return perform_update_compile_py(info["update_url"])
+            result = perform_update_compile_py(staged_path)
         else:
-            return perform_update_script_py(info["update_url"])
+            result = perform_update_script_py(staged_path)
+    # Сюда попадаем, только если обновиться не удалось
+    discard_staged_update(staged_path)
+    return result
+
+def do_update_if_available():
+    info = check_for_updates()
+    if not info.get("update_available"):
+        return {"success": False, "message": "Обновлений не обнаружено"}
+    return apply_update(info)
 
 # ------------------------------------------------------------------------------------
 #                        Получение (локальных) метрик
@@ -374,22 +797,1147 @@ def get_local_services():
 # ------------------------------------------------------------------------------------
 #             Запросы к удалённому агенту (если IP не локальный)
 # ------------------------------------------------------------------------------------
-def fetch_remote_json(ip: str, path: str):
+# Компактные форматы агента (см. agent.py): списки объектов передаются как
+# параллельные массивы {"$cols": {...}}; msgpack - если библиотека установлена.
+COLUMNAR_MIMETYPE = "application/x-agent-columnar+json"
+MSGPACK_MIMETYPE = "application/msgpack"
+REMOTE_ACCEPT = ", ".join(
+    ([MSGPACK_MIMETYPE] if msgpack else []) + [f"{COLUMNAR_MIMETYPE};q=0.9", "application/json;q=0.5"]
+)
+
+def from_columnar(data):
+    """{"$cols": {"pid": [...], "name": [...]}} -> список словарей (рекурсивно)."""
+    if isinstance(data, dict):
+        if len(data) == 1 and "$cols" in data:
+            columns = data["$cols"]
+            count = len(next(iter(columns.values()), []))
+            return [{key: from_columnar(values[i]) for key, values in columns.items()} for i in range(count)]
+        return {key: from_columnar(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [from_columnar(item) for item in data]
+    return data
+
+def decode_remote_payload(content_type, content):
+    """Декодирует тело ответа агента по Content-Type (msgpack / колоночный JSON / JSON)."""
+    content_type = content_type.split(";")[0].strip()
+    if content_type == MSGPACK_MIMETYPE and msgpack:
+        return from_columnar(msgpack.unpackb(content, raw=False))
+    if content_type == COLUMNAR_MIMETYPE:
+        return from_columnar(json.loads(content))
+    return json.loads(content)
+
+def decode_remote_body(resp):
+    """Декодирует ответ requests от агента."""
+    return decode_remote_payload(resp.headers.get("Content-Type", ""), resp.content)
+
+# ------------------------------------------------------------------------------------
+#       Здоровье агентов и circuit breaker (closed / open / half-open)
+# ------------------------------------------------------------------------------------
+# closed    - запросы идут как обычно;
+# open      - после BREAKER_FAILURE_THRESHOLD ошибок подряд запросы к хосту сразу
+#             возвращают ошибку, не дожидаясь таймаута;
+# half-open - через BREAKER_OPEN_SECONDS один пробный запрос (обычно фоновый зонд
+#             /version): успех закрывает автомат, ошибка снова открывает.
+HEALTH_EWMA_ALPHA = 0.3          # вес нового замера в скользящей средней задержки
+BREAKER_FAILURE_THRESHOLD = 3    # ошибок подряд до открытия
+BREAKER_OPEN_SECONDS = 30        # сколько держать открытым до пробного запроса
+HEALTH_PROBE_INTERVAL = 5        # как часто фоновый зонд проверяет открытые хосты
+HEALTH_PROBE_PATH = "version"
+
+host_health = {}  # "ip:port" (host_key) -> состояние (см. new_host_health)
+host_health_lock = threading.Lock()
+
+def host_key(ip: str, port=None) -> str:
+    """Ключ агента в host_health и пуле сессий: на одном IP может быть несколько агентов на разных портах."""
+    return f"{ip}:{port or REMOTE_AGENT_PORT}"
+
+def new_host_health():
+    return {
+        "state": "closed",
+        "latency_ewma_ms": None,
+        "consecutive_failures": 0,
+        "last_success": None,
+        "last_failure": None,
+        "last_error": None,
+        "opened_at": None,
+        "requests": 0,
+        "failures": 0,
+    }
+
+def breaker_allows(key: str) -> bool:
+    """Можно ли сейчас обращаться к агенту key (host_key). Открытый автомат по истечении паузы пропускает один пробный запрос."""
+    with host_health_lock:
+        health = host_health.get(key)
+        if health is None or health["state"] == "closed":
+            return True
+        if health["state"] == "open" and time.time() - health["opened_at"] >= BREAKER_OPEN_SECONDS:
+            health["state"] = "half-open"
+            return True
+        return False
+
+def record_host_result(key: str, ok: bool, latency: float, error=None):
+    """Учитывает исход запроса к агенту key (host_key; latency - секунды) и переключает автомат."""
+    now = time.time()
+    with host_health_lock:
+        health = host_health.setdefault(key, new_host_health())
+        health["requests"] += 1
+        if ok:
+            latency_ms = latency * 1000
+            previous = health["latency_ewma_ms"]
+            health["latency_ewma_ms"] = round(latency_ms if previous is None
+                                              else previous + HEALTH_EWMA_ALPHA * (latency_ms - previous), 1)
+            health["consecutive_failures"] = 0
+            health["last_success"] = now
+            health["state"], health["opened_at"] = "closed", None
+        else:
+            health["failures"] += 1
+            health["consecutive_failures"] += 1
+            health["last_failure"], health["last_error"] = now, error
+            if health["state"] == "half-open" or health["consecutive_failures"] >= BREAKER_FAILURE_THRESHOLD:
+                health["state"], health["opened_at"] = "open", now
+
+def circuit_open_error(key: str):
+    return {"error": f"Circuit open: agent {key} is unavailable, retry after probe"}
+
+def background_health_prober():
+    """Пробует открытые хосты лёгким запросом, чтобы автомат закрывался без пользовательского трафика."""
+    while True:
+        time.sleep(HEALTH_PROBE_INTERVAL)
+        now = time.time()
+        with host_health_lock:
+            due = [key for key, h in host_health.items()
+                   if h["state"] == "open" and now - h["opened_at"] >= BREAKER_OPEN_SECONDS]
+        for key in due:
+            ip, _, port = key.rpartition(":")
+            remote_refresh_executor.submit(fetch_remote_json, ip, HEALTH_PROBE_PATH,
+                                           (REMOTE_CONNECT_TIMEOUT, REMOTE_CONNECT_TIMEOUT), int(port))
+
+# ------------------------------------------------------------------------------------
+#        Пул keep-alive соединений к удалённым агентам (по сессии на ip:port)
+# ------------------------------------------------------------------------------------
+REMOTE_AGENT_PORT = 5000
+REMOTE_CONNECT_TIMEOUT = 2      # сек на установку TCP-соединения
+REMOTE_READ_TIMEOUT = 5         # сек на ответ
+REMOTE_POOL_MAXSIZE = 8         # keep-alive соединений на один агент
+REMOTE_POOL_MAX_HOSTS = 4096    # минимум сессий (агентов) одновременно; больше - по размеру реестра
+REMOTE_SESSION_IDLE_TTL = 60    # сессия без запросов дольше N сек закрывается
+
+remote_sessions = OrderedDict()  # "ip:port" -> [requests.Session, время последнего использования]
+remote_sessions_lock = threading.Lock()
+
+def is_local_host(ip: str, port=None) -> bool:
+    """Локальный ли агент: наш IP и наш порт (агент на другом порту этой машины - удалённый)."""
+    return is_local_ip(ip) and (port or REMOTE_AGENT_PORT) == REMOTE_AGENT_PORT
+
+def remote_pool_max_hosts():
+    """Сколько сессий держать: по одной на каждый хост реестра и обнаруженный агент, не меньше REMOTE_POOL_MAX_HOSTS."""
+    return max(REMOTE_POOL_MAX_HOSTS, len(user_registry["by_ip"]) + len(members))
+
+def get_remote_session(netloc: str):
+    """
+    Сессия requests с пулом соединений к netloc ("ip:port"). Сессии лежат в порядке
+    последнего использования: простаивающие дольше REMOTE_SESSION_IDLE_TTL
+    и лишние сверх remote_pool_max_hosts() закрываются - опрос всего парка
+    не вытесняет собственные keep-alive соединения.
+    """
+    now = time.time()
+    max_hosts = remote_pool_max_hosts()
+    to_close = []
+    with remote_sessions_lock:
+        entry = remote_sessions.get(netloc)
+        if entry is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=REMOTE_POOL_MAXSIZE, max_retries=0)
+            session.mount("http://", adapter)
+            entry = [session, now]
+            remote_sessions[netloc] = entry
+        else:
+            entry[1] = now
+            remote_sessions.move_to_end(netloc)
+        while remote_sessions:
+            oldest_netloc, (oldest, last_used) = next(iter(remote_sessions.items()))
+            if oldest_netloc == netloc or (len(remote_sessions) <= max_hosts
+                                   and now - last_used <= REMOTE_SESSION_IDLE_TTL):
+                break
+            remote_sessions.popitem(last=False)
+            to_close.append(oldest)
+    for session in to_close:
+        session.close()
+    return entry[0]
+
+def fetch_remote_json(ip: str, path: str, timeout=None, port=None):
     """
     Общая функция для похода к удалённому агенту:
-      GET http://<ip>:5000/<path>
+      GET http://<ip>:<port>/<path> (по умолчанию порт REMOTE_AGENT_PORT)
+    Соединение берётся из пула keep-alive для этого агента.
+    Запрашивает компактный формат (Accept), старые агенты отвечают обычным JSON.
+    timeout - (connect, read); по умолчанию REMOTE_CONNECT_TIMEOUT/REMOTE_READ_TIMEOUT.
+    Исход учитывается в host_health; при открытом автомате ошибка возвращается сразу.
     Возвращает dict (JSON) или {"error": "..."}
     """
-    url = f"http://{ip}:5000/{path}"
+    key = host_key(ip, port)
+    if not breaker_allows(key):
+        return circuit_open_error(key)
+    url = f"http://{key}/{path}"
+    started = time.time()
+    try:
+        resp = get_remote_session(key).get(
+            url,
+            timeout=timeout or (REMOTE_CONNECT_TIMEOUT, REMOTE_READ_TIMEOUT),
+            headers={"Accept": REMOTE_ACCEPT}
+        )
+    except Exception as e:
+        record_host_result(key, False, time.time() - started, str(e))
+        return {"error": str(e)}
+    # 5xx - агент жив, но неисправен; прочие коды считаем признаком живого хоста
+    record_host_result(key, resp.status_code < 500, time.time() - started, f"HTTP {resp.status_code}")
     try:
-        resp = requests.get(url, timeout=5)
         if resp.status_code == 200:
-            return resp.json()
+            return decode_remote_body(resp)
         else:
             return {"error": f"Remote agent HTTP {resp.status_code}"}
     except Exception as e:
         return {"error": str(e)}
 
+# ------------------------------------------------------------------------------------
+#      Кэш ответов агентов: TTL, общая загрузка на ключ, stale-while-revalidate
+# ------------------------------------------------------------------------------------
+REMOTE_CACHE_TTL = 2            # сек: ответ считается свежим
+REMOTE_CACHE_STALE = 30         # сек после TTL: устаревший ответ отдаётся сразу, пока идёт обновление
+REMOTE_CACHE_MAX_ENTRIES = 4096
+REMOTE_REFRESH_WORKERS = 16     # потоки фоновых загрузок в кэш
+REMOTE_PREFETCH_INTERVAL = 0    # >0 - каждые N сек прогревать кэш для всех хостов реестра (0 - выключено)
+REMOTE_PREFETCH_PATHS = ("metrics",)
+
+remote_cache = OrderedDict()  # (ip, port, path) -> {"time": время загрузки или None, "data": ..., "future": загрузка или None}
+remote_cache_lock = threading.Lock()
+remote_refresh_executor = ThreadPoolExecutor(max_workers=REMOTE_REFRESH_WORKERS, thread_name_prefix="remote-refresh")
+
+def refresh_remote_entry(ip: str, path: str, timeout=None, port=None):
+    """Загружает (ip, port, path) и кладёт в кэш. Ошибки не кэшируются, но возвращаются всем ожидающим."""
+    data = fetch_remote_json(ip, path, timeout, port)
+    with remote_cache_lock:
+        entry = remote_cache.get((ip, port or REMOTE_AGENT_PORT, path))
+        if entry is not None:
+            entry["future"] = None
+            if not (isinstance(data, dict) and "error" in data):
+                entry["data"], entry["time"] = data, time.time()
+    return data
+
+def start_remote_refresh(ip: str, path: str, timeout=None, port=None):
+    """Запускает загрузку ключа, если она ещё не идёт; возвращает (запись, future). Вызывать под remote_cache_lock."""
+    key = (ip, port or REMOTE_AGENT_PORT, path)
+    entry = remote_cache.get(key)
+    if entry is None:
+        entry = remote_cache[key] = {"time": None, "data": None, "future": None}
+        while len(remote_cache) > REMOTE_CACHE_MAX_ENTRIES:
+            remote_cache.popitem(last=False)
+    else:
+        remote_cache.move_to_end(key)
+    if entry["future"] is None:
+        entry["future"] = remote_refresh_executor.submit(refresh_remote_entry, ip, path, timeout, port)
+    return entry, entry["future"]
+
+def cached_remote_json(ip: str, path: str, timeout=None, port=None):
+    """
+    fetch_remote_json через кэш:
+      - ответ моложе REMOTE_CACHE_TTL отдаётся сразу, без запроса к агенту;
+      - устаревший, но моложе TTL + REMOTE_CACHE_STALE, тоже отдаётся сразу,
+        а в фоне запускается одно обновление на ключ;
+      - иначе ждём загрузку; одновременные запросы того же ключа ждут одну и ту же.
+    """
+    now = time.time()
+    key = (ip, port or REMOTE_AGENT_PORT, path)
+    with remote_cache_lock:
+        entry = remote_cache.get(key)
+        if entry is not None and entry["time"] is not None and now - entry["time"] < REMOTE_CACHE_TTL:
+            remote_cache.move_to_end(key)
+            return entry["data"]
+        entry, future = start_remote_refresh(ip, path, timeout, port)
+        if entry["time"] is not None and now - entry["time"] < REMOTE_CACHE_TTL + REMOTE_CACHE_STALE:
+            return entry["data"]
+    return future.result()
+
+def background_remote_prefetch():
+    """Держит кэш тёплым: обновляет REMOTE_PREFETCH_PATHS всех удалённых хостов реестра, не дожидаясь ответов."""
+    while True:
+        now = time.time()
+        with remote_cache_lock:
+            for ip, user in list(user_registry["by_ip"].items()):
+                port = user.get("port", REMOTE_AGENT_PORT)  # тот же ключ, что у запросов /connect
+                if is_local_host(ip, port):
+                    continue
+                for path in REMOTE_PREFETCH_PATHS:
+                    entry = remote_cache.get((ip, port, path))
+                    if entry is None or entry["time"] is None or now - entry["time"] >= REMOTE_PREFETCH_INTERVAL:
+                        start_remote_refresh(ip, path, port=port)
+        time.sleep(REMOTE_PREFETCH_INTERVAL)
+
+# ------------------------------------------------------------------------------------
+#        Параллельные запросы к одному агенту с общим дедлайном
+# ------------------------------------------------------------------------------------
+REMOTE_REQUEST_DEADLINE = 6    # сек на весь составной ответ (все части вместе)
+REMOTE_FANOUT_WORKERS = 32     # общий пул потоков для параллельных подзапросов
+
+remote_executor = ThreadPoolExecutor(max_workers=REMOTE_FANOUT_WORKERS, thread_name_prefix="remote")
+
+def fetch_remote_parts(ip: str, parts: dict, deadline: float = None, port=None):
+    """
+    Параллельно запрашивает у агента ip:port несколько путей {"имя части": "путь"} (через кэш ответов).
+    Все подзапросы укладываются в общий дедлайн: таймаут каждого не больше
+    оставшегося времени. Возвращает (результаты по частям, есть_ли_ошибки);
+    опоздавшая или упавшая часть содержит {"error": "..."}.
+    """
+    started = time.time()
+    deadline = deadline or (started + REMOTE_REQUEST_DEADLINE)
+    remaining = max(0.1, deadline - started)
+    timeout = (min(REMOTE_CONNECT_TIMEOUT, remaining), remaining)
+    futures = {name: remote_executor.submit(cached_remote_json, ip, path, timeout, port)
+               for name, path in parts.items()}
+    wait_futures(futures.values(), timeout=max(0, deadline - time.time()))
+
+    results, partial = {}, False
+    for name, future in futures.items():
+        if future.done():
+            results[name] = future.result()
+        else:
+            future.cancel()
+            results[name] = {"error": f"Remote agent did not answer within {remaining:.1f}s deadline"}
+        if isinstance(results[name], dict) and "error" in results[name]:
+            partial = True
+    return results, partial
+
+# ------------------------------------------------------------------------------------
+#     Шардирование хостов между агрегаторами: консистентное хеширование
+# ------------------------------------------------------------------------------------
+# AGGREGATOR_PEERS - все агрегаторы ("host:port" через запятую, включая этот),
+# AGGREGATOR_SELF - адрес этого агрегатора в том же виде. Каждый хост (по IP)
+# принадлежит AGGREGATOR_REPLICAS агрегаторам, идущим по кольцу после хеша IP.
+# У каждого агрегатора RING_VNODES точек на кольце, поэтому при добавлении или
+# удалении агрегатора переезжает только ~1/N хостов. Без AGGREGATOR_PEERS
+# шардирование выключено: агрегатор владеет всеми хостами.
+AGGREGATOR_PEERS = [p.strip() for p in os.environ.get("AGGREGATOR_PEERS", "").split(",") if p.strip()]
+AGGREGATOR_SELF = os.environ.get("AGGREGATOR_SELF", f"{LOCAL_IP}:5000")
+AGGREGATOR_REPLICAS = int(os.environ.get("AGGREGATOR_REPLICAS", 2))
+RING_VNODES = 64
+FORWARDED_HEADER = "X-Fleet-Forwarded"  # запрос уже перенаправлен владельцем - не пересылать дальше
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+def build_hash_ring(peers, vnodes=RING_VNODES):
+    """Кольцо: отсортированные точки и владелец каждой точки."""
+    points = sorted((ring_hash(f"{peer}#{i}"), peer) for peer in set(peers) for i in range(vnodes))
+    return {"peers": sorted(set(peers)), "hashes": [h for h, _ in points], "owners": [p for _, p in points]}
+
+def ring_owners(key: str, replicas=None, ring=None):
+    """Первые replicas различных агрегаторов по часовой стрелке от хеша key."""
+    ring = ring or hash_ring
+    if not ring["peers"]:
+        return []
+    replicas = min(replicas or AGGREGATOR_REPLICAS, len(ring["peers"]))
+    start = bisect.bisect(ring["hashes"], ring_hash(key))
+    owners = []
+    for i in range(len(ring["owners"])):
+        peer = ring["owners"][(start + i) % len(ring["owners"])]
+        if peer not in owners:
+            owners.append(peer)
+            if len(owners) == replicas:
+                break
+    return owners
+
+def aggregator_config_error():
+    """
+    Ошибка настройки кольца или None. AGGREGATOR_SELF обязан быть в AGGREGATOR_PEERS:
+    иначе агрегатор не владеет ни одним хостом и пересылает всё остальным.
+    """
+    if AGGREGATOR_PEERS and AGGREGATOR_SELF not in AGGREGATOR_PEERS:
+        return f"AGGREGATOR_SELF={AGGREGATOR_SELF} is not listed in AGGREGATOR_PEERS={','.join(AGGREGATOR_PEERS)}"
+    return None
+
+def owns_host(ip: str) -> bool:
+    return not hash_ring["peers"] or AGGREGATOR_SELF in ring_owners(ip)
+
+def forward_to_owner(ip: str):
+    """
+    Если хост ip принадлежит другим агрегаторам - пересылает им текущий запрос
+    (по очереди, до первого ответа 2xx) и возвращает их ответ. None - обслужить самим:
+    мы владелец, запрос уже переслан, или ни один владелец не ответил успешно.
+    """
+    if owns_host(ip) or request.headers.get(FORWARDED_HEADER):
+        return None
+    path = request.full_path.lstrip("/").rstrip("?")
+    for owner in ring_owners(ip):
+        try:
+            resp = get_remote_session(owner).get(
+                f"http://{owner}/{path}",
+                timeout=(REMOTE_CONNECT_TIMEOUT, REMOTE_REQUEST_DEADLINE),
+                headers={FORWARDED_HEADER: AGGREGATOR_SELF}
+            )
+        except Exception as e:
+            print(f"[WARNING] Агрегатор-владелец {owner} недоступен:", e)
+            continue
+        if not 200 <= resp.status_code < 300:
+            print(f"[WARNING] Агрегатор-владелец {owner} ответил {resp.status_code}, пробуем следующего")
+            continue
+        return Response(resp.content, status=resp.status_code,
+                        content_type=resp.headers.get("Content-Type", "application/json"),
+                        headers={"X-Fleet-Owner": owner})
+    return None
+
+hash_ring = build_hash_ring(AGGREGATOR_PEERS)
+
+# ------------------------------------------------------------------------------------
+#        Опрос всего парка: все агенты реестра параллельно (asyncio, один поток)
+# ------------------------------------------------------------------------------------
+FLEET_HOST_TIMEOUT = 3          # сек на один агент (соединение + ответ)
+FLEET_DEADLINE = 5              # сек на опрос всего парка
+FLEET_MAX_CONCURRENCY = 512     # одновременно открытых соединений
+FLEET_METRICS_FIELDS = "cpu.usage,memory.percent,disk.percent,last_update,system_info.hostname"
+FLEET_METRICS_PATH = f"metrics?fields={FLEET_METRICS_FIELDS}"
+
+def fleet_hosts():
+    """
+    Хосты для опроса парка: по одной записи на IP из реестра (диапазоны CIDR не
+    опрашиваются) плюс живые обнаруженные агенты, которых нет в реестре.
+    При шардировании - только хосты, которыми владеет этот агрегатор.
+    """
+    hosts = list(user_registry["by_ip"].items())
+    known = {(ip, user.get("port", REMOTE_AGENT_PORT)) for ip, user in hosts}
+    for member in live_members():
+        if (member["ip"], member["port"]) not in known:
+            hosts.append((member["ip"], member))
+    return [(ip, user) for ip, user in hosts if owns_host(ip)]
+
+async def async_fetch_remote_json(ip: str, path: str, port: int = REMOTE_AGENT_PORT):
+    """
+    Минимальный асинхронный GET http://<ip>:<port>/<path> (HTTP/1.1, Connection: close).
+    Соединения не держат потоков, поэтому тысячи агентов опрашиваются из одного.
+    При ошибке бросает исключение (таймаут задаёт вызывающий).
+    """
+    reader, writer = await asyncio.open_connection(ip, port)
+    try:
+        writer.write((f"GET /{path} HTTP/1.1\r\nHost: {ip}:{port}\r\n"
+                      f"Accept: {REMOTE_ACCEPT}\r\nConnection: close\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(chunks)
+        else:
+            body = await reader.read()
+    finally:
+        writer.close()
+
+    if status != 200:
+        raise RuntimeError(f"Remote agent HTTP {status}")
+    return decode_remote_payload(headers.get("content-type", ""), body)
+
+async def fleet_poll(path: str, local_fn, hosts, deadline_seconds=FLEET_DEADLINE):
+    """
+    Опрашивает все hosts [(ip, запись реестра)]: не больше FLEET_MAX_CONCURRENCY
+    соединений одновременно, FLEET_HOST_TIMEOUT на агент и общий дедлайн deadline_seconds.
+    Локальный хост (этот же порт) не ходит по сети - local_fn выполняется в пуле потоков;
+    хосты с открытым автоматом не опрашиваются (статус "open").
+    Возвращает список {"key" ("ip:port"), "ip", "user", "status", "error", "latency_ms", "data"}.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + deadline_seconds
+    semaphore = asyncio.Semaphore(FLEET_MAX_CONCURRENCY)
+
+    async def poll_host(ip, user):
+        port = user.get("port", REMOTE_AGENT_PORT)  # у обнаруженных агентов порт из анонса
+        result = {"key": host_key(ip, port), "ip": ip, "user": user["name"], "status": "ok", "error": None,
+                  "latency_ms": None, "data": None}
+        async with semaphore:
+            timeout = min(FLEET_HOST_TIMEOUT, deadline - loop.time())
+            started = loop.time()
+            try:
+                if timeout <= 0:
+                    raise asyncio.TimeoutError()
+                if is_local_host(ip, port):
+                    result["data"] = await asyncio.wait_for(loop.run_in_executor(remote_executor, local_fn), timeout)
+                elif not breaker_allows(host_key(ip, port)):
+                    result["status"], result["error"] = "open", circuit_open_error(host_key(ip, port))["error"]
+                else:
+                    try:
+                        result["data"] = await asyncio.wait_for(async_fetch_remote_json(ip, path, port), timeout)
+                    except Exception as e:
+                        record_host_result(host_key(ip, port), False, loop.time() - started, str(e) or type(e).__name__)
+                        raise
+                    record_host_result(host_key(ip, port), True, loop.time() - started)
+            except asyncio.TimeoutError:
+                result["status"], result["error"] = "timeout", f"No answer within {max(timeout, 0):.1f}s"
+            except Exception as e:
+                result["status"], result["error"] = "error", str(e) or type(e).__name__
+            result["latency_ms"] = round((loop.time() - started) * 1000, 1)
+        return result
+
+    return await asyncio.gather(*(poll_host(ip, user) for ip, user in hosts))
+
+def run_fleet_poll(path: str, local_fn, hosts=None):
+    """Синхронная обёртка для Flask: свой цикл событий на запрос. Возвращает (результаты, сводка)."""
+    started = time.time()
+    results = asyncio.run(fleet_poll(path, local_fn, fleet_hosts() if hosts is None else hosts))
+    return results, fleet_summary(results, started)
+
+def fleet_summary(results, started):
+    ok = sum(1 for r in results if r["status"] == "ok")
+    return {
+        "hosts": len(results),
+        "ok": ok,
+        "failed": len(results) - ok,
+        "elapsed_ms": round((time.time() - started) * 1000, 1),
+    }
+
+def fleet_host_status(result):
+    return {key: result[key] for key in ("key", "user", "ip", "status", "error", "latency_ms")}
+
+FLEET_ROW_SCALARS = (str, int, float, bool, type(None))
+
+def fleet_metrics_field(data, section, key=None):
+    """Скалярное значение data[section][key] (или data[section]); всё остальное - None."""
+    value = data.get(section) if isinstance(data, dict) else None
+    if key is not None:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value if isinstance(value, FLEET_ROW_SCALARS) else None
+
+def fleet_metrics_row(data):
+    """Плоская строка сводной таблицы из ответа /metrics агента (или присланного снимка)."""
+    return {
+        "hostname": fleet_metrics_field(data, "system_info", "hostname"),
+        "cpu": fleet_metrics_field(data, "cpu", "usage"),
+        "memory": fleet_metrics_field(data, "memory", "percent"),
+        "disk": fleet_metrics_field(data, "disk", "percent"),
+        "last_update": fleet_metrics_field(data, "last_update"),
+    }
+
+# ------------------------------------------------------------------------------------
+#           Push-режим: снимки, присланные агентами (POST /fleet/ingest)
+# ------------------------------------------------------------------------------------
+FLEET_PUSH_FRESH = 30                      # сек: хост со свежим push не опрашивается в /fleet/metrics
+FLEET_PUSH_HISTORY = 120                   # сколько последних снимков хранить на хост
+FLEET_INGEST_MAX_BYTES = 8 * 1024 * 1024   # предел распакованного тела пакета
+FLEET_PUSH_MAX_HOSTS = 10000               # сколько хостов держать в fleet_table (LRU по времени приёма)
+# Разделы снимка, которые обязаны быть объектами (иначе снимок отклоняется)
+FLEET_SNAPSHOT_SECTIONS = ("cpu", "memory", "disk", "system_info")
+
+# host_key(ip отправителя, порт агента) -> {"ip", "agent", "received", "time", "generation",
+# "metrics", "services", "history"}; несколько агентов на одном IP (AGENT_PORT) - разные записи.
+# Порядок - от давно приславших к недавним
+fleet_table = OrderedDict()
+fleet_table_lock = threading.Lock()
+
+def read_ingest_body():
+    """Тело POST /fleet/ingest: JSON, возможно gzip (Content-Encoding). Распаковка ограничена по размеру."""
+    raw = request.get_data(cache=False)
+    if request.headers.get("Content-Encoding", "").lower() == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        raw = decompressor.decompress(raw, FLEET_INGEST_MAX_BYTES)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"payload exceeds {FLEET_INGEST_MAX_BYTES} bytes")
+    elif len(raw) > FLEET_INGEST_MAX_BYTES:
+        raise ValueError(f"payload exceeds {FLEET_INGEST_MAX_BYTES} bytes")
+    return json.loads(raw)
+
+def apply_replica_delta(base, delta):
+    """Применяет дельту агента (см. diff_replica в agent.py): merge patch для словарей, $rows для списков."""
+    if isinstance(delta, dict) and len(delta) == 1 and "$rows" in delta:
+        spec = delta["$rows"]
+        key = spec["key"]
+        rows = OrderedDict((row.get(key), row) for row in (base if isinstance(base, list) else []))
+        for removed in spec.get("remove", []):
+            rows.pop(removed, None)
+        for row in spec.get("upsert", []):
+            rows[row.get(key)] = row
+        return list(rows.values())
+    if isinstance(delta, dict):
+        result = dict(base) if isinstance(base, dict) else {}
+        for key, value in delta.items():
+            if value is None:
+                result.pop(key, None)
+            else:
+                result[key] = apply_replica_delta(result.get(key), value)
+        return result
+    return delta
+
+def valid_snapshot_doc(doc):
+    """Документ хоста пригоден для fleet_table: metrics - объект с объектами в известных разделах, services - список."""
+    metrics = doc.get("metrics") if isinstance(doc, dict) else None
+    if not isinstance(metrics, dict):
+        return False
+    if any(not isinstance(metrics[name], dict) for name in FLEET_SNAPSHOT_SECTIONS if name in metrics):
+        return False
+    return doc.get("services") is None or isinstance(doc.get("services"), list)
+
+def ingest_snapshots(ip: str, port: int, agent: dict, snapshots: list):
+    """
+    Применяет снимки агента к fleet_table по порядку: полный снимок заменяет документ
+    хоста, дельта применяется, только если её base - текущее поколение того же
+    экземпляра агента. Иначе (разрыв или дельта, давшая документ неверной формы)
+    обработка останавливается и агенту возвращается resync.
+    Возвращает (принято, подтверждённое поколение, resync).
+    """
+    now = time.time()
+    accepted, resync = 0, False
+    samples = []
+    user = find_user_by_ip(ip)
+    key = host_key(ip, port)
+    with fleet_table_lock:
+        entry = fleet_table.get(key)
+        if entry is None or entry["agent"].get("instance") != agent.get("instance"):
+            entry = fleet_table[key] = {"ip": ip, "agent": agent, "received": now, "time": 0, "generation": None,
+                                        "metrics": None, "services": None,
+                                        "history": deque(maxlen=FLEET_PUSH_HISTORY)}
+            while len(fleet_table) > FLEET_PUSH_MAX_HOSTS:
+                fleet_table.popitem(last=False)  # вытесняем агента, дольше всех не присылавшего снимков
+        fleet_table.move_to_end(key)
+        entry["agent"], entry["received"] = agent, now
+        for snap in snapshots:
+            if "delta" in snap:
+                if entry["metrics"] is None or snap.get("base") != entry["generation"]:
+                    resync = True
+                    break
+                doc = apply_replica_delta({"metrics": entry["metrics"], "services": entry["services"]}, snap["delta"])
+            elif (snap.get("time") or 0) > entry["time"]:
+                doc = snap
+            else:
+                continue  # старый полный снимок (например, из спула) уже перекрыт
+            if not valid_snapshot_doc(doc):
+                resync = True  # дельта дала документ неверной формы - нужен полный снимок
+                break
+            entry["time"], entry["generation"] = snap.get("time") or 0, snap.get("generation")
+            entry["metrics"], entry["services"] = doc.get("metrics"), doc.get("services")
+            # история - только сводные значения, чтобы не держать списки процессов
+            entry["history"].append({"generation": entry["generation"], "time": entry["time"],
+                                     **fleet_metrics_row(entry["metrics"] or {})})
+            samples.append(({"key": key, "user": user["name"] if user else agent.get("name"), "ip": ip, "status": "pushed",
+                             **fleet_metrics_row(entry["metrics"] or {})}, entry["time"] or now))
+            accepted += 1
+        ack = entry["generation"]
+    record_fleet_samples(samples)
+    return accepted, ack, resync
+
+def fresh_pushed_hosts():
+    """{"ip:port": копия записи} агентов, приславших снимок за последние FLEET_PUSH_FRESH сек."""
+    now = time.time()
+    with fleet_table_lock:
+        return {key: {k: v for k, v in entry.items() if k != "history"}
+                for key, entry in fleet_table.items()
+                if entry["metrics"] is not None and now - entry["received"] <= FLEET_PUSH_FRESH}
+
+def polled_fleet_hosts(pushed):
+    """Хосты fleet_hosts(), которые нужно опрашивать: агенты со свежим push (pushed) пропускаются."""
+    return [(ip, user) for ip, user in fleet_hosts() if host_key(ip, user.get("port")) not in pushed]
+
+def fleet_metric_rows(results, pushed, summary):
+    """
+    Строки /fleet/metrics: хосты в push-режиме (в т.ч. не из реестра) - из fleet_table,
+    остальные - из результатов опроса. Дописывает счётчики push в summary.
+    """
+    now = time.time()
+    rows = []
+    for key, entry in pushed.items():
+        user = find_user_by_ip(entry["ip"])
+        rows.append({"key": key, "user": user["name"] if user else entry["agent"].get("name"), "ip": entry["ip"],
+                     "status": "pushed",
+                     "error": None, "latency_ms": None, "age": round(now - entry["received"], 1),
+                     **fleet_metrics_row(entry["metrics"])})
+    summary["hosts"] += len(pushed)
+    summary["ok"] += len(pushed)
+    summary["pushed"] = len(pushed)
+    polled = []
+    for result in results:
+        row = fleet_host_status(result)
+        if isinstance(result["data"], dict):
+            row.update(fleet_metrics_row(result["data"]))
+        polled.append((row, now))
+        rows.append(row)
+    record_fleet_samples(polled)
+    return rows
+
+# ------------------------------------------------------------------------------------
+#        Иерархия агрегаторов: свёртки поддеревьев (GET /fleet/rollup)
+# ------------------------------------------------------------------------------------
+# Узел-агрегатор опрашивает свой реестр и дочерние агрегаторы FLEET_CHILDREN
+# ("host:port" через запятую) и отдаёт наверх одну свёртку. Свёртки сливаются
+# без потерь: счётчики и суммы складываются, min/max сравниваются, гистограммы
+# (корзина на 1%) складываются поэлементно, top-K сливается через heapq.
+# Дедлайн передаётся вниз параметром budget: узел обязан ответить за budget секунд,
+# поэтому сам опрашивает свои хосты и детей за budget - FLEET_TIER_MARGIN (запас на
+# свёртку и ответ). Родитель ждёт ребёнка ровно тот budget, который ему передал.
+FLEET_CHILDREN = [c.strip() for c in os.environ.get("FLEET_CHILDREN", "").split(",") if c.strip()]
+FLEET_TIER_MARGIN = 0.5          # сек запаса на каждый уровень дерева
+FLEET_ROLLUP_TOP_K = 10
+FLEET_ROLLUP_METRICS = ("cpu", "memory", "disk")
+FLEET_HISTOGRAM_BUCKETS = 101    # 0..100 %
+
+def parse_percent(value):
+    try:
+        return float(str(value).strip().rstrip('%'))
+    except (TypeError, ValueError):
+        return None
+
+def empty_rollup():
+    return {
+        "nodes": [platform.node()],
+        "hosts": 0,
+        "ok": 0,
+        "failed": 0,
+        "metrics": {name: {"count": 0, "sum": 0.0, "min": None, "max": None,
+                           "histogram": [0] * FLEET_HISTOGRAM_BUCKETS} for name in FLEET_ROLLUP_METRICS},
+        "top": {name: [] for name in FLEET_ROLLUP_METRICS},
+    }
+
+def rollup_rows(rows):
+    """Свёртка строк /fleet/metrics этого узла."""
+    rollup = empty_rollup()
+    for row in rows:
+        rollup["hosts"] += 1
+        if row["status"] not in ("ok", "pushed"):
+            rollup["failed"] += 1
+            continue
+        rollup["ok"] += 1
+        for name in FLEET_ROLLUP_METRICS:
+            value = parse_percent(row.get(name))
+            if value is None:
+                continue
+            stats = rollup["metrics"][name]
+            stats["count"] += 1
+            stats["sum"] += value
+            stats["min"] = value if stats["min"] is None else min(stats["min"], value)
+            stats["max"] = value if stats["max"] is None else max(stats["max"], value)
+            stats["histogram"][min(FLEET_HISTOGRAM_BUCKETS - 1, max(0, int(value)))] += 1
+            rollup["top"][name].append({"value": value, "user": row["user"], "ip": row["ip"], "key": row.get("key"),
+                                        "node": rollup["nodes"][0]})
+    for name in FLEET_ROLLUP_METRICS:
+        rollup["top"][name] = heapq.nlargest(FLEET_ROLLUP_TOP_K, rollup["top"][name], key=lambda e: e["value"])
+    return rollup
+
+def merge_rollups(into, other):
+    """Сливает свёртку other (например, от дочернего агрегатора) в into."""
+    into["nodes"].extend(other.get("nodes", []))
+    for key in ("hosts", "ok", "failed"):
+        into[key] += other.get(key, 0)
+    for name in FLEET_ROLLUP_METRICS:
+        stats, child = into["metrics"][name], other.get("metrics", {}).get(name)
+        if not child or not child.get("count"):
+            continue
+        stats["count"] += child["count"]
+        stats["sum"] += child["sum"]
+        stats["min"] = child["min"] if stats["min"] is None else min(stats["min"], child["min"])
+        stats["max"] = child["max"] if stats["max"] is None else max(stats["max"], child["max"])
+        stats["histogram"] = [a + b for a, b in zip(stats["histogram"], child["histogram"])]
+        # оба списка уже отсортированы по убыванию - k-way слияние без полной сортировки
+        merged = heapq.merge(into["top"][name], other.get("top", {}).get(name, []),
+                             key=lambda e: e["value"], reverse=True)
+        into["top"][name] = [e for _, e in zip(range(FLEET_ROLLUP_TOP_K), merged)]
+    return into
+
+def histogram_percentile(histogram, count, q):
+    """Перцентиль по гистограмме с корзинами по 1% (точность - одна корзина)."""
+    target, running = q * count, 0
+    for bucket, hits in enumerate(histogram):
+        running += hits
+        if hits and running >= target:
+            return float(bucket)
+    return None
+
+def finalize_rollup(rollup):
+    """Производные поля для ответа: среднее и перцентили (при слиянии они не используются)."""
+    for stats in rollup["metrics"].values():
+        count = stats["count"]
+        stats["mean"] = round(stats["sum"] / count, 2) if count else None
+        for label, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            stats[label] = histogram_percentile(stats["histogram"], count, q) if count else None
+    return rollup
+
+async def fetch_child_rollup(child: str, budget: float):
+    """
+    Свёртка дочернего агрегатора child ("host:port") за budget секунд (запас
+    FLEET_TIER_MARGIN ребёнок вычитает сам); возвращает (статус узла, свёртка или None).
+    """
+    status = {"node": child, "status": "ok", "error": None}
+    if budget <= FLEET_TIER_MARGIN:
+        status["status"], status["error"] = "timeout", "No time budget left for this tier"
+        return status, None
+    host, _, port = child.rpartition(":")
+    try:
+        data = await asyncio.wait_for(
+            async_fetch_remote_json(host or child, f"fleet/rollup?budget={budget:.2f}",
+                                    int(port) if host else REMOTE_AGENT_PORT),
+            budget)
+        return status, data
+    except asyncio.TimeoutError:
+        status["status"], status["error"] = "timeout", f"No answer within {budget:.1f}s"
+    except Exception as e:
+        status["status"], status["error"] = "error", str(e) or type(e).__name__
+    return status, None
+
+async def gather_rollup_parts(hosts, budget):
+    """
+    Опрос своих хостов и дочерних агрегаторов одним циклом событий.
+    Всё укладывается в budget - FLEET_TIER_MARGIN, чтобы узел успел ответить за budget.
+    """
+    work = max(0.0, budget - FLEET_TIER_MARGIN)
+    return await asyncio.gather(
+        fleet_poll(FLEET_METRICS_PATH, get_local_metrics, hosts, work),
+        *(fetch_child_rollup(child, work) for child in FLEET_CHILDREN))
+
+# ------------------------------------------------------------------------------------
+#        Колоночная таблица парка (NumPy) и запросы GET /fleet/query
+# ------------------------------------------------------------------------------------
+# Строка на хост; числовые колонки - массивы float64 (NaN - нет данных), плюс
+# история для запросов по окну времени: кольцо из FLEET_WINDOW_SLOTS корзин по
+# FLEET_WINDOW_STEP сек, так что оно покрывает все FLEET_WINDOW_MAX сек. Замеры
+# прореживаются при записи: корзина хранит сумму, число, минимум и максимум своих
+# замеров, поэтому частые опросы не вытесняют начало окна. Пополняется опросами
+# /fleet/metrics, push-снимками и фоновым опросом раз в FLEET_SAMPLE_INTERVAL сек
+# (по умолчанию - раз в корзину; 0 - выключить, тогда окна видят только ручные опросы).
+# Хосты, о которых нет вестей FLEET_ROW_TTL сек, удаляются из таблицы.
+# Фильтры, сортировка и группировка выполняются операциями над массивами целиком.
+FLEET_QUERY_NUMERIC = ("cpu", "memory", "disk")
+FLEET_QUERY_TEXT = ("key", "user", "ip", "hostname", "status")  # key - "ip:port", строка таблицы
+FLEET_QUERY_AGGS = ("last", "avg", "min", "max")
+FLEET_WINDOW_MAX = 3600          # верхняя граница ?window=, сек
+FLEET_WINDOW_SLOTS = 120         # корзин истории на хост
+FLEET_WINDOW_STEP = FLEET_WINDOW_MAX / FLEET_WINDOW_SLOTS  # сек на корзину (точность окна)
+FLEET_ROW_TTL = FLEET_WINDOW_MAX  # сек без замеров - строка хоста удаляется
+FLEET_QUERY_MAX_LIMIT = 10000
+FLEET_SAMPLE_INTERVAL = float(os.environ.get("FLEET_SAMPLE_INTERVAL", FLEET_WINDOW_STEP))  # 0 - выключено
+FLEET_QUERY_RE = re.compile(r'^(\w+)(>=|<=|!=|=|>|<)(.*)$')
+# поля корзины истории и значение пустой корзины
+FLEET_HISTORY_FIELDS = {"sum": 0.0, "count": 0.0, "min": np.inf, "max": -np.inf} if np is not None else {}
+
+fleet_columns_lock = threading.Lock()
+fleet_columns = {"index": {}, "size": 0, "capacity": 0}
+
+def grow_fleet_columns(capacity):
+    """Увеличивает ёмкость массивов (удвоением), сохраняя данные. Вызывать под fleet_columns_lock."""
+    old, size = fleet_columns.get("capacity", 0), fleet_columns["size"]
+
+    def resized(array, fill, shape):
+        new = np.full(shape, fill, dtype=array.dtype if array is not None else float)
+        if array is not None and size:
+            new[:size] = array[:size]
+        return new
+
+    fleet_columns["capacity"] = max(capacity, old * 2, 64)
+    cap = fleet_columns["capacity"]
+    for name in FLEET_QUERY_TEXT:
+        column = fleet_columns.get(name)
+        new = np.full(cap, "", dtype=object)
+        if column is not None and size:
+            new[:size] = column[:size]
+        fleet_columns[name] = new
+    for name in FLEET_QUERY_NUMERIC:
+        fleet_columns[name] = resized(fleet_columns.get(name), np.nan, cap)
+        for field, empty in FLEET_HISTORY_FIELDS.items():
+            key = f"{name}_{field}"
+            fleet_columns[key] = resized(fleet_columns.get(key), empty, (cap, FLEET_WINDOW_SLOTS))
+    fleet_columns["updated"] = resized(fleet_columns.get("updated"), np.nan, cap)
+    fleet_columns["seen"] = resized(fleet_columns.get("seen"), np.nan, cap)
+    # номер корзины (время // FLEET_WINDOW_STEP), которая сейчас лежит в слоте; -inf - пусто
+    fleet_columns["history_bucket"] = resized(fleet_columns.get("history_bucket"), -np.inf, (cap, FLEET_WINDOW_SLOTS))
+
+def reset_fleet_row(idx):
+    """Очищает строку idx перед тем, как отдать её новому хосту. Вызывать под fleet_columns_lock."""
+    for name in FLEET_QUERY_TEXT:
+        fleet_columns[name][idx] = ""
+    for name in FLEET_QUERY_NUMERIC:
+        fleet_columns[name][idx] = np.nan
+        for field, empty in FLEET_HISTORY_FIELDS.items():
+            fleet_columns[f"{name}_{field}"][idx] = empty
+    fleet_columns["updated"][idx] = fleet_columns["seen"][idx] = np.nan
+    fleet_columns["history_bucket"][idx] = -np.inf
+
+def evict_stale_fleet_rows(now):
+    """
+    Удаляет строки хостов без замеров дольше FLEET_ROW_TTL: на место удалённой
+    переносится последняя строка, таблица остаётся плотной. Вызывать под fleet_columns_lock.
+    """
+    size = fleet_columns["size"]
+    if not size:
+        return
+    stale = np.nonzero(fleet_columns["seen"][:size] < now - FLEET_ROW_TTL)[0]
+    arrays = [a for a in fleet_columns.values() if isinstance(a, np.ndarray)]
+    for idx in stale[::-1]:  # с конца: перенос последней строки не задевает ещё не удалённые
+        last = fleet_columns["size"] - 1
+        del fleet_columns["index"][fleet_columns["key"][idx]]
+        if idx != last:
+            for array in arrays:
+                array[idx] = array[last]
+            fleet_columns["index"][fleet_columns["key"][idx]] = int(idx)
+        fleet_columns["size"] = last
+
+def record_fleet_samples(samples):
+    """samples - [(строка /fleet/metrics, время замера)]: обновляет последние значения и корзины истории."""
+    if np is None or not samples:
+        return
+    now = time.time()
+    with fleet_columns_lock:
+        evict_stale_fleet_rows(now)
+        for row, at in samples:
+            key = row.get("key") or host_key(row["ip"])
+            idx = fleet_columns["index"].get(key)
+            if idx is None:
+                if fleet_columns["size"] >= fleet_columns["capacity"]:
+                    grow_fleet_columns(fleet_columns["size"] + 1)
+                idx = fleet_columns["index"][key] = fleet_columns["size"]
+                fleet_columns["size"] += 1
+                reset_fleet_row(idx)
+            fleet_columns["seen"][idx] = now
+            fleet_columns["key"][idx] = key
+            for name in FLEET_QUERY_TEXT:
+                value = row.get(name)
+                if value is not None or name == "status":
+                    fleet_columns[name][idx] = str(value or "")
+            if row.get("status") not in ("ok", "pushed"):
+                continue
+            values = {}
+            for name in FLEET_QUERY_NUMERIC:
+                value = parse_percent(row.get(name))
+                values[name] = np.nan if value is None else value
+                fleet_columns[name][idx] = values[name]
+            fleet_columns["updated"][idx] = at
+            bucket = at // FLEET_WINDOW_STEP
+            slot = int(bucket) % FLEET_WINDOW_SLOTS
+            current = fleet_columns["history_bucket"][idx, slot]
+            if bucket < current or at < now - FLEET_WINDOW_MAX:
+                continue  # замер старше окна (например, из спула) - только в последние значения
+            if bucket > current:
+                fleet_columns["history_bucket"][idx, slot] = bucket
+                for name in FLEET_QUERY_NUMERIC:
+                    for field, empty in FLEET_HISTORY_FIELDS.items():
+                        fleet_columns[f"{name}_{field}"][idx, slot] = empty
+            for name, value in values.items():
+                if np.isnan(value):
+                    continue
+                fleet_columns[f"{name}_sum"][idx, slot] += value
+                fleet_columns[f"{name}_count"][idx, slot] += 1
+                fleet_columns[f"{name}_min"][idx, slot] = min(fleet_columns[f"{name}_min"][idx, slot], value)
+                fleet_columns[f"{name}_max"][idx, slot] = max(fleet_columns[f"{name}_max"][idx, slot], value)
+
+def fleet_column_snapshot(window, agg):
+    """
+    Копии колонок; числовые - последнее значение или агрегат (avg/min/max) за window сек.
+    Окно округляется вверх до целых корзин FLEET_WINDOW_STEP.
+    """
+    with fleet_columns_lock:
+        size = fleet_columns["size"]
+        if not size:
+            return 0, {}
+        columns = {name: fleet_columns[name][:size].copy() for name in FLEET_QUERY_TEXT}
+        columns["updated"] = fleet_columns["updated"][:size].copy()
+        if agg == "last":
+            for name in FLEET_QUERY_NUMERIC:
+                columns[name] = fleet_columns[name][:size].copy()
+            return size, columns
+        in_window = fleet_columns["history_bucket"][:size] >= (time.time() - window) // FLEET_WINDOW_STEP
+        field = "sum" if agg == "avg" else agg
+        history = {name: (fleet_columns[f"{name}_{field}"][:size].copy(), fleet_columns[f"{name}_count"][:size].copy())
+                   for name in FLEET_QUERY_NUMERIC}
+    for name, (values, counts) in history.items():
+        valid = in_window & (counts > 0)
+        total = np.where(valid, counts, 0.0).sum(axis=1)
+        if agg == "avg":
+            result = np.where(valid, values, 0.0).sum(axis=1) / np.maximum(total, 1)
+        elif agg == "max":
+            result = np.where(valid, values, -np.inf).max(axis=1)
+        else:
+            result = np.where(valid, values, np.inf).min(axis=1)
+        columns[name] = np.where(total > 0, result, np.nan)
+    return size, columns
+
+def parse_fleet_where(where):
+    """where=cpu>80,disk>=90,status=ok - условия через запятую (И). Возвращает [(колонка, оператор, значение)]."""
+    conditions = []
+    for part in filter(None, (p.strip() for p in (where or "").split(","))):
+        match = FLEET_QUERY_RE.match(part)
+        if not match:
+            raise ValueError(f"Bad condition: {part}")
+        column, op, value = match.groups()
+        if column in FLEET_QUERY_NUMERIC:
+            conditions.append((column, op, float(value.rstrip('%'))))
+        elif column in FLEET_QUERY_TEXT and op in ("=", "!="):
+            conditions.append((column, op, value))
+        else:
+            raise ValueError(f"Unsupported condition: {part}")
+    return conditions
+
+FLEET_QUERY_OPS = {
+    ">": lambda c, v: c > v, "<": lambda c, v: c < v, ">=": lambda c, v: c >= v,
+    "<=": lambda c, v: c <= v, "=": lambda c, v: c == v, "!=": lambda c, v: c != v,
+}
+
+def sort_order(values, descending):
+    """Индексы сортировки; NaN всегда в конце."""
+    if values.dtype == object:
+        order = np.argsort(values.astype(str), kind="stable")
+        return order[::-1] if descending else order
+    return np.argsort(-values if descending else values, kind="stable")
+
+def json_value(value):
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else round(float(value), 2)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+def query_fleet_table(where=None, order_by=None, limit=100, group_by=None, window=0, agg=None):
+    """
+    Запрос к колоночной таблице парка. Возвращает {"rows", "matched", "hosts"}.
+    window > 0 - числовые колонки агрегируются за последние window сек функцией agg
+    (avg по умолчанию). group_by - текстовая колонка: строка на группу с числом
+    хостов и avg/max числовых колонок.
+    """
+    agg = agg or ("avg" if window else "last")
+    if agg not in FLEET_QUERY_AGGS:
+        raise ValueError(f"agg must be one of {', '.join(FLEET_QUERY_AGGS)}")
+    if agg != "last" and not window:
+        raise ValueError("agg requires window")
+    conditions = parse_fleet_where(where)
+    size, columns = fleet_column_snapshot(window, agg)
+    if not size:
+        return {"rows": [], "matched": 0, "hosts": 0}
+
+    mask = np.ones(size, dtype=bool)
+    for column, op, value in conditions:
+        mask &= FLEET_QUERY_OPS[op](columns[column], value)
+    selected = np.nonzero(mask)[0]
+
+    if group_by:
+        if group_by not in FLEET_QUERY_TEXT:
+            raise ValueError(f"group_by must be one of {', '.join(FLEET_QUERY_TEXT)}")
+        keys, inverse = np.unique(columns[group_by][selected].astype(str), return_inverse=True)
+        table = {group_by: keys, "hosts": np.bincount(inverse, minlength=len(keys))}
+        for name in FLEET_QUERY_NUMERIC:
+            values = columns[name][selected]
+            valid = ~np.isnan(values)
+            counts = np.bincount(inverse, weights=valid, minlength=len(keys))
+            sums = np.bincount(inverse, weights=np.where(valid, values, 0.0), minlength=len(keys))
+            table[f"{name}_avg"] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+            maxima = np.full(len(keys), -np.inf)
+            np.maximum.at(maxima, inverse[valid], values[valid])
+            table[f"{name}_max"] = np.where(counts > 0, maxima, np.nan)
+        rows_index = np.arange(len(keys))
+    else:
+        table = {name: columns[name][selected] for name in FLEET_QUERY_TEXT + FLEET_QUERY_NUMERIC + ("updated",)}
+        rows_index = np.arange(len(selected))
+
+    if order_by:
+        descending = order_by.startswith("-")
+        key = order_by.lstrip("-+")
+        if key not in table:
+            raise ValueError(f"Unknown order_by column: {key}")
+        rows_index = sort_order(table[key], descending)
+    rows_index = rows_index[:limit]
+    rows = [{name: json_value(values[i]) for name, values in table.items()} for i in rows_index]
+    return {"rows": rows, "matched": int(len(selected)), "hosts": int(size)}
+
+def background_fleet_sampler():
+    """Периодический опрос парка, чтобы у /fleet/query была история для окон."""
+    while True:
+        try:
+            pushed = fresh_pushed_hosts()
+            hosts = polled_fleet_hosts(pushed)
+            results, summary = run_fleet_poll(FLEET_METRICS_PATH, get_local_metrics, hosts)
+            fleet_metric_rows(results, pushed, summary)
+        except Exception as e:
+            print("[ERROR] Фоновый опрос парка:", e)
+        time.sleep(FLEET_SAMPLE_INTERVAL)
+
+# ------------------------------------------------------------------------------------
+#          Top-K процессов по всему парку (k-way слияние ответов хостов)
+# ------------------------------------------------------------------------------------
+FLEET_TOP_KEYS = {"cpu": "cpu", "rss": "rss", "memory": "rss"}
+FLEET_TOP_MAX_K = 1000
+FLEET_TOP_CACHE_TTL = 5          # сек: результат переиспользуется в пределах интервала
+
+fleet_top_cache = {}  # (поле, k) -> (время, ответ)
+fleet_top_locks = {}  # (поле, k) -> Lock: один расчёт на ключ, остальные ждут его результат
+fleet_top_lock = threading.Lock()
+
+def get_local_top_processes(field, k):
+    """Локальный top-k в формате agent.py /processes/top."""
+    rows = []
+    for proc in psutil.process_iter(['pid', 'name', 'username', 'status', 'cpu_percent', 'memory_info']):
+        try:
+            rows.append({
+                "pid": proc.info['pid'],
+                "name": proc.info['name'] or "",
+                "user": proc.info['username'] or "",
+                "status": proc.info['status'] or "",
+                "cpu": proc.info['cpu_percent'] or 0.0,
+                "rss": proc.info['memory_info'].rss if proc.info['memory_info'] else 0,
+            })
+        except:
+            pass
+    top = heapq.nlargest(k, rows, key=lambda r: r[field])
+    for row in top:
+        row["cpu_usage"], row["memory_usage"] = f"{row['cpu']:.1f}%", convert_bytes(row["rss"])
+    return {"key": field, "k": k, "time": time.time(), "processes": top}
+
+def merge_top_processes(results, field, k):
+    """
+    Слияние top-k списков хостов: каждый уже отсортирован по убыванию field,
+    поэтому heapq.merge выдаёт общий порядок за O(k log N) без полной сортировки.
+    """
+    lists = []
+    for result in results:
+        data = result["data"]
+        if not isinstance(data, dict) or not isinstance(data.get("processes"), list):
+            if result["status"] == "ok":
+                result["status"], result["error"] = "error", "Agent did not return /processes/top"
+            continue
+        rows = [{**row, "host": result["user"], "ip": result["ip"]} for row in data["processes"]
+                if isinstance(row.get(field), (int, float))]
+        rows.sort(key=lambda r: r[field], reverse=True)  # на случай агента, не отсортировавшего ответ
+        lists.append(rows)
+    return [row for _, row in zip(range(k), heapq.merge(*lists, key=lambda r: r[field], reverse=True))]
+
+def fleet_summary_recount(results, summary):
+    """Пересчёт ok/failed после того, как слияние пометило хосты без /processes/top."""
+    ok = sum(1 for r in results if r["status"] == "ok")
+    return {**summary, "ok": ok, "failed": len(results) - ok}
+
+def fleet_top_processes(field, k):
+    """Кэшированный на FLEET_TOP_CACHE_TTL top-k процессов парка; одновременные запросы ждут один расчёт."""
+    with fleet_top_lock:
+        key_lock = fleet_top_locks.setdefault((field, k), threading.Lock())
+    with key_lock:
+        cached = fleet_top_cache.get((field, k))
+        if cached and time.time() - cached[0] < FLEET_TOP_CACHE_TTL:
+            return cached[1], cached[0]
+        results, summary = run_fleet_poll(f"processes/top?key={field}&k={k}",
+                                          lambda: get_local_top_processes(field, k))
+        response = {
+            "key": field,
+            "k": k,
+            "processes": merge_top_processes(results, field, k),
+            "hosts": [fleet_host_status(r) for r in results],
+            "summary": fleet_summary_recount(results, summary),
+        }
+        computed_at = time.time()
+        fleet_top_cache[(field, k)] = (computed_at, response)
+        return response, computed_at
+
 # ------------------------------------------------------------------------------------
 #                           Flask эндпойнты
 # ------------------------------------------------------------------------------------
@@ -404,7 +1952,7 @@ def update_endpoint():
 
 @app.route('/users', methods=['GET'])
 def list_users():
-    return jsonify({"users": users})
+    return jsonify({"users": user_registry["users"]})
 
 # -------------------- Метрики локальные --------------------
 @app.route('/metrics', methods=['GET'])
@@ -423,56 +1971,69 @@ def list_services():
     return jsonify({"services": get_local_services()})
 
 # -------------------- Метрики (удалённая логика) --------------------
+def connect_target(username):
+    """
+    Запись, IP и порт агента для /connect/<username>.
+    404 - записи нет; 400 - запись реестра задаёт диапазон CIDR, а не конкретный хост.
+    """
+    user = find_user(username) or find_member(username)
+    if not user:
+        abort(404, f"User '{username}' not found")
+    ip = user_host(user)
+    if ip is None:
+        abort(400, f"User '{username}' is an address range ({user['ip']}), not a single host")
+    return user, ip, user.get("port")  # у обнаруженных агентов - порт из анонса
+
 @app.route('/connect/<username>/metrics', methods=['GET'])
 def connect_to_user_metrics(username):
     """
     Если IP user локальный -> отдаём свои метрики,
-    иначе -> http://user_ip:5000/metrics
+    иначе -> http://user_ip:port/metrics
     """
-    user = next((u for u in users if u['name'] == username), None)
-    if not user:
-        abort(404, f"User '{username}' not found")
-    ip = user["ip"]
+    user, ip, port = connect_target(username)
 
-    if is_local_ip(ip):
+    if is_local_host(ip, port):
         return jsonify(get_local_metrics())
     else:
-        data = fetch_remote_json(ip, "metrics")
+        forwarded = forward_to_owner(ip)
+        if forwarded is not None:
+            return forwarded
+        data = cached_remote_json(ip, "metrics", port=port)
         return jsonify(data)
 
 @app.route('/connect/<username>/directories', methods=['GET'])
 def connect_to_user_directories(username):
     """
     Если IP user локальный -> свои директории,
-    иначе -> http://user_ip:5000/directories
+    иначе -> http://user_ip:port/directories
     """
-    user = next((u for u in users if u['name'] == username), None)
-    if not user:
-        abort(404, f"User '{username}' not found")
-    ip = user["ip"]
+    user, ip, port = connect_target(username)
 
-    if is_local_ip(ip):
+    if is_local_host(ip, port):
         dirs_ = get_local_directories()
         return jsonify({"directories": dirs_})
     else:
-        data = fetch_remote_json(ip, "directories")
+        forwarded = forward_to_owner(ip)
+        if forwarded is not None:
+            return forwarded
+        data = cached_remote_json(ip, "directories", port=port)
         return jsonify(data)
 
 @app.route('/connect/<username>/services', methods=['GET'])
 def connect_to_user_services(username):
     """
     Если IP user локальный -> свои сервисы,
-    иначе -> http://user_ip:5000/services
+    иначе -> http://user_ip:port/services
     """
-    user = next((u for u in users if u['name'] == username), None)
-    if not user:
-        abort(404, f"User '{username}' not found")
-    ip = user["ip"]
+    user, ip, port = connect_target(username)
 
-    if is_local_ip(ip):
+    if is_local_host(ip, port):
         return jsonify({"services": get_local_services()})
     else:
-        data = fetch_remote_json(ip, "services")
+        forwarded = forward_to_owner(ip)
+        if forwarded is not None:
+            return forwarded
+        data = cached_remote_json(ip, "services", port=port)
         return jsonify(data)
 
 # -------------------- Пример: connect/<username>  --------------------
@@ -483,27 +2044,179 @@ def connect_to_user(username):
     - Если локальный IP -> вернуть "local" всё,
     - Иначе -> запросить remote /metrics и /directories
     """
-    user = next((u for u in users if u['name'] == username), None)
-    if not user:
-        abort(404, description="User not found")
-    ip = user["ip"]
+    user, ip, port = connect_target(username)
 
-    if is_local_ip(ip):
+    if is_local_host(ip, port):
         return jsonify({
             "user": user,
             "metrics": get_local_metrics(),
             "directories": get_local_directories()
         })
     else:
-        # Пример, как собрать в один ответ
-        remote_metrics = fetch_remote_json(ip, "metrics")
-        remote_dirs = fetch_remote_json(ip, "directories")
+        forwarded = forward_to_owner(ip)
+        if forwarded is not None:
+            return forwarded
+        # Части запрашиваются параллельно; опоздавшие помечаются ошибкой, остальное отдаём
+        parts, partial = fetch_remote_parts(ip, {"metrics": "metrics", "directories": "directories"}, port=port)
         return jsonify({
             "user": user,
-            "metrics": remote_metrics,
-            "directories": remote_dirs
+            "metrics": parts["metrics"],
+            "directories": parts["directories"],
+            "partial": partial
         })
 
+# -------------------- Сводка по всему парку --------------------
+@app.route('/fleet/metrics', methods=['GET'])
+def fleet_metrics():
+    """Метрики всех хостов реестра одной таблицей: строка на хост со статусом опроса (или свежего push)."""
+    pushed = fresh_pushed_hosts()
+    hosts = polled_fleet_hosts(pushed)
+    results, summary = run_fleet_poll(FLEET_METRICS_PATH, get_local_metrics, hosts)
+    return jsonify({"rows": fleet_metric_rows(results, pushed, summary), "summary": summary})
+
+@app.route('/fleet/rollup', methods=['GET'])
+def fleet_rollup():
+    """
+    Свёртка всего поддерева: свой реестр + дочерние агрегаторы (FLEET_CHILDREN).
+    budget - за сколько секунд нужно ответить (его передаёт родительский агрегатор);
+    запас FLEET_TIER_MARGIN на свёртку и ответ вычитается здесь же.
+    """
+    budget = min(FLEET_DEADLINE, request.args.get('budget', FLEET_DEADLINE, type=float))
+    started = time.time()
+    pushed = fresh_pushed_hosts()
+    hosts = polled_fleet_hosts(pushed)
+    results, *children = asyncio.run(gather_rollup_parts(hosts, budget))
+    rollup = rollup_rows(fleet_metric_rows(results, pushed, fleet_summary(results, started)))
+    rollup["children"] = []
+    for status, data in children:
+        if isinstance(data, dict) and "metrics" in data:
+            merge_rollups(rollup, data)
+            status["hosts"] = data.get("hosts", 0)
+        elif status["status"] == "ok":
+            status["status"], status["error"] = "error", "Child did not return a rollup"
+        rollup["children"].append(status)
+    rollup["elapsed_ms"] = round((time.time() - started) * 1000, 1)
+    return jsonify(finalize_rollup(rollup))
+
+@app.route('/fleet/services', methods=['GET'])
+def fleet_services():
+    """Сервисы всех хостов реестра: строка на сервис, плюс статус опроса каждого хоста."""
+    results, summary = run_fleet_poll("services", lambda: {"services": get_local_services()})
+    rows, hosts = [], []
+    for result in results:
+        host = fleet_host_status(result)
+        services = result["data"].get("services", []) if isinstance(result["data"], dict) else []
+        host["count"] = len(services)
+        hosts.append(host)
+        for svc in services:
+            rows.append({"user": result["user"], "ip": result["ip"], **svc})
+    return jsonify({"rows": rows, "hosts": hosts, "summary": summary})
+
+@app.route('/fleet/ingest', methods=['POST'])
+def fleet_ingest():
+    """
+    Приём пакета снимков от агента в push-режиме:
+    {"agent": {"name", "ip", "port", "version", "instance"},
+     "snapshots": [{"generation", "time", "metrics", "services"} | {"generation", "time", "base", "delta"}, ...]}
+    Агент определяется по адресу отправителя и "port" из agent (нет - REMOTE_AGENT_PORT):
+    несколько агентов на одном IP хранятся раздельно. "ip" в теле - справочный.
+    Ответ: {"accepted", "received", "ack": поколение, "resync": нужен ли полный снимок}.
+    """
+    try:
+        payload = read_ingest_body()
+    except Exception as e:
+        return jsonify({"error": f"Bad ingest payload: {e}"}), 400
+    agent = payload.get("agent") if isinstance(payload, dict) else None
+    snapshots = payload.get("snapshots") if isinstance(payload, dict) else None
+    if not isinstance(agent, dict) or not isinstance(snapshots, list) \
+            or not all(isinstance(sn, dict) and (valid_snapshot_doc(sn) or isinstance(sn.get("delta"), dict))
+                       for sn in snapshots):
+        return jsonify({"error": "Expected {\"agent\": {...}, \"snapshots\": [{\"metrics\": {...}} | {\"delta\": {...}}, ...]}"}), 400
+    # Хост - адрес отправителя: "ip" из тела не проверен и только сохраняется в записи
+    ip = request.remote_addr
+    port = agent.get("port", REMOTE_AGENT_PORT)
+    if not isinstance(port, int) or isinstance(port, bool) or not 0 < port < 65536:
+        return jsonify({"error": "agent.port must be an integer 1-65535"}), 400
+    accepted, ack, resync = ingest_snapshots(ip, port, agent, snapshots)
+    return jsonify({"accepted": accepted, "received": len(snapshots), "ack": ack, "resync": resync})
+
+@app.route('/fleet/members', methods=['GET'])
+def fleet_members():
+    """Живые агенты, обнаруженные по UDP-анонсам (запись пропадает через ttl без анонсов)."""
+    now = time.time()
+    rows = [{**m, "age": round(now - m["last_seen"], 1), "in_registry": m["ip"] in user_registry["by_ip"]}
+            for m in live_members()]
+    return jsonify({"members": rows, "discovery": DISCOVERY_MODE, "port": DISCOVERY_PORT})
+
+@app.route('/fleet/processes/top', methods=['GET'])
+def fleet_processes_top():
+    """Top-k процессов всего парка по cpu или rss (memory): ?key=cpu&k=20."""
+    key = request.args.get('key', 'cpu')
+    if key not in FLEET_TOP_KEYS:
+        return jsonify({"error": f"key must be one of {', '.join(FLEET_TOP_KEYS)}"}), 400
+    k = max(1, min(request.args.get('k', 20, type=int), FLEET_TOP_MAX_K))
+    response, computed_at = fleet_top_processes(FLEET_TOP_KEYS[key], k)
+    return jsonify({**response, "age": round(time.time() - computed_at, 2)})
+
+@app.route('/fleet/query', methods=['GET'])
+def fleet_query():
+    """
+    Запрос к колоночной таблице парка:
+      where=cpu>80,disk>90,status=ok  order_by=-cpu  limit=20
+      group_by=status                 window=300&agg=avg|min|max (по истории за окно)
+    """
+    if np is None:
+        return jsonify({"error": "NumPy is not installed: /fleet/query is unavailable"}), 501
+    started = time.time()
+    try:
+        limit = max(1, min(int(request.args.get('limit', 100)), FLEET_QUERY_MAX_LIMIT))
+        window = max(0.0, min(float(request.args.get('window', 0)), FLEET_WINDOW_MAX))
+        result = query_fleet_table(
+            where=request.args.get('where'),
+            order_by=request.args.get('order_by'),
+            limit=limit,
+            group_by=request.args.get('group_by'),
+            window=window,
+            agg=request.args.get('agg'),
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    result["elapsed_ms"] = round((time.time() - started) * 1000, 3)
+    return jsonify(result)
+
+@app.route('/fleet/ring', methods=['GET'])
+def fleet_ring():
+    """Кольцо агрегаторов; ?key=<ip> - владельцы хоста, иначе - сколько хостов реестра у каждого."""
+    key = request.args.get('key')
+    if key:
+        return jsonify({"key": key, "owners": ring_owners(key), "self": AGGREGATOR_SELF})
+    counts = {peer: 0 for peer in hash_ring["peers"]}
+    for ip in user_registry["by_ip"]:
+        for owner in ring_owners(ip):
+            counts[owner] += 1
+    return jsonify({"self": AGGREGATOR_SELF, "peers": hash_ring["peers"], "replicas": AGGREGATOR_REPLICAS,
+                    "vnodes": RING_VNODES, "hosts_per_peer": counts})
+
+@app.route('/fleet/health', methods=['GET'])
+def fleet_health():
+    """Таблица здоровья хостов реестра: состояние автомата, задержка (EWMA), ошибки подряд."""
+    with host_health_lock:
+        snapshot = {ip: dict(h) for ip, h in host_health.items()}
+    rows, states = [], {}
+    for ip, user in fleet_hosts():
+        port = user.get("port", REMOTE_AGENT_PORT)
+        health = snapshot.pop(host_key(ip, port), None) or {**new_host_health(), "state": "unknown"}
+        if is_local_host(ip, port):
+            health["state"] = "local"
+        rows.append({"user": user["name"], "ip": ip, "port": port, **health})
+    # хосты, к которым ходили, но которых уже нет в реестре
+    for key, health in snapshot.items():
+        ip, _, port = key.rpartition(":")
+        rows.append({"user": None, "ip": ip, "port": int(port), **health})
+    for row in rows:
+        states[row["state"]] = states.get(row["state"], 0) + 1
+    return jsonify({"rows": rows, "summary": {"hosts": len(rows), "states": states}})
+
 # ------------------------------------------------------------------------------------
 #                       Фоновая проверка обновлений
 # ------------------------------------------------------------------------------------
@@ -512,7 +2225,7 @@ def background_update_checker():
         info = check_for_updates()
         if info.get("update_available"):
             print("[INFO] Фоновая проверка: найдено обновление, пробуем обновиться.")
-            res = do_update_if_available()
+            res = apply_update(info)
             if res.get("success"):
                 print("[INFO] Успешно обновились, завершаем старый процесс.")
                 break
@@ -525,7 +2238,31 @@ def background_update_checker():
 # ------------------------------------------------------------------------------------
 if __name__ == '__main__':
     print(f"[INFO] Запуск агента v{VERISONAPP}, PID={os.getpid()}, локальный IP={LOCAL_IP}")
+    config_error = aggregator_config_error()
+    if config_error:
+        print("[ERROR]", config_error)
+        sys.exit(1)
+    # Недокачанные файлы обновлений от прошлого запуска
+    cleanup_staged_updates()
+    # Хэш собственного файла считается один раз - проверки обновлений хэшируют только скачанное
+    try:
+        running_code_hash(update_file_type() == "py")
+    except OSError as e:
+        print("[WARNING] Не удалось вычислить хэш агента:", e)
     # Запускаем фоновой поток проверки обновлений
     threading.Thread(target=background_update_checker, daemon=True).start()
+    # Горячая перезагрузка реестра пользователей
+    threading.Thread(target=background_registry_watcher, daemon=True).start()
+    # Таблица участников по UDP-анонсам агентов
+    if DISCOVERY_MODE:
+        threading.Thread(target=background_discovery_listener, daemon=True).start()
+    # Фоновый опрос парка для окон /fleet/query
+    if FLEET_SAMPLE_INTERVAL > 0:
+        threading.Thread(target=background_fleet_sampler, daemon=True).start()
+    # Фоновые пробы хостов с открытым автоматом
+    threading.Thread(target=background_health_prober, daemon=True).start()
+    # Прогрев кэша ответов удалённых агентов (если включён)
+    if REMOTE_PREFETCH_INTERVAL > 0:
+        threading.Thread(target=background_remote_prefetch, daemon=True).start()
     # Запускаем Flask
     app.run(host='0.0.0.0', port=5000, use_reloader=False)